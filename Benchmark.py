@@ -0,0 +1,170 @@
+# stdlib
+import io
+import sys
+import time
+import tracemalloc
+
+# in-tree deps
+import matrix_client_core as client_framework
+import matrix_client_core.render as render
+from matrix_client_core.mockserver import MockHomeserver
+
+
+class FakeRoom:
+	# Just enough of matrix_client.room.Room for RoomList
+
+	def __init__(self, room_id, aliases, canonical_alias=None):
+		self.room_id = room_id
+		self.aliases = aliases
+		self.canonical_alias = canonical_alias
+
+
+def make_rooms(nrooms, naliases):
+	rooms = {}
+	for i in range(nrooms):
+		room_id = "!room{}:example.org".format(i)
+		aliases = ["#room{}-alias{}:example.org".format(i, j) for j in range(naliases)]
+		rooms[room_id] = FakeRoom(room_id, aliases, aliases[0] if aliases else None)
+	return rooms
+
+
+def timeit(func, *args, repeat=100000):
+	# Return the average number of seconds a single call to func takes
+	t0 = time.perf_counter()
+	for _ in range(repeat):
+		func(*args)
+	return (time.perf_counter() - t0) / repeat
+
+
+def bench_room_handle(nrooms=1000, alias_counts=(1, 4, 16, 64)):
+	print("RoomList.get_room_handle(), {} rooms:".format(nrooms))
+	print("{:>8} {:>14} {:>14}".format("aliases", "uncached (us)", "cached (us)"))
+	for naliases in alias_counts:
+		rooms = client_framework.RoomList(make_rooms(nrooms, naliases))
+		room_id = "!room{}:example.org".format(nrooms // 2)
+		room = rooms.get_room(room_id)
+		uncached = timeit(rooms._room_handle, room, repeat=10000)
+		cached = timeit(rooms.get_room_handle, room_id)
+		print("{:>8} {:>14.3f} {:>14.3f}".format(naliases, uncached * 1e6, cached * 1e6))
+
+
+def bench_roomlist_build(room_counts=(100, 1000, 10000), naliases=2):
+	print("RoomList build time, {} aliases per room:".format(naliases))
+	for nrooms in room_counts:
+		rooms = make_rooms(nrooms, naliases)
+		t = timeit(client_framework.RoomList, rooms, repeat=10)
+		print("{:>8} rooms {:>10.3f} ms".format(nrooms, t * 1e3))
+
+
+class MockSetup:
+	# A mock homeserver with one bot account in 'nrooms' rooms, each with
+	# 'nevents' messages from another user
+
+	def __init__(self, nrooms, nevents=0):
+		self.hs = MockHomeserver()
+		self.url = self.hs.start()
+		self.bot = self.hs.add_user("bot", access_token="bottoken")
+		self.other = self.hs.add_user("other")
+		self.room_ids = []
+		for i in range(nrooms):
+			self.room_ids.append(self.hs.create_room(self.other, name="Room {}".format(i),
+				aliases=["#room{}:localhost".format(i)], members=[self.bot]))
+		self.post(nevents)
+
+	def post(self, nevents):
+		for room_id in self.room_ids:
+			for i in range(nevents):
+				self.hs.put_event(room_id, self.other, "m.room.message",
+					{"msgtype": "m.text", "body": "Message {}".format(i)})
+
+	def client(self, sync_filter=None):
+		account = client_framework.AccountInfo()
+		account.hs_client_api_url = self.url
+		account.mxid = self.bot
+		account.access_token = "bottoken"
+		return client_framework.MXClient(account=account, sync_filter=sync_filter)
+
+	def stop(self):
+		self.hs.stop()
+
+
+def bench_first_sync(nrooms=200, nevents=10):
+	setup = MockSetup(nrooms, nevents)
+	client = setup.client()
+	t0 = time.perf_counter()
+	client.login()
+	client.first_sync()
+	t = time.perf_counter() - t0
+	setup.stop()
+	print("First sync, {} rooms with {} events: {:.3f} s".format(nrooms, nevents, t))
+
+
+def bench_stream_first_sync(nrooms=200, nevents=50):
+	print("First sync, {} rooms with {} events:".format(nrooms, nevents))
+	for streaming in (False, True):
+		setup = MockSetup(nrooms, nevents)
+		client = setup.client('{"room": {"timeline": {"limit": %d}}}' % nevents)
+		client.stream_first_sync = streaming
+		client.login()
+		tracemalloc.start()
+		t0 = time.perf_counter()
+		client.first_sync()
+		t = time.perf_counter() - t0
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+		setup.stop()
+		print("{:>10}: {:.3f} s, peak {:.1f} MB allocated".format(
+			"streaming" if streaming else "in one go", t, peak / 1e6))
+
+
+def bench_timeline_events(nrooms=50, nevents=100):
+	for label, sinks in (("no output", []), ("text output", [render.TextSink(io.StringIO())])):
+		setup = MockSetup(nrooms)
+		client = setup.client('{"room": {"timeline": {"limit": %d}}}' % nevents)
+		client.login()
+		client.first_sync()
+		client.last_event = None
+		client.renderer.sinks = sinks
+		client.sdkclient.add_listener(client.on_global_timeline_event)
+		setup.post(nevents)
+		t0 = time.perf_counter()
+		client.sdkclient._sync(timeout_ms=0)
+		t = time.perf_counter() - t0
+		setup.stop()
+		print("Timeline events ({}): {:.0f} events/s".format(label, nrooms * nevents / t))
+
+
+def bench_send(nrooms=10, nmessages=50, concurrency=4):
+	setup = MockSetup(nrooms)
+	client = setup.client()
+	client.login()
+	client.first_sync()
+	client.last_event = None
+	client.start_send_thread(send_sleep_time=0, concurrency=concurrency)
+	total = nrooms * nmessages
+	t0 = time.perf_counter()
+	for i in range(nmessages):
+		for room_id in setup.room_ids:
+			client.sendmsg(room_id, "Message {}".format(i))
+	while setup.hs.sent < total:
+		time.sleep(0.001)
+	t = time.perf_counter() - t0
+	setup.stop()
+	print("Send pipeline, {} rooms, {} workers: {:.0f} messages/s".format(nrooms, concurrency, total / t))
+
+
+BENCHMARKS = {
+	'handles': bench_room_handle,
+	'roomlist': bench_roomlist_build,
+	'first_sync': bench_first_sync,
+	'stream': bench_stream_first_sync,
+	'events': bench_timeline_events,
+	'send': bench_send	}
+
+if __name__ == '__main__':
+	import logging
+	logging.basicConfig(level=logging.CRITICAL)
+
+	names = sys.argv[1:] or BENCHMARKS.keys()
+	for name in names:
+		BENCHMARKS[name]()
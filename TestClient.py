@@ -5,32 +5,16 @@ import matrix_client
 
 # in-tree deps
 import matrix_client_core as client_framework
+import matrix_client_core.messagestore as messagestore
 import matrix_client_core.notifier as notifier
 
 
 class TestClient(client_framework.MXClient):
 	def connect(self):
-		self.sync_filter = '''{
-			"presence": { "types": [ "" ] },
-			"room": {
-				"ephemeral": { "types": [ "" ] },
-				"state": {
-					"types": [
-						"m.room.canonical_alias",
-						"m.room.aliases",
-						"m.room.name",
-						"m.room.topic"
-					]
-				},
-				"timeline": {
-					"types": [ "*" ],
-					"limit": 3
-				}
-			}
-		}'''
+		self.sync_filter = self.build_sync_filter(timeline_limit=3)
 
 		self.is_bot = False
-		self.message_store = {}
+		self.message_store = messagestore.MessageStore(per_room=100)
 		self.login()
 		self.first_sync()
 		self.hook()
@@ -48,6 +32,6 @@ if __name__ == '__main__':
 
 	nl = notifier.NotificationListener()
 
-	tc = TestClient('testclient-account.json')
+	tc = TestClient('testclient-account.json', statefilename='testclient-state.json')
 	tc.connect()
 	tc.run_forever()
@@ -1,5 +1,5 @@
 # stdlib
-import difflib
+import copy
 import functools
 import json
 import getpass
@@ -10,15 +10,26 @@ import sys
 import time
 import io
 import traceback
-import queue
 import threading
+import os
 
 # external deps
+import matrix_client.api
 import matrix_client.client
+import matrix_client.errors
 import requests
 
 # in-tree deps
+import matrix_client_core.backoff as backoff
+import matrix_client_core.dedup as dedup
+import matrix_client_core.dispatch as dispatch
+import matrix_client_core.httpsession as httpsession
 import matrix_client_core.notifier as notifier
+import matrix_client_core.recorder as recorder
+import matrix_client_core.render as render
+import matrix_client_core.roomstate as roomstate
+import matrix_client_core.sendqueue as sendqueue
+import matrix_client_core.syncstream as syncstream
 
 
 def wrap_exception(func):
@@ -51,6 +62,8 @@ class AccountInfo:
 		self.mxid = None
 		self.access_token = None
 		self.password = None
+		self.sync_filter = None		# canonical JSON of the uploaded filter
+		self.sync_filter_id = None	# the ID the server gave it
 
 	def loadfromfile(self, filename):
 		with open(filename, "r") as f:
@@ -58,6 +71,8 @@ class AccountInfo:
 			self.hs_client_api_url = j['hs_client_api_url']
 			self.mxid = j['mxid']
 			self.access_token = j['access_token']
+			self.sync_filter = j.get('sync_filter')
+			self.sync_filter_id = j.get('sync_filter_id')
 		return True
 
 	def savetofile(self, filename):
@@ -65,6 +80,9 @@ class AccountInfo:
 			'hs_client_api_url': self.hs_client_api_url,
 			'mxid': self.mxid,
 			'access_token': self.access_token	}
+		if self.sync_filter_id is not None:
+			d['sync_filter'] = self.sync_filter
+			d['sync_filter_id'] = self.sync_filter_id
 
 		with open(filename, "w") as f:
 			s = json.dumps(d, sort_keys=True,
@@ -106,7 +124,74 @@ class AccountInfo:
 		return bool(self.login_type())
 
 
+class SyncState:
+	# On-disk copy of what we need to resume syncing without a full
+	# initial sync: the sync token and the room state RoomList uses.
+
+	VERSION = 1
+	ROOM_ATTRS = ('aliases', 'canonical_alias', 'name', 'topic')
+
+	def __init__(self):
+		self.hs_client_api_url = None
+		self.mxid = None
+		self.next_batch = None
+		self.rooms = {}	# room ID -> dict of ROOM_ATTRS
+		self.seen_events = []	# most recently seen event IDs
+
+	def loadfromfile(self, filename):
+		with open(filename, "r") as f:
+			j = json.load(f)
+			if j.get('version') != self.VERSION:
+				raise ValueError("Unsupported sync state version: {!r}".format(j.get('version')))
+			self.hs_client_api_url = j['hs_client_api_url']
+			self.mxid = j['mxid']
+			self.next_batch = j['next_batch']
+			self.rooms = j['rooms']
+			self.seen_events = j.get('seen_events', [])
+		return True
+
+	def savetofile(self, filename):
+		d = {
+			'version': self.VERSION,
+			'hs_client_api_url': self.hs_client_api_url,
+			'mxid': self.mxid,
+			'next_batch': self.next_batch,
+			'rooms': self.rooms,
+			'seen_events': self.seen_events	}
+
+		# Write and rename, so a crash can never leave a truncated file
+		tmpfilename = filename + ".tmp"
+		with open(tmpfilename, "w") as f:
+			json.dump(d, f, sort_keys=True, separators=(',', ':'))
+		os.replace(tmpfilename, filename)
+		return True
+
+	def matches(self, account):
+		# Only resume if this state was saved for the same account
+		return bool(self.next_batch) \
+			and self.hs_client_api_url == account.hs_client_api_url \
+			and self.mxid == account.mxid
+
+	def capture(self, account, sdkclient):
+		self.hs_client_api_url = account.hs_client_api_url
+		self.mxid = account.mxid
+		self.next_batch = sdkclient.sync_token
+		self.rooms = dict((room_id, dict((a, getattr(room, a, None)) for a in self.ROOM_ATTRS))
+				for room_id, room in sdkclient.get_rooms().items())
+
+	def restore(self, sdkclient):
+		for room_id, attrs in self.rooms.items():
+			room = sdkclient.rooms.get(room_id) or sdkclient._mkroom(room_id)
+			for a in self.ROOM_ATTRS:
+				if a in attrs: setattr(room, a, attrs[a])
+			if room.aliases is None: room.aliases = []
+		sdkclient.sync_token = self.next_batch
+
+
 class RoomList:
+	# Safe to use from several threads: event handlers may update rooms
+	# while others look up handles.
+
 	RE_PREFIX = re.compile("^(#[^:]*)")
 
 	def __init__(self, roomsdict):
@@ -116,21 +201,80 @@ class RoomList:
 		self.roomsbyid = roomsdict
 		self.roomsbyalias = {}
 		self.roomsbyprefix = {}	# Note: Can contain list for multiple matches
+		self.indexedaliases = {}	# room ID -> aliases we indexed it under
+		self.handles = {}	# room ID -> cached result of _room_handle()
+		self.lock = threading.RLock()	# for all of the above
 
 		for r in roomsdict.values():
-			for alias in itertools.chain((r.canonical_alias,), r.aliases):
-				if alias is None: continue
-				self.roomsbyalias[alias] = r
-				m = self.RE_PREFIX.search(alias)
-				if not m: continue
-				prefix = m.group(1)
-				item = self.roomsbyprefix.get(prefix)
-				if item is None:
-					self.roomsbyprefix[prefix] = r
-				elif isinstance(item, list):
-					if r not in item: item.append(r)
-				elif item != r:
-					self.roomsbyprefix[prefix] = [item, r]
+			self._index_room(r)
+
+	def _index_room(self, r):
+		aliases = tuple(a for a in itertools.chain((r.canonical_alias,), r.aliases) if a is not None)
+		self.indexedaliases[r.room_id] = aliases
+		self.handles.pop(r.room_id, None)
+		for alias in aliases:
+			self.roomsbyalias[alias] = r
+			m = self.RE_PREFIX.search(alias)
+			if not m: continue
+			prefix = m.group(1)
+			item = self.roomsbyprefix.get(prefix)
+			self._forget_handles(item)
+			if item is None:
+				self.roomsbyprefix[prefix] = r
+			elif isinstance(item, list):
+				if r not in item: item.append(r)
+			elif item != r:
+				self.roomsbyprefix[prefix] = [item, r]
+
+	def _unindex_room(self, room_id):
+		# Undo whatever _index_room() did for this room. Aliases that were
+		# claimed by another room in the meantime are left alone.
+		aliases = self.indexedaliases.pop(room_id, ())
+		self.handles.pop(room_id, None)
+		for alias in aliases:
+			r = self.roomsbyalias.get(alias)
+			if r is not None and r.room_id == room_id:
+				del self.roomsbyalias[alias]
+			m = self.RE_PREFIX.search(alias)
+			if not m: continue
+			prefix = m.group(1)
+			item = self.roomsbyprefix.get(prefix)
+			self._forget_handles(item)
+			if item is None:
+				continue
+			elif isinstance(item, list):
+				item[:] = [x for x in item if x.room_id != room_id]
+				if len(item) == 1: self.roomsbyprefix[prefix] = item[0]
+				elif not item: del self.roomsbyprefix[prefix]
+			elif item.room_id == room_id:
+				del self.roomsbyprefix[prefix]
+
+	def _forget_handles(self, item):
+		# Whether a prefix is unique changes the handles of every room
+		# sharing it, so those are the ones that must be recomputed.
+		if item is None: return
+		if isinstance(item, list):
+			for r in item: self.handles.pop(r.room_id, None)
+		else:
+			self.handles.pop(item.room_id, None)
+
+	def add_room(self, room):
+		# Start tracking a room object (or refresh it, if we already do)
+		self.update_room(room)
+
+	def remove_room(self, room_id):
+		# Stop tracking a room. Note that 'roomsbyid' is normally the SDK's
+		# own rooms dict, so this also removes it from there.
+		with self.lock:
+			self._unindex_room(room_id)
+			self.roomsbyid.pop(room_id, None)
+
+	def update_room(self, room):
+		# Re-index a single room after its aliases have changed
+		with self.lock:
+			self._unindex_room(room.room_id)
+			self.roomsbyid[room.room_id] = room
+			self._index_room(room)
 
 	def get_room(self, id_or_alias_or_prefix):
 		# Find a room object by ID or alias, and return it
@@ -138,6 +282,10 @@ class RoomList:
 		# We also happen to guarantee that if the result is
 		# not None, 'id_or_alias_or_prefix' _uniquely_ identifies the room.
 
+		with self.lock:
+			return self._get_room(id_or_alias_or_prefix)
+
+	def _get_room(self, id_or_alias_or_prefix):
 		if id_or_alias_or_prefix in self.roomsbyid:
 			return self.roomsbyid[id_or_alias_or_prefix]
 		if id_or_alias_or_prefix in self.roomsbyalias:
@@ -165,22 +313,72 @@ class RoomList:
 	def get_room_handle(self, id_or_alias_or_prefix):
 		# get a convenient short display handle for the room
 		# always returns something useful, even if just unmodified id_or_alias_or_prefix
+		with self.lock:
+			room = self._get_room(id_or_alias_or_prefix)
+			if room is None: return id_or_alias_or_prefix
+			try:
+				return self.handles[room.room_id]
+			except KeyError:
+				pass
+			handle = self._room_handle(room)
+			# Rooms we haven't indexed yet (e.g. joined after the RoomList was
+			# built) may still get their aliases behind our back; don't cache.
+			if room.room_id in self.indexedaliases:
+				self.handles[room.room_id] = handle
+			return handle
+
+	def _room_handle(self, room):
+		# The uncached part of get_room_handle(). Walks all aliases. Call
+		# with self.lock held.
 		best_match = None
-		room = self.get_room(id_or_alias_or_prefix)
-		if room is None: return id_or_alias_or_prefix
 		for alias in itertools.chain((room.canonical_alias,), room.aliases):
 			if alias is None: continue
 			best_match = self._best_handle(best_match, alias)
 			m = self.RE_PREFIX.search(alias)
 			if not m: continue # This really should never happen, but.
 			prefix = m.group(1)
-			if self.get_room(prefix) is not None:
+			if self._get_room(prefix) is not None:
 				# prefix _uniquely_ identifies the room
 				best_match = self._best_handle(best_match, prefix)
-		if best_match is None: return id_or_alias_or_prefix
+		if best_match is None: return room.room_id
 		return best_match
 
 
+class _NoRetrySession:
+	# Wraps a requests session, turning 429 responses into exceptions
+	# before the SDK gets to sleep on them
+
+	def __init__(self, session):
+		self.session = session
+
+	def request(self, *args, **kwargs):
+		response = self.session.request(*args, **kwargs)
+		if response.status_code == 429:
+			raise matrix_client.errors.MatrixRequestError(code=429, content=response.text)
+		return response
+
+
+class NoRetryMatrixHttpApi(matrix_client.api.MatrixHttpApi):
+	# Makes requests exactly like 'api' does, and on its behalf (same
+	# server, token, session and transaction IDs), except that when the
+	# server says we're sending too fast, it raises MatrixRequestError
+	# with code 429 instead of sleeping and trying again. This leaves it
+	# to the send queue to slow down.
+
+	def __init__(self, api):
+		self.api = api
+
+	def __getattr__(self, name):
+		return getattr(self.api, name)
+
+	@property
+	def session(self):
+		return _NoRetrySession(self.api.session)
+
+	def _make_txn_id(self):
+		return self.api._make_txn_id()
+
+
 class NoSyncMatrixClient(matrix_client.client.MatrixClient):
 	# A subclass of MatrixClient that inhibits syncing until we allow it.
 
@@ -189,84 +387,184 @@ class NoSyncMatrixClient(matrix_client.client.MatrixClient):
 
 	def __init__(self, *args, **kwargs):
 		sync_filter = kwargs.pop('sync_filter', None)
+		session = kwargs.pop('session', None)
+		self.sync_done_listeners = []
+		self.sync_response_listeners = []	# called with whole responses only
+		self.sync_piece_listeners = []	# called with pieces of streamed ones too
+		self.processing_piece = False	# True while stream_sync() hands out a piece
+		self.recorder = None
 		matrix_client.client.MatrixClient.__init__(self, *args, **kwargs)
 		if sync_filter: self.sync_filter = sync_filter
+		# With a token, the SDK has already made one request (whoami) on
+		# its own session by now.
+		if session is not None: self.api.session = session
+		# Hook into the API object, so that we get to see each raw sync
+		# response before the SDK starts processing it.
+		self.sync_api = self.api
+		self.api_sync = self.api.sync
+		self.api.sync = self._api_sync
+
+	def use_sync_session(self, session):
+		# Sync over a session of its own, so that a long poll neither
+		# waits for nor holds up any other request. Call after logging in.
+		self.sync_api = copy.copy(self.api)
+		self.sync_api.session = session
+		self.api_sync = functools.partial(type(self.api).sync, self.sync_api)
+
+	def _api_sync(self, *args, **kwargs):
+		response = self.api_sync(*args, **kwargs)
+		if self.processing_piece:
+			for callback in self.sync_piece_listeners: callback(response)
+			return response
+		if self.recorder is not None: self.recorder.write("sync", response)
+		for callback in self.sync_piece_listeners: callback(response)
+		for callback in self.sync_response_listeners: callback(response)
+		return response
 
 	def _sync(self, *args, **kwargs):
 		self.sync_attempted = True
 		self.sync_args = args
 		self.sync_kwargs = kwargs
 		if getattr(self, 'sync_enabled', False):
+			t0 = time.monotonic()
 			matrix_client.client.MatrixClient._sync(self, *args, **kwargs)
+			notifier.notify(__name__, 'mcc.mxc.sync.done', time.monotonic() - t0)
+			for callback in self.sync_done_listeners: callback()
 
 	def enable_sync(self):
 		self.sync_enabled = True
 
-	def finish_fixup(self):
+	def add_sync_done_listener(self, callback):
+		# Called without arguments after every completed sync
+		self.sync_done_listeners.append(callback)
+
+	def add_sync_response_listener(self, callback, pieces=False):
+		# Called once with each raw sync response, before any of the SDK's
+		# own processing or event listeners. Set 'pieces' for callbacks
+		# that work just as well on parts of a response: those get a
+		# streamed response (see stream_sync()) piece by piece as it comes
+		# in, and are called before the others.
+		if pieces: self.sync_piece_listeners.append(callback)
+		else: self.sync_response_listeners.append(callback)
+
+	def finish_fixup(self, streaming=False, room_filter=None, **kwargs):
 		# This basically enables syncing, and calls the real _sync if
 		# and only if it would have been called by the constructor.
+		# Keyword arguments override those of the inhibited call.
+		# 'streaming' does that sync with stream_sync() instead.
 
 		self.enable_sync()
 		if getattr(self, 'sync_attempted', False):
-			matrix_client.client.MatrixClient._sync(self, *self.sync_args, **self.sync_kwargs)
+			sync_kwargs = dict(self.sync_kwargs, **kwargs)
+			if streaming:
+				self.stream_sync(*self.sync_args, room_filter=room_filter, **sync_kwargs)
+			else:
+				matrix_client.client.MatrixClient._sync(self, *self.sync_args, **sync_kwargs)
+
+	def stream_sync(self, timeout_ms=30000, room_filter=None):
+		# A sync that is processed while it is being downloaded, one room
+		# at a time, so that the whole response is never in memory at
+		# once. Events that 'room_filter' doesn't want are dropped before
+		# anyone sees them.
+
+		# Each room goes through the SDK's own _sync() as a response of its
+		# own, and so do the remaining top-level keys after that, along
+		# with the new sync token. Should the download fail halfway, the
+		# token is unchanged and the next sync starts over.
+
+		# Only piece listeners see those pieces. The other sync response
+		# listeners (and the recorder) still get the response in one piece,
+		# but only after the SDK is done with it, and for them it has to be
+		# put back together in memory.
+		chunks = syncstream.fetch(self.sync_api, self.sync_token, timeout_ms, self.sync_filter)
+		whole = None
+		if self.sync_response_listeners or self.recorder is not None: whole = {'rooms': {}}
+		rest = {'rooms': {}}
+		try:
+			for path, value in syncstream.iter_sync(chunks):
+				if len(path) == 3:
+					section, room_id = path[1:]
+					if room_filter and section == 'join': syncstream.filter_room(value, room_filter)
+					self._process_response({'next_batch': self.sync_token, 'rooms': {section: {room_id: value}}}, True)
+					if whole is not None: whole['rooms'].setdefault(section, {})[room_id] = value
+				elif len(path) == 2:
+					rest['rooms'][path[1]] = value
+				else:
+					rest[path[0]] = value
+		finally:
+			# Gives the connection back, even if we stopped halfway
+			chunks.close()
+		self._process_response(rest, True)
+		if whole is None: return
+		for key, value in rest.items():
+			if key != 'rooms': whole[key] = value
+		for section, rooms in rest['rooms'].items():
+			whole['rooms'].setdefault(section, {}).update(rooms)
+		if self.recorder is not None: self.recorder.write("sync", whole)
+		for callback in self.sync_response_listeners: callback(whole)
+
+	def _process_response(self, response, piece=False):
+		# Run an already decoded sync response (or a piece of one) through
+		# _sync()
+		api_sync = self.api_sync
+		self.api_sync = lambda *args, **kwargs: response
+		self.processing_piece = piece
+		try:
+			matrix_client.client.MatrixClient._sync(self)
+		finally:
+			self.api_sync = api_sync
+			self.processing_piece = False
 
 
 class MXClient:
-	def __init__(self, accountfilename=None, account=None, sync_filter=None):
+	# Handlers for specific event types, as (method name, event type)
+	EVENT_HANDLERS = (
+		('on_m_room_canonical_alias', 'm.room.canonical_alias'),
+		('on_m_room_aliases', 'm.room.aliases'))
+
+	# State that RoomList and the REPL need, whatever handlers there are
+	BASE_STATE_TYPES = ('m.room.aliases', 'm.room.canonical_alias', 'm.room.name', 'm.room.topic')
+
+	def __init__(self, accountfilename=None, account=None, sync_filter=None, statefilename=None):
 		self.accountfilename = accountfilename
 		self.account = account
+		self.statefilename = statefilename
+		self.state_save_interval = 60
+		self.state_saved_time = 0
 		self.sdkclient = None
 		self.sync_filter = sync_filter
+		self.sync_filter_cached = False	# its ID came from the account file, not the server
 		self.initial_sync_timeout_seconds = 600
 		self.sync_timeout_seconds = 100
-		self.exception_delay_init = 45
-		self.exception_delay = self.exception_delay_init
-		self.sendq = queue.Queue()
+		self.api_timeout_seconds = 30	# for everything but syncing
+		self.backoff = backoff.Backoff()
+		self.renderer = render.Renderer([render.TextSink()])
+		self.recorder = None
+		self.seen_events = dedup.SeenEvents()	# None = don't filter duplicates
+		self.seen_events_saved = 1000	# how many of them to keep in the state file
+		self.room_state = roomstate.RoomStateCache()	# None = always ask the server
+		self.stream_first_sync = False	# True = parse the initial sync as it comes in
+		self.message_store = None	# a messagestore.MessageStore to keep timeline events in
+		self.host = None	# the host.BotHost running this client, if any
+		self.last_event = None
+		self.http_session = None	# httpsession.TimeoutSession for API calls; None = make one
+		self.sync_session = None	# the same, for syncing only
+		self.per_event_callbacks = True	# False = only on_sync_batch() gets timeline events
+		self.event_workers = 0	# 0 = run event handlers on the sync thread
+		self.event_backlog = 1000
+		self.dispatcher = None
+		self.sendq = sendqueue.SendScheduler()
+		self.send_api = None	# NoRetryMatrixHttpApi, for sendcmd
 		self.sendcmd = None
-
-	@staticmethod
-	def _prettyprint_raw_event(prefix, event):
-		print(prefix, end=' ')
-		pprint.pprint(event)
-
-	def _print_diff(self, prefix, event):
-		self._print_diff_root(prefix, event)
-		self._print_diff_unsigned(prefix, event)
-		self._print_diff_checkunsigned(prefix, event)
-
-	def _print_diff_root(self, prefix, event):
-		try:
-			a, b = event['prev_content'], event['content']
-		except KeyError:
-			return
-		self._print_actual_diff(prefix + " Diff root/content:", a, b)
-
-	def _print_diff_unsigned(self, prefix, event):
-		try:
-			a, b = event['unsigned']['prev_content'], event['content']
-		except KeyError:
-			return
-		self._print_actual_diff(prefix + " Diff unsigned/content:", a, b)
-
-	def _print_diff_checkunsigned(self, prefix, event):
-		try:
-			a, b = event['prev_content'], event['unsigned']['prev_content']
-		except KeyError:
-			return
-		self._print_actual_diff(prefix + " Diff root/unsigned(!):", a, b)
-
-	@staticmethod
-	def _print_actual_diff(prefix, a, b):
-		ppa = (pprint.pformat(a) + "\n").splitlines(True)
-		ppb = (pprint.pformat(b) + "\n").splitlines(True)
-		print(prefix)
-		print("".join(difflib.ndiff(ppa, ppb)), end='')
+		self.send_concurrency = 4
 
 	@wrap_exception
 	def on_m_room_aliases(self, event):
 		self.last_event = event
 		if 'state_key' not in event: return # not a state event!
-		self.rooms = RoomList(self.sdkclient.get_rooms())
+		room = self.sdkclient.get_rooms().get(event['room_id'])
+		if room is None: return
+		self.rooms.update_room(room)
 
 	on_m_room_canonical_alias = on_m_room_aliases
 
@@ -274,53 +572,64 @@ class MXClient:
 	def on_global_timeline_event(self, event):
 		self.last_event = event
 		roomid = event['room_id']
+		if not self.renderer.sinks:
+			# Nobody's going to look at it, so don't bother formatting
+			return
+
 		roomhandle = self.rooms.get_room_handle(roomid)
-		roomprefix = "[{0}]".format(roomhandle)
 
 		sender = event['sender']
 		rich_sender = sender
-		try:
-			rich_sender = "{} ({})".format(sender, event['content']['displayname'])
-		except KeyError:
-			try:
-				rich_sender = "{} ({})".format(sender, event['unsigned']['prev_content']['displayname'])
-			except KeyError:
-				pass
-
-		if event['type'] == "m.room.member":
-			if event['content']['membership'] == "join":
-				print(roomprefix, "{} joined".format(rich_sender))
-			elif event['content']['membership'] == "leave":
-				print(roomprefix, "{} left".format(rich_sender))
-			else:
-				self._prettyprint_raw_event(roomprefix, event)
-		elif event['type'] == "m.room.message":
-			if event['content']['msgtype'] == "m.text":
-				inmsg = event['content']['body']
-				print(roomprefix, "{}: {}".format(rich_sender, inmsg))
-			elif event['content']['msgtype'] == "m.emote":
-				print(roomprefix, " * {} {}".format(rich_sender, event['content']['body']))
-			else:
-				print(roomprefix, " ? {}:{}: {}".format(
-					rich_sender,
-					event['content']['msgtype'],
-					event['content'].get('body', "")))
-		else:
-			self._prettyprint_raw_event(roomprefix, event)
-
-		self._print_diff(roomprefix, event)
-
-		self._reset_exc_delay()
-
-	def _reset_exc_delay(self):
-		self.exception_delay = self.exception_delay_init
-
-	def _exc_delay(self):
-		ret = self.exception_delay
-		self.exception_delay *= 2
-		return ret
+		displayname = None
+		if self.room_state is not None:
+			# Asking the server here would hold up syncing
+			displayname = self.room_state.displayname(roomid, sender, fetch=False)
+			if displayname is None: self.room_state.prefetch(roomid, 'm.room.member', sender)
+		if displayname is None:
+			displayname = event.get('content', {}).get('displayname')
+		if displayname is None:
+			# Someone who just left still had a name a moment ago
+			displayname = event.get('unsigned', {}).get('prev_content', {}).get('displayname')
+		if displayname is not None:
+			rich_sender = "{} ({})".format(sender, displayname)
+
+		self.renderer.render(roomhandle, rich_sender, event)
+
+	# Before Backoff, there was one delay for every kind of failure. These
+	# still work, for the sync thread's delay.
+	@property
+	def exception_delay_init(self):
+		return self.backoff.initial
+
+	@exception_delay_init.setter
+	def exception_delay_init(self, value):
+		self.backoff.initial = value
+
+	@property
+	def exception_delay(self):
+		return self.backoff.next_delay(backoff.SYNC)
+
+	@exception_delay.setter
+	def exception_delay(self, value):
+		# Starts over, from 'value'
+		self.backoff.success(backoff.SYNC)
+		self.backoff.initial = value
+
+	def on_exception(self, e, source=backoff.HANDLER):
+		# Only the sync thread waits here, as it has nothing else to do
+		# but try again. Everyone else carries on; failed sends hold up
+		# their room's lane for a while (see send_one()). Failed handlers
+		# and REPL commands aren't run again, so they don't back off.
+		self._report_exception(e)
+		notifier.notify(__name__, 'mcc.mxc.exception', source)
+		if source not in backoff.RETRIED: return
+		delay = self.backoff.failure(source)
+		if source != backoff.SYNC: return
+		print("Waiting {0:.1f} seconds before trying again.".format(delay))
+		self.backoff.wait(source)
+		print("Let's go!")
 
-	def on_exception(self, e):
+	def _report_exception(self, e):
 		print("Exception caught:", traceback.format_exception_only(type(e), e)[-1].strip())
 		print("Type /debug to show more info.")
 		moreinfo = io.StringIO()
@@ -332,47 +641,197 @@ class MXClient:
 		self.debug_info = moreinfo.getvalue()
 		moreinfo.close()
 
-		delay = self._exc_delay()
-		print("Waiting {0} seconds before trying again.".format(delay))
-		time.sleep(delay)
-		print("Let's go!")
-
-	def sendmsg(self, room_id, msg):
+	def sendmsg(self, room_id, msg, priority=sendqueue.NORMAL, ttl=None):
+		# Queue a message. sendqueue.INTERACTIVE messages go before NORMAL
+		# ones, which go before BULK ones. Unless it can be sent within
+		# 'ttl' seconds (if given), it is dropped.
 		notifier.notify(__name__, 'mcc.mxc.sendmsg', msg)
-		self.sendq.put((room_id, msg))
+		self.sendq.put(self._lane(room_id), msg, priority, ttl)
+
+	def _lane(self, room_id):
+		# The send queue and dispatcher key for a room. Clients sharing a
+		# host also share those, so they each get their own keys.
+		if self.host is None: return room_id
+		return (self, room_id)
+
+	@staticmethod
+	def _retry_after(e):
+		# If 'e' is the server telling us to slow down, return the number of
+		# seconds it wants us to wait (0 if unspecified). Otherwise None.
+		content = e.content
+		if not isinstance(content, dict):
+			try:
+				content = json.loads(content)
+			except (ValueError, TypeError):
+				content = {}
+		if e.code != 429 and content.get('errcode') != 'M_LIMIT_EXCEEDED':
+			return None
+		try:
+			return content['retry_after_ms'] / 1000
+		except (KeyError, TypeError):
+			return 0
 
 	def sendrunner(self):
 		while True:
-			try:
-				room_id, msg = self.sendq.get()
-				notifier.notify(__name__, 'mcc.mxc.sendrunner.sendcmd', msg)
-				self.sendcmd(room_id, msg)
-			except queue.Empty:
-				print("Queue was empty")
-			time.sleep(self.send_sleep_time)
-
-	def start_send_thread(self, sendcmd, send_sleep_time=5):
-		self.sendcmd = sendcmd
+			key, msg = self.sendq.get()
+			self.send_one(key, key, msg)
+
+	def send_one(self, key, room_id, msg):
+		# Send a message taken from the send queue under 'key'
+		t0 = time.monotonic()
+		try:
+			notifier.notify(__name__, 'mcc.mxc.sendrunner.sendcmd', msg)
+			self.sendcmd(room_id, msg)
+			notifier.notify(__name__, 'mcc.mxc.sendrunner.sent', (room_id, time.monotonic() - t0))
+		except matrix_client.errors.MatrixRequestError as e:
+			self._record_send(room_id, e.code, t0)
+			retry_after = self._retry_after(e)
+			if retry_after is None: self._send_failed(key, e)
+			else: self.sendq.throttle(key, msg, retry_after)
+		except Exception as e:
+			self._record_send(room_id, type(e).__name__, t0)
+			self._send_failed(key, e)
+		else:
+			self._record_send(room_id, "ok", t0)
+			self.sendq.success()
+			self.backoff.success(backoff.SEND)
+		finally:
+			self.sendq.done(key)
+
+	def _send_failed(self, key, e):
+		# Give up on the message, and hold off sending to that room
+		self.on_exception(e, backoff.SEND)
+		self.sendq.defer(key, self.backoff.remaining(backoff.SEND))
+
+	def _record_send(self, room_id, result, t0):
+		if self.recorder is None: return
+		self.recorder.write("send", [room_id, result, time.monotonic() - t0])
+
+	def start_recording(self, filename):
+		# Append raw sync responses and send results to a trace file, for
+		# later use with recorder.TraceReplayer. Call after login().
+		self.recorder = recorder.TraceWriter(filename)
+		self.sdkclient.recorder = self.recorder
+
+	def stop_recording(self):
+		if self.recorder is None: return
+		self.sdkclient.recorder = None
+		self.recorder.close()
+		self.recorder = None
+
+	def start_send_thread(self, sendcmd=None, send_sleep_time=5, concurrency=None):
+		# 'send_sleep_time' is the minimum time between two messages to the
+		# same room. Up to 'concurrency' rooms are sent to in parallel.
+		# 'sendcmd' defaults to sending an m.text message. Use methods of
+		# self.send_api for it, so that the send queue gets to see when the
+		# server wants us to slow down; the SDK's own api would just sleep.
+		self.sendcmd = sendcmd or self.send_api.send_message
 		self.send_sleep_time = send_sleep_time
-		t = threading.Thread(target=self.sendrunner)
-		t.daemon = True
-		t.start()
+		self.sendq.pacing = send_sleep_time
+		if concurrency is not None: self.send_concurrency = concurrency
+		for i in range(self.send_concurrency):
+			t = threading.Thread(target=self.sendrunner)
+			t.daemon = True
+			t.start()
+
+	@staticmethod
+	def _timed(handler):
+		# Wrap a listener so that its run time gets reported
+		name = handler.__name__
+
+		@functools.wraps(handler)
+		def wrapper(*args, **kwargs):
+			t0 = time.perf_counter()
+			try:
+				return handler(*args, **kwargs)
+			finally:
+				notifier.notify(__name__, 'mcc.mxc.handler.done', (name, time.perf_counter() - t0))
+
+		return wrapper
+
+	def _dispatched(self, handler):
+		# Wrap a listener so that it runs on the dispatcher's worker pool,
+		# in order with the other events of the same room
+		if self.dispatcher is None: return handler
+
+		@functools.wraps(handler)
+		def wrapper(event):
+			self.dispatcher.submit(self._lane(event['room_id']), handler, event)
+
+		return wrapper
+
+	def _drop_duplicate_events(self, response):
+		# Remove timeline events we've already seen (e.g. when a sync is
+		# retried) from a sync response, before anything else gets to them
+		for room_id, sync_room in response.get('rooms', {}).get('join', {}).items():
+			timeline = sync_room.get('timeline')
+			if not timeline or not timeline.get('events'): continue
+			events = []
+			for event in timeline['events']:
+				event_id = event.get('event_id')
+				if event_id is not None and self.seen_events.check(event_id):
+					notifier.notify(__name__, 'mcc.mxc.duplicate_event', (room_id, event_id))
+					continue
+				events.append(event)
+			timeline['events'] = events
+
+	@wrap_exception
+	def _dispatch_sync_batch(self, response):
+		# Hand the timeline events of one sync response to
+		# on_sync_batch() in one go
+		batch = self._sync_batch(response)
+		if batch: self.on_sync_batch(batch)
+
+	@staticmethod
+	def _sync_batch(response):
+		# Collect the timeline events of a sync response by room
+		batch = {}
+		for room_id, sync_room in response.get('rooms', {}).get('join', {}).items():
+			events = sync_room.get('timeline', {}).get('events')
+			if not events: continue
+			for event in events:
+				event['room_id'] = room_id
+			batch[room_id] = events
+		return batch
 
 	def hook(self):
 		# Connect all the listeners, start threads etc.
-		self.last_event = None
-		m = getattr(self, 'on_global_timeline_event', None)
-		if callable(m): self.sdkclient.add_listener(m)
-		m = getattr(self, 'on_m_room_canonical_alias', None)
-		if callable(m): self.sdkclient.add_listener(m, 'm.room.canonical_alias')
-		m = getattr(self, 'on_m_room_aliases', None)
-		if callable(m): self.sdkclient.add_listener(m, 'm.room.aliases')
-		m = getattr(self, 'on_exception', None)
-		if callable(m): self.sdkclient.start_listener_thread(exception_handler=m)
-		else: self.sdkclient.start_listener_thread()
+		self.add_listeners()
+		self.sdkclient.start_listener_thread(
+			exception_handler=functools.partial(self.on_exception, source=backoff.SYNC))
 		# Only supported by urllib-requests-adapter. NOOP otherwise.
 		requests.GLOBAL_TIMEOUT_SECONDS = self.sync_timeout_seconds
 
+	def add_listeners(self):
+		# The part of hook() that doesn't start syncing
+		self.last_event = None
+		if self.dispatcher is None and self.event_workers > 0:
+			self.dispatcher = dispatch.OrderedDispatcher(self.event_workers, self.event_backlog)
+			self.dispatcher.start()
+		if self.room_state is not None and self.room_state.api is not None and self.room_state.executor is None:
+			# Prefetch state on the event workers, or on a worker of its own
+			executor = self.dispatcher
+			if executor is None:
+				executor = dispatch.OrderedDispatcher(1, self.event_backlog)
+				executor.start()
+			self.room_state.executor = executor
+		m = getattr(self, 'on_sync_batch', None)
+		if callable(m): self.sdkclient.add_sync_response_listener(self._timed(self._dispatch_sync_batch))
+		m = getattr(self, 'on_global_timeline_event', None)
+		if callable(m) and self.per_event_callbacks: self.sdkclient.add_listener(self._dispatched(self._timed(m)))
+		for mname, event_type in self.EVENT_HANDLERS:
+			m = getattr(self, mname, None)
+			if callable(m): self.sdkclient.add_listener(self._dispatched(self._timed(m)), event_type)
+		self.sdkclient.add_leave_listener(self._forget_left_room)
+		if self.statefilename is not None:
+			self.sdkclient.add_sync_done_listener(self.on_sync_done)
+		self.sdkclient.add_sync_done_listener(functools.partial(self.backoff.success, backoff.SYNC))
+
+	@wrap_exception
+	def _forget_left_room(self, room_id, left_room):
+		# The SDK drops the room object, but its aliases are still indexed
+		self.rooms.remove_room(room_id)
+
 	def repl_debug(self, txt):
 		""" Show more information about the last error that happened """
 		print(getattr(self, 'debug_info', "No errors.\n"), end='')
@@ -443,7 +902,10 @@ class MXClient:
 			print("You are not a member of that room.")
 			return True
 
-		ops = self.sdkclient.api.get_power_levels(room.room_id)
+		if self.room_state is not None:
+			ops = self.room_state.power_levels(room.room_id)
+		else:
+			ops = self.sdkclient.api.get_power_levels(room.room_id)
 		pprint.pprint(ops)
 
 		return True
@@ -471,7 +933,7 @@ class MXClient:
 		# or as a bot manhole.
 
 		if exception_handler is True:
-			exception_handler = self.on_exception
+			exception_handler = functools.partial(self.on_exception, source=backoff.REPL)
 
 		while True:
 			try:
@@ -515,15 +977,89 @@ class MXClient:
 
 		return True
 
+	def build_sync_filter(self, timeline_limit=None, lazy_load_members=True):
+		# Build the smallest sync filter that still gets every handler this
+		# client defines the events it needs. Assign the result to
+		# self.sync_filter before login() to have it uploaded.
+
+		state_types = set(self.BASE_STATE_TYPES)
+		if self.room_state is not None: state_types.update(self.room_state.TYPES)
+		timeline_types = set()
+		for mname, event_type in self.EVENT_HANDLERS:
+			if callable(getattr(self, mname, None)):
+				state_types.add(event_type)
+				timeline_types.add(event_type)
+		for mname in ('on_global_timeline_event', 'on_sync_batch'):
+			if callable(getattr(self, mname, None)): timeline_types = set(("*",))
+
+		state = {"types": sorted(state_types)}
+		# Only the members who sent something; the rest on demand
+		if lazy_load_members: state["lazy_load_members"] = True
+		timeline = {"types": sorted(timeline_types)}
+		if timeline_limit is not None: timeline["limit"] = timeline_limit
+		nothing = {"not_types": ["*"]}
+		return {
+			"presence": nothing,
+			"account_data": nothing,
+			"room": {
+				"ephemeral": nothing,
+				"account_data": nothing,
+				"state": state,
+				"timeline": timeline	}	}
+
+	def _upload_sync_filter(self):
+		# Make sure the server has our filter, and return its ID. The ID is
+		# remembered in the account file, so we only upload a filter again
+		# after it has changed.
+		canonical, filter_id = self._cached_sync_filter()
+		self.sync_filter_cached = bool(filter_id)
+		if filter_id: return filter_id
+		notifier.notify(__name__, 'mcc.mxc.login.upload_filter', canonical)
+		response = self.sdkclient.api.create_filter(self.account.mxid, self.sync_filter)
+		return self._remember_sync_filter(canonical, response['filter_id'])
+
+	def _cached_sync_filter(self):
+		# Returns the canonical JSON of our filter, and its ID if we
+		# uploaded it before (None otherwise)
+		canonical = json.dumps(self.sync_filter, sort_keys=True, separators=(',', ':'))
+		if self.account.sync_filter == canonical: return canonical, self.account.sync_filter_id
+		return canonical, None
+
+	def _remember_sync_filter(self, canonical, filter_id):
+		self.account.sync_filter = canonical
+		self.account.sync_filter_id = filter_id
+		if self.accountfilename is not None: self.account.savetofile(self.accountfilename)
+		return filter_id
+
+	def _forget_stale_filter(self, e):
+		# Called when a sync failed with 'e'. If that may be because the
+		# server no longer knows the filter ID we remembered from an
+		# earlier run, forget it and return True: the caller should upload
+		# the filter again and retry.
+		if not 400 <= e.code < 500 or not self.sync_filter_cached: return False
+		notifier.notify(__name__, 'mcc.mxc.first_sync.filter_rejected', (self.account.sync_filter_id, e.code))
+		self.account.sync_filter_id = None
+		self.sync_filter_cached = False
+		return True
+
 	def login(self):
 		# Only supported by urllib-requests-adapter. NOOP otherwise.
 		requests.GLOBAL_TIMEOUT_SECONDS = self.initial_sync_timeout_seconds
 
 		self._ensure_account()
 		t = self.account.login_type()
+		if self.http_session is None:
+			# One connection for each thread that might make API calls
+			self.http_session = httpsession.TimeoutSession("api", self.api_timeout_seconds,
+				self.send_concurrency + self.event_workers + 1)
+		if self.sync_session is None:
+			self.sync_session = httpsession.TimeoutSession("sync", self.sync_timeout_seconds, 1)
+		# A filter given as a dict gets uploaded, and referred to by ID
+		sync_filter = None if isinstance(self.sync_filter, dict) else self.sync_filter
 		notifier.notify(__name__, 'mcc.mxc.login.connect', (self.account.hs_client_api_url, self.account.mxid))
 		if t == self.account.T_PASSWORD:
-			self.sdkclient = NoSyncMatrixClient(self.account.hs_client_api_url, sync_filter=self.sync_filter)
+			self.sdkclient = NoSyncMatrixClient(self.account.hs_client_api_url,
+				sync_filter=sync_filter, session=self.http_session)
 			notifier.notify(__name__, 'mcc.mxc.login.login', (self.account.mxid))
 			token = self.sdkclient.login_with_password(self.account.mxid, self.account.password)
 			self.account.access_token = token
@@ -534,17 +1070,98 @@ class MXClient:
 				self.account.hs_client_api_url,
 				token=self.account.access_token,
 				user_id=self.account.mxid,
-				sync_filter=self.sync_filter)
+				sync_filter=sync_filter,
+				session=self.http_session)
 		else:
 			raise CFException("MXClient.login(): Cannot login: 'account' is (partially) uninitialized")
+		self.sdkclient.use_sync_session(self.sync_session)
+		self.send_api = NoRetryMatrixHttpApi(self.sdkclient.api)
+		if isinstance(self.sync_filter, dict):
+			self.sdkclient.sync_filter = self._upload_sync_filter()
+		if self.room_state is not None: self.room_state.api = self.sdkclient.api
+		self._add_response_listeners()
 		self.sdkclient.enable_sync()
 
+	def _add_response_listeners(self):
+		# The raw sync response listeners that keep our own state. They
+		# can all take a streamed response piece by piece.
+		if self.seen_events is not None:
+			self.sdkclient.add_sync_response_listener(self._drop_duplicate_events, pieces=True)
+		if self.room_state is not None:
+			self.sdkclient.add_sync_response_listener(self.room_state.on_sync_response, pieces=True)
+		if self.message_store is not None:
+			self.sdkclient.add_sync_response_listener(self.message_store.add_sync_response, pieces=True)
+
 	def first_sync(self):
 		notifier.notify(__name__, 'mcc.mxc.first_sync.sync')
-		self.sdkclient.finish_fixup()
+		with self.sync_session.timeout_override(self.initial_sync_timeout_seconds):
+			self._first_sync()
 		notifier.notify(__name__, 'mcc.mxc.first_sync.sync_done')
 		self.rooms = RoomList(self.sdkclient.get_rooms())
 		self.foreground_room = None
+		self._save_sync_state()
+
+	def _first_sync(self):
+		if self._load_sync_state():
+			# Resume where we left off. No need to long-poll for that.
+			try:
+				self._with_filter_retry(self.sdkclient.finish_fixup, timeout_ms=0)
+			except matrix_client.errors.MatrixRequestError as e:
+				if not 400 <= e.code < 500: raise
+				notifier.notify(__name__, 'mcc.mxc.first_sync.resume_failed', e.code)
+				self.sdkclient.sync_token = None
+				self.sdkclient.rooms.clear()
+				self._with_filter_retry(self._full_sync)
+		else:
+			self._with_filter_retry(self._full_sync)
+
+	def _with_filter_retry(self, func, *args, **kwargs):
+		# Sync with func(), once more with a newly uploaded filter if the
+		# remembered one was refused
+		try:
+			func(*args, **kwargs)
+		except matrix_client.errors.MatrixRequestError as e:
+			if not self._forget_stale_filter(e): raise
+			self.sdkclient.sync_filter = self._upload_sync_filter()
+			func(*args, **kwargs)
+
+	def _full_sync(self):
+		room_filter = None
+		if isinstance(self.sync_filter, dict): room_filter = self.sync_filter.get('room')
+		self.sdkclient.finish_fixup(streaming=self.stream_first_sync, room_filter=room_filter)
+
+	def _load_sync_state(self):
+		# Returns True if the saved state was restored into sdkclient
+		if self.statefilename is None: return False
+		state = SyncState()
+		try:
+			state.loadfromfile(self.statefilename)
+		except IOError as e:
+			if e.errno != 2: # 2 = File Not Found
+				notifier.notify(__name__, 'mcc.mxc.state.load_failed', e)
+			return False
+		except (ValueError, KeyError, TypeError) as e:
+			notifier.notify(__name__, 'mcc.mxc.state.load_failed', e)
+			return False
+		if not state.matches(self.account): return False
+		state.restore(self.sdkclient)
+		if self.seen_events is not None: self.seen_events.load(state.seen_events)
+		notifier.notify(__name__, 'mcc.mxc.state.restored', (state.next_batch, len(state.rooms)))
+		return True
+
+	def _save_sync_state(self):
+		if self.statefilename is None: return
+		state = SyncState()
+		state.capture(self.account, self.sdkclient)
+		if self.seen_events is not None:
+			state.seen_events = self.seen_events.recent(self.seen_events_saved)
+		state.savetofile(self.statefilename)
+		self.state_saved_time = time.time()
+
+	@wrap_exception
+	def on_sync_done(self):
+		if time.time() - self.state_saved_time >= self.state_save_interval:
+			self._save_sync_state()
 
 	def _ensure_account(self):
 		account = self.account
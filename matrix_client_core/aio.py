@@ -0,0 +1,613 @@
+# An asyncio flavour of MXClient.
+
+# AsyncMXClient does its syncing, sending, backing off and REPL as
+# coroutines on a single event loop, over a small built-in HTTP client.
+# It keeps MXClient's handlers (on_global_timeline_event, on_m_room_*,
+# on_sync_batch, repl_*) and notifier events. Handlers may be plain
+# methods, which run right on the loop, or coroutines, which run as tasks
+# in order per room.
+
+# stdlib
+import asyncio
+import collections
+import functools
+import json
+import pprint
+import ssl
+import sys
+import time
+import urllib.parse
+
+# external deps
+import matrix_client.errors
+
+# in-tree deps
+import matrix_client_core as client_framework
+import matrix_client_core.backoff as backoff
+import matrix_client_core.notifier as notifier
+import matrix_client_core.sendqueue as sendqueue
+
+API_PATH = "/_matrix/client/r0"
+
+
+class HTTPClient:
+	# A minimal HTTP/1.1 client keeping up to 'max_connections' keep-alive
+	# connections to one server. It does just what the client-server API
+	# needs: small bodies, with Content-Length or chunked responses.
+
+	def __init__(self, base_url, name="api", timeout=30, max_connections=4):
+		url = urllib.parse.urlsplit(base_url)
+		self.name = name
+		self.ssl = ssl.create_default_context() if url.scheme == "https" else None
+		self.host = url.hostname
+		self.port = url.port or (443 if self.ssl else 80)
+		self.netloc = url.netloc
+		self.base_path = url.path.rstrip("/")
+		self.timeout = timeout
+		self.max_connections = max_connections
+		self.idle = collections.deque()	# (reader, writer) of idle connections
+		self.slots = None	# semaphore; made on first use, inside the loop
+
+	async def request(self, method, path, query=None, body=None, headers=None, timeout=None):
+		# Returns (HTTP status, response body as bytes)
+		if self.slots is None: self.slots = asyncio.Semaphore(self.max_connections)
+		target = self.base_path + path
+		if query: target += "?" + urllib.parse.urlencode(query)
+		body = body or b""
+		lines = ["{} {} HTTP/1.1".format(method, target),
+			"Host: " + self.netloc,
+			"Content-Length: {}".format(len(body))]
+		lines.extend("{}: {}".format(k, v) for k, v in (headers or {}).items())
+		data = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+		async with self.slots:
+			t0 = time.monotonic()
+			status, response, reused = await asyncio.wait_for(
+				self._roundtrip(method, data), timeout or self.timeout)
+		notifier.notify(__name__, 'mcc.http.request', (self.name, time.monotonic() - t0, reused))
+		return status, response
+
+	async def _roundtrip(self, method, data):
+		while True:
+			reused = bool(self.idle)
+			if reused:
+				reader, writer = self.idle.popleft()
+			else:
+				reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+			try:
+				writer.write(data)
+				await writer.drain()
+				status, response, keep_alive = await self._read_response(reader, method)
+			except (ConnectionError, asyncio.IncompleteReadError):
+				writer.close()
+				# The server may have closed an idle connection on us
+				if reused: continue
+				raise
+			except BaseException:
+				# Timed out or cancelled halfway; nothing to reuse
+				writer.close()
+				raise
+			if keep_alive: self.idle.append((reader, writer))
+			else: writer.close()
+			return status, response, reused
+
+	@staticmethod
+	async def _read_response(reader, method):
+		line = await reader.readline()
+		if not line: raise ConnectionResetError("Connection closed by server")
+		version, status = line.split(None, 2)[:2]
+		status = int(status)
+		headers = {}
+		while True:
+			line = await reader.readline()
+			if line in (b"\r\n", b"\n", b""): break
+			k, _, v = line.decode("latin-1").partition(":")
+			headers[k.strip().lower()] = v.strip()
+
+		keep_alive = version == b"HTTP/1.1" and headers.get("connection", "").lower() != "close"
+		if headers.get("transfer-encoding", "").lower() == "chunked":
+			parts = []
+			while True:
+				size = int((await reader.readline()).split(b";")[0], 16)
+				if size == 0: break
+				parts.append(await reader.readexactly(size))
+				await reader.readexactly(2)
+			# Skip trailers
+			while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass
+			response = b"".join(parts)
+		elif "content-length" in headers:
+			response = await reader.readexactly(int(headers["content-length"]))
+		elif method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+			response = b""
+		else:
+			response = await reader.read()
+			keep_alive = False
+		return status, response, keep_alive
+
+	def close(self):
+		while self.idle:
+			reader, writer = self.idle.popleft()
+			writer.close()
+
+
+class AsyncMatrixApi:
+	# The client-server API calls AsyncMXClient needs, as coroutines.
+	# Syncing has a connection of its own, so a long poll never holds up
+	# anything else.
+
+	def __init__(self, base_url, token=None, api_timeout=30, sync_timeout=100, max_connections=4):
+		self.base_url = base_url
+		self.token = token
+		self.http = HTTPClient(base_url, "api", api_timeout, max_connections)
+		self.sync_http = HTTPClient(base_url, "sync", sync_timeout, 1)
+		self.txn_id = 0
+
+	async def _send(self, method, path, content=None, query=None, http=None, timeout=None):
+		headers = {"Content-Type": "application/json", "User-Agent": "matrix-client-core"}
+		if self.token: headers["Authorization"] = "Bearer " + self.token
+		body = json.dumps(content).encode("utf-8") if content is not None else None
+		status, data = await (http or self.http).request(method, API_PATH + path, query, body, headers, timeout)
+		if not 200 <= status < 300:
+			raise matrix_client.errors.MatrixRequestError(code=status,
+				content=data.decode("utf-8", "replace"))
+		return json.loads(data.decode("utf-8"))
+
+	@staticmethod
+	def _quote(s):
+		return urllib.parse.quote(s, safe="")
+
+	async def login(self, user, password):
+		return await self._send("POST", "/login",
+			{"type": "m.login.password", "user": user, "password": password})
+
+	async def whoami(self):
+		return await self._send("GET", "/account/whoami")
+
+	async def sync(self, since=None, timeout_ms=30000, filter=None, timeout=None):
+		# 'timeout' (in seconds) overrides the sync connection's default
+		query = {"timeout": int(timeout_ms)}
+		if since: query["since"] = since
+		if filter: query["filter"] = filter
+		return await self._send("GET", "/sync", query=query, http=self.sync_http, timeout=timeout)
+
+	async def create_filter(self, user_id, filter_params):
+		return await self._send("POST", "/user/{}/filter".format(self._quote(user_id)), filter_params)
+
+	async def send_message_event(self, room_id, event_type, content):
+		self.txn_id += 1
+		txn_id = "{}.{}".format(int(time.time() * 1000), self.txn_id)
+		path = "/rooms/{}/send/{}/{}".format(self._quote(room_id), self._quote(event_type), txn_id)
+		return await self._send("PUT", path, content)
+
+	async def send_message(self, room_id, text, msgtype="m.text"):
+		return await self.send_message_event(room_id, "m.room.message", {"msgtype": msgtype, "body": text})
+
+	async def send_notice(self, room_id, text):
+		return await self.send_message(room_id, text, "m.notice")
+
+	async def send_emote(self, room_id, text):
+		return await self.send_message(room_id, text, "m.emote")
+
+	async def join_room(self, room_id_or_alias):
+		return await self._send("POST", "/join/{}".format(self._quote(room_id_or_alias)), {})
+
+	async def get_state_event(self, room_id, event_type, state_key=""):
+		path = "/rooms/{}/state/{}".format(self._quote(room_id), self._quote(event_type))
+		if state_key: path += "/" + self._quote(state_key)
+		return await self._send("GET", path)
+
+	async def get_membership(self, room_id, user_id):
+		return await self.get_state_event(room_id, "m.room.member", user_id)
+
+	async def get_power_levels(self, room_id):
+		return await self.get_state_event(room_id, "m.room.power_levels")
+
+	def close(self):
+		self.http.close()
+		self.sync_http.close()
+
+
+class AsyncSendScheduler(sendqueue.SendScheduler):
+	# A SendScheduler that can be waited on from the event loop, with aget()
+
+	def __init__(self, *args, **kwargs):
+		sendqueue.SendScheduler.__init__(self, *args, **kwargs)
+		self.wakeup = None	# asyncio.Event; made on first use, inside the loop
+
+	def _schedule(self, lane):
+		sendqueue.SendScheduler._schedule(self, lane)
+		if self.wakeup is not None: self.wakeup.set()
+
+	async def aget(self):
+		# Like get(), but waits without blocking the loop
+		if self.wakeup is None: self.wakeup = asyncio.Event()
+		while True:
+			with self.cond:
+				due = self._next_due()
+				if isinstance(due, tuple):
+					key, priority, enqueued, item = due
+					self.depth -= 1
+					depth = self.depth
+					break
+				self.wakeup.clear()
+			self._report_expired()
+			try:
+				await asyncio.wait_for(self.wakeup.wait(), due)
+			except asyncio.TimeoutError:
+				pass
+		self._report_expired()
+		notifier.notify(sendqueue.__name__, 'mcc.sendqueue.dequeue', (key, priority, time.monotonic() - enqueued, depth))
+		return key, item
+
+
+class AsyncMXClient(client_framework.MXClient):
+	# Use from a coroutine: await login() and first_sync(), then hook() to
+	# start syncing, start_sending() to start sending, and optionally
+	# await repl(). The SDK client is only used to keep track of rooms and
+	# call the listeners; it makes no requests of its own. Room state that
+	# isn't in the cache is not fetched on demand, as that would block
+	# the loop, and 'event_workers' is ignored.
+
+	def __init__(self, *args, **kwargs):
+		client_framework.MXClient.__init__(self, *args, **kwargs)
+		self.api = None
+		self.sendq = AsyncSendScheduler()
+		self.sync_loop_timeout_ms = 30000
+		self.room_locks = {}	# lane -> asyncio.Lock, to run coroutine handlers in order
+		self.tasks = set()
+
+	def _spawn(self, coro):
+		# Start a task, and hold on to it until it's done
+		task = asyncio.get_running_loop().create_task(coro)
+		self.tasks.add(task)
+		task.add_done_callback(self.tasks.discard)
+		return task
+
+	def on_exception(self, e, source=backoff.HANDLER):
+		# Everything calls this on the loop, so never sleep here. The sync
+		# loop does its own waiting.
+		self._report_exception(e)
+		notifier.notify(client_framework.__name__, 'mcc.mxc.exception', source)
+		if source not in backoff.RETRIED: return None
+		return self.backoff.failure(source)
+
+	@staticmethod
+	def _timed(handler):
+		if not asyncio.iscoroutinefunction(handler):
+			return client_framework.MXClient._timed(handler)
+		name = handler.__name__
+
+		@functools.wraps(handler)
+		async def wrapper(*args, **kwargs):
+			t0 = time.perf_counter()
+			try:
+				return await handler(*args, **kwargs)
+			finally:
+				notifier.notify(client_framework.__name__, 'mcc.mxc.handler.done', (name, time.perf_counter() - t0))
+
+		return wrapper
+
+	def _dispatched(self, handler):
+		# Coroutine handlers run as tasks, in order with the other events
+		# of the same room
+		if not asyncio.iscoroutinefunction(handler): return handler
+
+		@functools.wraps(handler)
+		def wrapper(event):
+			self._spawn(self._in_order(self._lane(event['room_id']), handler(event)))
+
+		return wrapper
+
+	async def _in_order(self, key, coro):
+		lock = self.room_locks.get(key)
+		if lock is None: lock = self.room_locks[key] = asyncio.Lock()
+		async with lock:
+			try:
+				await coro
+			except Exception as e:
+				self.on_exception(e)
+
+	@client_framework.wrap_exception
+	def _dispatch_sync_batch(self, response):
+		batch = self._sync_batch(response)
+		if not batch: return
+		result = self.on_sync_batch(batch)
+		if asyncio.iscoroutine(result): self._spawn(self._in_order(None, result))
+
+	def add_listeners(self):
+		self.event_workers = 0
+		client_framework.MXClient.add_listeners(self)
+
+	def hook(self):
+		# Connect all the listeners and start syncing
+		self.add_listeners()
+		self._spawn(self.sync_forever(self.sync_loop_timeout_ms))
+
+	async def login(self):
+		self._ensure_account()
+		t = self.account.login_type()
+		self.api = AsyncMatrixApi(self.account.hs_client_api_url,
+			api_timeout=self.api_timeout_seconds, sync_timeout=self.sync_timeout_seconds,
+			max_connections=self.send_concurrency + 1)
+		notifier.notify(client_framework.__name__, 'mcc.mxc.login.connect', (self.account.hs_client_api_url, self.account.mxid))
+		if t == self.account.T_PASSWORD:
+			notifier.notify(client_framework.__name__, 'mcc.mxc.login.login', (self.account.mxid))
+			response = await self.api.login(self.account.mxid, self.account.password)
+			self.account.access_token = response['access_token']
+			self.account.mxid = response['user_id']
+			self.account.savetofile(self.accountfilename)
+		elif t == self.account.T_TOKEN:
+			# Fail early on a bad token, as the SDK does
+			self.api.token = self.account.access_token
+			await self.api.whoami()
+		else:
+			raise client_framework.CFException("AsyncMXClient.login(): Cannot login: 'account' is (partially) uninitialized")
+		self.api.token = self.account.access_token
+
+		# Without a token, the SDK client doesn't talk to the server. Ours
+		# is set afterwards, so that room objects still work for those
+		# who don't mind blocking.
+		sync_filter = None if isinstance(self.sync_filter, dict) else self.sync_filter
+		self.sdkclient = client_framework.NoSyncMatrixClient(self.account.hs_client_api_url, sync_filter=sync_filter)
+		self.sdkclient.user_id = self.account.mxid
+		self.sdkclient.api.token = self.account.access_token
+		if isinstance(self.sync_filter, dict):
+			self.sdkclient.sync_filter = await self._upload_sync_filter()
+		if self.room_state is not None: self.room_state.api = None
+		self._add_response_listeners()
+
+	async def _upload_sync_filter(self):
+		canonical, filter_id = self._cached_sync_filter()
+		self.sync_filter_cached = bool(filter_id)
+		if filter_id: return filter_id
+		notifier.notify(client_framework.__name__, 'mcc.mxc.login.upload_filter', canonical)
+		response = await self.api.create_filter(self.account.mxid, self.sync_filter)
+		return self._remember_sync_filter(canonical, response['filter_id'])
+
+	async def _first_sync_request(self, since, timeout=None):
+		# Like _with_filter_retry()
+		try:
+			return await self.api.sync(since, 0, self.sdkclient.sync_filter, timeout=timeout)
+		except matrix_client.errors.MatrixRequestError as e:
+			if not self._forget_stale_filter(e): raise
+			self.sdkclient.sync_filter = await self._upload_sync_filter()
+			return await self.api.sync(since, 0, self.sdkclient.sync_filter, timeout=timeout)
+
+	async def first_sync(self):
+		notifier.notify(client_framework.__name__, 'mcc.mxc.first_sync.sync')
+		response = None
+		if self._load_sync_state():
+			# Resume where we left off. No need to long-poll for that.
+			try:
+				response = await self._first_sync_request(self.sdkclient.sync_token)
+			except matrix_client.errors.MatrixRequestError as e:
+				if not 400 <= e.code < 500: raise
+				notifier.notify(client_framework.__name__, 'mcc.mxc.first_sync.resume_failed', e.code)
+				self.sdkclient.sync_token = None
+				self.sdkclient.rooms.clear()
+		if response is None:
+			response = await self._first_sync_request(None, self.initial_sync_timeout_seconds)
+		self.sdkclient._process_response(response)
+		notifier.notify(client_framework.__name__, 'mcc.mxc.first_sync.sync_done')
+		self.rooms = client_framework.RoomList(self.sdkclient.get_rooms())
+		self.foreground_room = None
+		self._save_sync_state()
+
+	async def sync_forever(self, timeout_ms=30000):
+		while True:
+			t0 = time.monotonic()
+			try:
+				response = await self.api.sync(self.sdkclient.sync_token, timeout_ms, self.sdkclient.sync_filter)
+				self.sdkclient._process_response(response)
+			except Exception as e:
+				delay = self.on_exception(e, backoff.SYNC)
+				print("Waiting {0:.1f} seconds before trying again.".format(delay))
+				await asyncio.sleep(self.backoff.remaining(backoff.SYNC))
+				print("Let's go!")
+				continue
+			notifier.notify(client_framework.__name__, 'mcc.mxc.sync.done', time.monotonic() - t0)
+			for callback in self.sdkclient.sync_done_listeners: callback()
+
+	def start_sending(self, sendcmd=None, send_sleep_time=5, concurrency=None):
+		# Like start_send_thread(), with tasks. 'sendcmd' must be a
+		# coroutine function; the default sends an m.text message.
+		self.sendcmd = sendcmd or self.api.send_message
+		self.send_sleep_time = send_sleep_time
+		self.sendq.pacing = send_sleep_time
+		if concurrency is not None: self.send_concurrency = concurrency
+		for i in range(self.send_concurrency):
+			self._spawn(self.sendrunner())
+
+	async def sendrunner(self):
+		while True:
+			key, msg = await self.sendq.aget()
+			await self.send_one(key, key, msg)
+
+	async def send_one(self, key, room_id, msg):
+		t0 = time.monotonic()
+		try:
+			notifier.notify(client_framework.__name__, 'mcc.mxc.sendrunner.sendcmd', msg)
+			await self.sendcmd(room_id, msg)
+			notifier.notify(client_framework.__name__, 'mcc.mxc.sendrunner.sent', (room_id, time.monotonic() - t0))
+		except matrix_client.errors.MatrixRequestError as e:
+			self._record_send(room_id, e.code, t0)
+			retry_after = self._retry_after(e)
+			if retry_after is None: self._send_failed(key, e)
+			else: self.sendq.throttle(key, msg, retry_after)
+		except Exception as e:
+			self._record_send(room_id, type(e).__name__, t0)
+			self._send_failed(key, e)
+		else:
+			self._record_send(room_id, "ok", t0)
+			self.sendq.success()
+			self.backoff.success(backoff.SEND)
+		finally:
+			self.sendq.done(key)
+
+	def _room_title(self, room):
+		# Room.display_name may ask the server for the member list
+		return room.name or room.canonical_alias or room.room_id
+
+	def repl_open(self, txt):
+		""" Open a room you're already a member of """
+		try:
+			cmd, handle = txt.split(None, 1)
+		except ValueError:
+			print("Wrong number of arguments")
+			return True
+
+		room = self.rooms.get_room(handle)
+		if room is None:
+			print("You are not a member of that room. Did you want /join?")
+			return True
+
+		print("Opening room %s: %s" % (handle, self._room_title(room)))
+		print("Topic:", room.topic)
+		self.foreground_room = room
+
+		return True
+
+	async def repl_me(self, txt):
+		""" Send an action/emote """
+		if not self.foreground_room:
+			print("Cannot send message: You have not selected any room. Try /help.")
+			return True
+
+		await self.api.send_emote(self.foreground_room.room_id, txt[4:])
+		return True
+
+	async def repl_join(self, txt):
+		""" Join a room you're not already a member of """
+		try:
+			cmd, roomid = txt.split(None, 1)
+		except ValueError:
+			print("Wrong number of arguments")
+			return True
+
+		room_id = (await self.api.join_room(roomid))['room_id']
+		room = self.sdkclient.rooms.get(room_id) or self.sdkclient._mkroom(room_id)
+		self.foreground_room = room
+		print("Opening room %s: %s" % (roomid, self._room_title(room)))
+		print("Topic:", room.topic)
+		return True
+
+	async def repl_ops(self, txt):
+		""" Show priviledged users """
+		roomhandle = self.foreground_room
+		try:
+			if txt != "/ops": cmd, roomhandle = txt.split(None, 1)
+		except ValueError:
+			print("Too many arguments")
+			return True
+
+		if not roomhandle:
+			print("Not in a room, and no room specified.")
+			return True
+
+		room = self.rooms.get_room(roomhandle)
+		if room is None:
+			print("You are not a member of that room.")
+			return True
+
+		ops = None
+		if self.room_state is not None:
+			ops = self.room_state.power_levels(room.room_id, fetch=False)
+		if ops is None:
+			ops = await self.api.get_power_levels(room.room_id)
+		pprint.pprint(ops)
+
+		return True
+
+	async def repl(self, exception_handler=True, stdin=None):
+		# Read Eval Print Loop, reading from 'stdin' (a StreamReader)
+		# without blocking the loop. Returns at the end of input.
+
+		if exception_handler is True:
+			exception_handler = functools.partial(self.on_exception, source=backoff.REPL)
+		if stdin is None:
+			stdin = asyncio.StreamReader()
+			await asyncio.get_running_loop().connect_read_pipe(
+				lambda: asyncio.StreamReaderProtocol(stdin), sys.stdin)
+
+		while True:
+			try:
+				if not await self._repl_inner(stdin): break
+			except Exception as e:
+				if exception_handler is None: raise
+				exception_handler(e)
+
+	async def _repl_inner(self, stdin):
+		line = await stdin.readline()
+		if not line: return False
+		txt = line.decode("utf-8", "replace").rstrip("\r\n")
+		if txt.startswith('/'):
+			if txt.startswith('//'):
+				txt = txt[1:]
+			else:
+				cmd = txt.split(None, 1)[0].lstrip('/')
+				m = getattr(self, 'repl_' + cmd, None)
+				if callable(m):
+					result = m(txt)
+					if asyncio.iscoroutine(result): result = await result
+					if not result: return False
+				else:
+					print("Unrecognized command: {!r}. Try /help.".format(cmd))
+				return True
+
+		if not self.foreground_room:
+			print("Cannot send message: You have not selected any room. Try /help.")
+			return True
+
+		send_as_notice = getattr(self, 'is_bot', False)
+		if txt.startswith(' '):
+			txt = txt[1:]
+			send_as_notice = not send_as_notice
+
+		if send_as_notice:
+			await self.api.send_notice(self.foreground_room.room_id, txt)
+		else:
+			await self.api.send_message(self.foreground_room.room_id, txt)
+
+		return True
+
+	def close(self):
+		for task in list(self.tasks): task.cancel()
+		if self.api is not None: self.api.close()
+
+
+if __name__ == '__main__':
+	# Run an echo bot for a minute against a local mock homeserver
+	from matrix_client_core.mockserver import MockHomeserver
+
+	class EchoBot(AsyncMXClient):
+		async def on_global_timeline_event(self, event):
+			if event['sender'] == self.account.mxid: return
+			if event['type'] != 'm.room.message': return
+			print("{}: {}".format(event['sender'], event['content'].get('body')))
+			self.sendmsg(event['room_id'], "You said: " + event['content'].get('body', ""))
+
+	async def main():
+		hs = MockHomeserver()
+		url = hs.start()
+		user_id = hs.add_user("echo", access_token="echotoken")
+		other = hs.add_user("other")
+		room_id = hs.create_room(other, name="Echo room", members=[user_id])
+
+		account = client_framework.AccountInfo()
+		account.hs_client_api_url = url
+		account.mxid = user_id
+		account.access_token = "echotoken"
+		bot = EchoBot(account=account)
+		bot.renderer.sinks = []
+		await bot.login()
+		await bot.first_sync()
+		bot.hook()
+		bot.start_sending(send_sleep_time=0)
+		for i in range(3):
+			hs.put_event(room_id, other, "m.room.message", {"msgtype": "m.text", "body": "Hello {}".format(i)})
+			await asyncio.sleep(0.5)
+		print("Messages sent by the bot:", hs.sent)
+		bot.close()
+		hs.stop()
+
+	asyncio.run(main())
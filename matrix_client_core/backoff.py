@@ -0,0 +1,92 @@
+# stdlib
+import random
+import threading
+import time
+
+# in-tree deps
+import matrix_client_core.notifier as notifier
+
+# Failure sources MXClient keeps apart. Only syncs and sends are tried
+# again, so only they back off; failed handlers and REPL commands are
+# just reported and counted.
+SYNC = 'sync'
+HANDLER = 'handler'
+SEND = 'send'
+REPL = 'repl'
+RETRIED = (SYNC, SEND)
+
+
+class _Failures:
+	def __init__(self, now):
+		self.count = 0
+		self.since = now	# time of the first failure in this series
+		self.retry_at = now
+
+
+class Backoff:
+	# Exponential backoff with a cap and jitter, kept separately for each
+	# source of failures, so that e.g. failed sends don't slow down
+	# syncing.
+
+	# The n-th failure in a row asks for 'initial' * 'factor' ** (n - 1)
+	# seconds, at most 'maximum', minus up to 'jitter' (a fraction) of that
+	# at random, so that many clients failing at once don't all come back
+	# at once. Nothing here sleeps unless asked to with wait(); callers
+	# decide how to hold off until remaining() is 0.
+
+	def __init__(self, initial=5, maximum=300, factor=2, jitter=0.5,
+			clock=time.monotonic, random=random.random):
+		self.initial = initial
+		self.maximum = maximum
+		self.factor = factor
+		self.jitter = jitter
+		self.clock = clock
+		self.random = random
+		self.sources = {}	# source -> _Failures, only while failing
+		self.lock = threading.Lock()
+
+	def failure(self, source):
+		# Record a failure. Returns how many seconds to hold off.
+		now = self.clock()
+		with self.lock:
+			state = self.sources.get(source)
+			if state is None: state = self.sources[source] = _Failures(now)
+			delay = self._delay(state.count)
+			state.count += 1
+			delay *= 1 - self.jitter * self.random()
+			state.retry_at = now + delay
+			count = state.count
+		notifier.notify(__name__, 'mcc.backoff.failure', (source, count, delay))
+		return delay
+
+	def success(self, source):
+		# Record a success, which ends a series of failures
+		if source not in self.sources: return
+		with self.lock:
+			state = self.sources.pop(source, None)
+		if state is None: return
+		notifier.notify(__name__, 'mcc.backoff.recovered', (source, state.count, self.clock() - state.since))
+
+	def _delay(self, count):
+		return min(self.maximum, self.initial * self.factor ** count)
+
+	def next_delay(self, source):
+		# What the next failure will ask for, before jitter
+		return self._delay(self.failures(source))
+
+	def failures(self, source):
+		# Number of failures in a row so far
+		state = self.sources.get(source)
+		if state is None: return 0
+		return state.count
+
+	def remaining(self, source):
+		# Seconds left to hold off
+		state = self.sources.get(source)
+		if state is None: return 0
+		return max(0, state.retry_at - self.clock())
+
+	def wait(self, source):
+		# For threads that have nothing better to do in the meantime
+		delay = self.remaining(source)
+		if delay > 0: time.sleep(delay)
@@ -0,0 +1,70 @@
+# stdlib
+import collections
+import threading
+import time
+
+
+class SeenEvents:
+	# A bounded set of recently seen event IDs.
+
+	# Holds at most 'max_size' IDs, forgetting the least recently seen ones
+	# first, and, if 'max_age' is given, forgets IDs not seen for that many
+	# seconds.
+
+	def __init__(self, max_size=10000, max_age=None, clock=time.monotonic):
+		self.max_size = max_size
+		self.max_age = max_age
+		self.clock = clock
+		self.ids = collections.OrderedDict()	# event ID -> time last seen
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def stats(self):
+		return (self.hits, self.misses, self.evictions)
+
+	def hit_rate(self):
+		total = self.hits + self.misses
+		if not total: return 0.0
+		return self.hits / total
+
+	def check(self, event_id):
+		# Record 'event_id' as seen. Returns True if it had been seen before.
+		now = self.clock()
+		with self.lock:
+			seen = event_id in self.ids
+			if seen:
+				self.hits += 1
+				self.ids.move_to_end(event_id)
+			else:
+				self.misses += 1
+			self.ids[event_id] = now
+			self._expire(now)
+		return seen
+
+	def _expire(self, now):
+		while len(self.ids) > self.max_size:
+			self.ids.popitem(last=False)
+			self.evictions += 1
+		if self.max_age is None: return
+		while self.ids:
+			event_id, t = next(iter(self.ids.items()))
+			if now - t <= self.max_age: break
+			del self.ids[event_id]
+			self.evictions += 1
+
+	def recent(self, n=None):
+		# The 'n' most recently seen IDs, oldest first (for saving)
+		with self.lock:
+			ids = list(self.ids)
+		if n is None: return ids
+		return ids[-n:]
+
+	def load(self, ids):
+		# Mark 'ids' as seen, without counting them as hits or misses
+		now = self.clock()
+		with self.lock:
+			for event_id in ids:
+				self.ids[event_id] = now
+			self._expire(now)
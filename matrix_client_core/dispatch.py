@@ -0,0 +1,80 @@
+# stdlib
+import collections
+import threading
+import time
+import traceback
+
+# in-tree deps
+import matrix_client_core.notifier as notifier
+
+
+class OrderedDispatcher:
+	# Runs calls on a pool of worker threads.
+
+	# Calls submitted with the same key (room ID) run one at a time, in the
+	# order they were submitted. Calls with different keys run in parallel.
+	# At most 'max_backlog' calls can be waiting; submit() blocks after that,
+	# which in turn slows down whoever is producing them (the sync thread).
+
+	def __init__(self, workers=4, max_backlog=1000):
+		self.workers = workers
+		self.max_backlog = max_backlog
+		self.lanes = {}		# key -> deque of calls; present while busy or queued
+		self.ready = collections.deque()	# keys with queued calls and no call running
+		self.backlog = 0
+		self.cond = threading.Condition()
+		self.threads = []
+
+	def start(self):
+		for i in range(self.workers):
+			t = threading.Thread(target=self._runner)
+			t.daemon = True
+			t.start()
+			self.threads.append(t)
+
+	def submit(self, key, func, *args):
+		with self.cond:
+			while self.backlog >= self.max_backlog:
+				self.cond.wait()
+			lane = self.lanes.get(key)
+			if lane is None:
+				lane = self.lanes[key] = collections.deque()
+				self.ready.append(key)
+			lane.append((time.monotonic(), func, args))
+			self.backlog += 1
+			self.cond.notify_all()
+
+	def try_submit(self, key, func, *args):
+		# Like submit(), but never blocks: returns False instead of
+		# waiting for room in the backlog. For work that may be skipped.
+		with self.cond:
+			if self.backlog >= self.max_backlog: return False
+			self.submit(key, func, *args)
+		return True
+
+	def qsize(self):
+		return self.backlog
+
+	def _runner(self):
+		while True:
+			with self.cond:
+				while not self.ready:
+					self.cond.wait()
+				key = self.ready.popleft()
+				submitted, func, args = self.lanes[key].popleft()
+
+			t0 = time.monotonic()
+			try:
+				func(*args)
+			except Exception:
+				traceback.print_exc()
+			t1 = time.monotonic()
+
+			with self.cond:
+				if self.lanes[key]: self.ready.append(key)
+				else: del self.lanes[key]
+				self.backlog -= 1
+				backlog = self.backlog
+				self.cond.notify_all()
+
+			notifier.notify(__name__, 'mcc.dispatch.done', (key, t0 - submitted, t1 - t0, backlog))
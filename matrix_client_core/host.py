@@ -0,0 +1,181 @@
+# stdlib
+import heapq
+import itertools
+import threading
+import time
+
+# in-tree deps
+import matrix_client_core.backoff as backoff
+import matrix_client_core.dispatch as dispatch
+import matrix_client_core.httpsession as httpsession
+import matrix_client_core.notifier as notifier
+import matrix_client_core.sendqueue as sendqueue
+
+
+class BotHost:
+	# Runs many MXClients in one process, on a fixed number of threads no
+	# matter how many clients there are. 'sync_workers' threads take turns
+	# syncing the clients, 'event_workers' threads run the event handlers of
+	# all clients, and 'send_workers' threads send their messages, from one
+	# shared SendScheduler. Their room state caches prefetch on the event
+	# workers, or on one thread of their own if there are none. Clients on
+	# the same homeserver share two pools of keep-alive connections: one
+	# for syncing, one for everything else.
+
+	# A long-polling sync ties up its thread until it returns. With no more
+	# clients than 'sync_workers', each client always has one in flight,
+	# of up to 'sync_timeout_ms'. With more, clients take turns, and each
+	# poll is cut short so that a client waits at most 'sync_latency_ms'
+	# for its next one: events may show up that much later than they would
+	# on a client of its own, and the server gets polled more often the
+	# more clients there are per worker. Add sync workers to make up for
+	# it. Each client's handlers work exactly as they would on their own;
+	# only use add() and start() instead of login(), first_sync() and hook().
+
+	def __init__(self, sync_workers=4, event_workers=4, send_workers=4,
+			event_backlog=1000, sync_timeout_ms=30000, sync_latency_ms=2000, send_pacing=0,
+			api_timeout_seconds=30):
+		self.sync_workers = sync_workers
+		self.event_workers = event_workers
+		self.send_workers = send_workers
+		self.sync_timeout_ms = sync_timeout_ms
+		self.sync_latency_ms = sync_latency_ms
+		self.api_timeout_seconds = api_timeout_seconds
+		self.clients = []
+		self.sessions = {}	# (homeserver URL, "api" or "sync") -> httpsession.TimeoutSession
+		self.dispatcher = None
+		if event_workers > 0:
+			self.dispatcher = dispatch.OrderedDispatcher(event_workers, event_backlog)
+		self.prefetcher = self.dispatcher or dispatch.OrderedDispatcher(1, event_backlog)
+		self.sendq = sendqueue.SendScheduler(send_pacing)
+		self.due = []		# heap of (time, seq, client, job) for clients waiting to start or sync
+		self.seq = itertools.count()
+		self.cond = threading.Condition()
+		self.running = False
+		self.threads = []
+
+	def session(self, url, kind="api"):
+		# The shared HTTP session of a kind for a homeserver. Each comes
+		# with enough connections for every thread that might use it.
+		with self.cond:
+			session = self.sessions.get((url, kind))
+			if session is None:
+				if kind == "sync":
+					session = httpsession.TimeoutSession(kind,
+						self.sync_timeout_ms / 1000 + self.api_timeout_seconds, self.sync_workers)
+				else:
+					session = httpsession.TimeoutSession(kind,
+						self.api_timeout_seconds, self.event_workers + self.send_workers + 1)
+				self.sessions[(url, kind)] = session
+			return session
+
+	def add(self, client):
+		# Take charge of a client that hasn't logged in yet. Set its
+		# 'sendcmd' beforehand to send with something other than
+		# send_message().
+		client.host = self
+		client.sendq = self.sendq
+		client.dispatcher = self.dispatcher
+		if client.room_state is not None: client.room_state.executor = self.prefetcher
+		self.clients.append(client)
+		if self.running: self._schedule(client, 0, self._start_one)
+
+	def start(self):
+		# Start the threads, which then log in the clients, each on its
+		# own, retrying with backoff if it fails. Returns right away.
+		self.running = True
+		self.prefetcher.start()
+		for target, n in ((self._send_runner, self.send_workers), (self._sync_runner, self.sync_workers)):
+			for i in range(n):
+				t = threading.Thread(target=target)
+				t.daemon = True
+				t.start()
+				self.threads.append(t)
+		for client in self.clients:
+			self._schedule(client, 0, self._start_one)
+
+	def stop(self):
+		# Stop syncing. Queued messages are still sent.
+		with self.cond:
+			self.running = False
+			self.cond.notify_all()
+
+	def run_forever(self):
+		self.start()
+		while self.running:
+			time.sleep(1)
+
+	def _start_client(self, client):
+		client._ensure_account()
+		client.http_session = self.session(client.account.hs_client_api_url, "api")
+		client.sync_session = self.session(client.account.hs_client_api_url, "sync")
+		client.login()
+		client.first_sync()
+		client.add_listeners()
+		if client.sendcmd is None: client.sendcmd = client.send_api.send_message
+		notifier.notify(__name__, 'mcc.host.client_started', client.account.mxid)
+
+	def _schedule(self, client, delay, job):
+		with self.cond:
+			heapq.heappush(self.due, (time.monotonic() + delay, next(self.seq), client, job))
+			self.cond.notify()
+
+	def _next_client(self):
+		# Wait for a client to be due for its next job. None = stop.
+		with self.cond:
+			while self.running:
+				if not self.due:
+					self.cond.wait()
+					continue
+				delay = self.due[0][0] - time.monotonic()
+				if delay > 0:
+					self.cond.wait(delay)
+					continue
+				return heapq.heappop(self.due)[2:]
+		return None
+
+	def poll_timeout_ms(self):
+		# How long each sync may long-poll, so that no client waits more
+		# than 'sync_latency_ms' for its turn
+		turns = -(-len(self.clients) // max(1, self.sync_workers))
+		if turns <= 1: return self.sync_timeout_ms
+		return min(self.sync_timeout_ms, self.sync_latency_ms // turns)
+
+	def _sync_runner(self):
+		while True:
+			due = self._next_client()
+			if due is None: return
+			client, job = due
+			job(client)
+
+	def _start_one(self, client):
+		try:
+			self._start_client(client)
+		except Exception as e:
+			# A client that can't log in doesn't hold up the others
+			client._report_exception(e)
+			delay = client.backoff.failure(backoff.SYNC)
+			notifier.notify(__name__, 'mcc.host.start_failed',
+				(getattr(client.account, 'mxid', None), delay))
+			self._schedule(client, delay, self._start_one)
+			return
+		client.backoff.success(backoff.SYNC)
+		self._schedule(client, 0, self._sync_one)
+
+	def _sync_one(self, client):
+		try:
+			client.sdkclient._sync(timeout_ms=self.poll_timeout_ms())
+		except Exception as e:
+			# Like on_exception(), but don't hold up the other clients
+			client._report_exception(e)
+			delay = client.backoff.failure(backoff.SYNC)
+			notifier.notify(__name__, 'mcc.host.sync_failed', (client.account.mxid, delay))
+		else:
+			delay = 0
+		self._schedule(client, delay, self._sync_one)
+
+	def _send_runner(self):
+		while True:
+			key, msg = self.sendq.get()
+			client, room_id = key
+			client.send_one(key, room_id, msg)
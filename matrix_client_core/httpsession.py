@@ -0,0 +1,67 @@
+# stdlib
+import contextlib
+import threading
+import time
+
+# external deps
+import requests
+
+# in-tree deps
+import matrix_client_core.notifier as notifier
+
+
+class TimeoutSession(requests.Session):
+	# A requests.Session with a default timeout for every request, and a
+	# pool of up to 'pool_maxsize' keep-alive connections per host.
+
+	# Reports each request as mcc.http.request, with whether it could
+	# reuse a pooled connection or had to open a new one.
+
+	def __init__(self, name, timeout=None, pool_maxsize=10):
+		requests.Session.__init__(self)
+		self.name = name
+		self.timeout = timeout
+		self.local = threading.local()
+		self.adapter = None
+		# Only real requests can be told how many connections to keep
+		adapters = getattr(requests, 'adapters', None)
+		if adapters is not None:
+			self.adapter = adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+			self.mount("http://", self.adapter)
+			self.mount("https://", self.adapter)
+
+	@contextlib.contextmanager
+	def timeout_override(self, timeout):
+		# Use a different default timeout in this thread for a while
+		saved = getattr(self.local, 'timeout', None)
+		self.local.timeout = timeout
+		try:
+			yield
+		finally:
+			self.local.timeout = saved
+
+	def connections_opened(self):
+		# How many connections this session has opened so far
+		if self.adapter is None: return 0
+		pools = self.adapter.poolmanager.pools
+		total = 0
+		for key in pools.keys():
+			try:
+				total += pools[key].num_connections
+			except KeyError:
+				pass	# just evicted
+		return total
+
+	def request(self, method, url, *args, **kwargs):
+		timeout = getattr(self.local, 'timeout', None)
+		kwargs.setdefault('timeout', self.timeout if timeout is None else timeout)
+		before = self.connections_opened()
+		t0 = time.monotonic()
+		try:
+			return requests.Session.request(self, method, url, *args, **kwargs)
+		finally:
+			# A best guess: another thread may have opened a connection in
+			# the meantime
+			reused = self.connections_opened() == before
+			notifier.notify(__name__, 'mcc.http.request',
+				(self.name, time.monotonic() - t0, reused))
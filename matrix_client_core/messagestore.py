@@ -0,0 +1,126 @@
+# stdlib
+import collections
+import sqlite3
+import sys
+import threading
+
+
+class Message:
+	# The parts of a timeline event worth keeping around. A lot smaller
+	# than the event dict it came from.
+
+	__slots__ = ('event_id', 'room_id', 'sender', 'type', 'msgtype', 'body', 'ts')
+
+	FIELDS = __slots__
+
+	def __init__(self, event_id, room_id, sender, type, msgtype=None, body=None, ts=0):
+		self.event_id = event_id
+		self.room_id = room_id
+		self.sender = sender
+		self.type = type
+		self.msgtype = msgtype
+		self.body = body
+		self.ts = ts
+
+	@classmethod
+	def from_event(cls, event, room_id=None):
+		content = event.get('content', {})
+		body = content.get('body')
+		return cls(event['event_id'],
+			# Shared by many messages, so keep just one copy of each
+			sys.intern(room_id or event['room_id']),
+			sys.intern(event['sender']),
+			sys.intern(event['type']),
+			sys.intern(content['msgtype']) if 'msgtype' in content else None,
+			body if isinstance(body, str) else None,
+			event.get('origin_server_ts', 0))
+
+	def astuple(self):
+		return tuple(getattr(self, f) for f in self.FIELDS)
+
+	def __repr__(self):
+		return "Message({})".format(", ".join(map(repr, self.astuple())))
+
+
+class MessageStore:
+	# The last 'per_room' messages of each room, findable by event ID.
+
+	# Messages pushed out of a room's buffer are forgotten, unless
+	# 'spill_filename' is given, in which case they go to an SQLite
+	# database there, where get() can still find them.
+
+	SPILL_BATCH = 100
+
+	def __init__(self, per_room=100, spill_filename=None):
+		if per_room < 1: raise ValueError("per_room must be at least 1, not {!r}".format(per_room))
+		self.per_room = per_room
+		self.rooms = {}		# room ID -> deque of Messages, oldest first
+		self.by_id = {}		# event ID -> Message
+		self.lock = threading.Lock()
+		self.spilled = []	# Messages waiting to be written to the database
+		self.db = None
+		if spill_filename is not None:
+			self.db = sqlite3.connect(spill_filename, check_same_thread=False)
+			self.db.execute("CREATE TABLE IF NOT EXISTS messages ("
+				"event_id TEXT PRIMARY KEY, room_id TEXT, sender TEXT, type TEXT, "
+				"msgtype TEXT, body TEXT, ts INTEGER)")
+			self.db.commit()
+
+	def __len__(self):
+		return len(self.by_id)
+
+	def add(self, event, room_id=None):
+		# Store a timeline event. Returns the Message, or None if the event
+		# was already there.
+		message = Message.from_event(event, room_id)
+		with self.lock:
+			if message.event_id in self.by_id: return None
+			ring = self.rooms.get(message.room_id)
+			if ring is None: ring = self.rooms[message.room_id] = collections.deque()
+			if len(ring) >= self.per_room:
+				old = ring.popleft()
+				del self.by_id[old.event_id]
+				if self.db is not None:
+					self.spilled.append(old)
+					if len(self.spilled) >= self.SPILL_BATCH: self._flush()
+			ring.append(message)
+			self.by_id[message.event_id] = message
+		return message
+
+	def add_sync_response(self, response):
+		# Sync response listener: store the timeline events of every room
+		for room_id, sync_room in response.get('rooms', {}).get('join', {}).items():
+			for event in sync_room.get('timeline', {}).get('events', ()):
+				if 'event_id' in event: self.add(event, room_id)
+
+	def get(self, event_id):
+		with self.lock:
+			message = self.by_id.get(event_id)
+			if message is not None or self.db is None: return message
+			self._flush()
+			row = self.db.execute("SELECT {} FROM messages WHERE event_id = ?".format(
+				", ".join(Message.FIELDS)), (event_id,)).fetchone()
+		if row is None: return None
+		return Message(*row)
+
+	def recent(self, room_id, n=None):
+		# The last 'n' messages in a room, oldest first
+		with self.lock:
+			ring = self.rooms.get(room_id, ())
+			if n is None or n >= len(ring): return list(ring)
+			return list(ring)[-n:]
+
+	def _flush(self):
+		# Call with self.lock held
+		if not self.spilled: return
+		self.db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+			[m.astuple() for m in self.spilled])
+		self.db.commit()
+		self.spilled = []
+
+	def close(self):
+		with self.lock:
+			if self.db is None: return
+			self._flush()
+			self.db.close()
+			self.db = None
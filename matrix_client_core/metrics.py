@@ -0,0 +1,262 @@
+# stdlib
+import bisect
+import http.server
+import os
+import threading
+import time
+
+# in-tree deps
+import matrix_client_core.notifier as notifier
+import matrix_client_core.sendqueue as sendqueue
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(names, values):
+	if not names: return ""
+	return "{" + ",".join('{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+				for n, v in zip(names, values)) + "}"
+
+
+class Metric:
+	TYPE = None
+
+	def __init__(self, name, help, labelnames=()):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+		self.values = {}	# label values tuple -> value
+		self.lock = threading.Lock()
+
+	def render(self):
+		lines = ["# HELP {} {}".format(self.name, self.help),
+			"# TYPE {} {}".format(self.name, self.TYPE)]
+		with self.lock:
+			items = sorted(self.values.items())
+		for labels, value in items:
+			lines.extend(self._render_value(labels, value))
+		return lines
+
+	def _render_value(self, labels, value):
+		return ["{}{} {}".format(self.name, _format_labels(self.labelnames, labels), value)]
+
+
+class Counter(Metric):
+	TYPE = "counter"
+
+	def inc(self, amount=1, *labels):
+		with self.lock:
+			self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+	TYPE = "gauge"
+
+	def set(self, value, *labels):
+		with self.lock:
+			self.values[labels] = value
+
+
+class Histogram(Metric):
+	TYPE = "histogram"
+
+	def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+		Metric.__init__(self, name, help, labelnames)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, value, *labels):
+		with self.lock:
+			v = self.values.get(labels)
+			if v is None:
+				v = self.values[labels] = [[0] * len(self.buckets), 0, 0]
+			i = bisect.bisect_left(self.buckets, value)
+			if i < len(self.buckets): v[0][i] += 1
+			v[1] += value
+			v[2] += 1
+
+	def _render_value(self, labels, value):
+		counts, total, count = value
+		lines = []
+		names = self.labelnames + ("le",)
+		cumulative = 0
+		for bound, n in zip(self.buckets, counts):
+			cumulative += n
+			lines.append("{}_bucket{} {}".format(self.name, _format_labels(names, labels + (bound,)), cumulative))
+		lines.append("{}_bucket{} {}".format(self.name, _format_labels(names, labels + ("+Inf",)), count))
+		lines.append("{}_sum{} {}".format(self.name, _format_labels(self.labelnames, labels), total))
+		lines.append("{}_count{} {}".format(self.name, _format_labels(self.labelnames, labels), count))
+		return lines
+
+
+class MetricsCollector(notifier.BaseNotificationListener):
+	# Turns notifier events into Prometheus metrics.
+
+	# Use render() to get the metrics in the Prometheus text format, or
+	# have them served with start_http_server() or written periodically by
+	# something calling write_textfile() (for node_exporter's textfile
+	# collector).
+
+	def __init__(self, autoconnect=True):
+		self.metrics = []
+		self.first_sync_seconds = self._add(Gauge("mcc_first_sync_seconds",
+			"Duration of the initial sync"))
+		self.sync_seconds = self._add(Histogram("mcc_sync_seconds",
+			"Duration of sync round-trips, including processing"))
+		self.messages_queued = self._add(Counter("mcc_messages_queued_total",
+			"Messages handed to sendmsg()"))
+		self.messages_sent = self._add(Counter("mcc_messages_sent_total",
+			"Messages sent successfully"))
+		self.send_seconds = self._add(Histogram("mcc_send_seconds",
+			"Duration of a single sendcmd() call"))
+		self.send_queue_depth = self._add(Gauge("mcc_send_queue_depth",
+			"Messages waiting in the send queue"))
+		self.send_queue_wait_seconds = self._add(Histogram("mcc_send_queue_wait_seconds",
+			"Time messages spent in the send queue, by priority", ("priority",)))
+		self.send_expired = self._add(Counter("mcc_send_expired_total",
+			"Messages dropped from the send queue because their time to live ran out",
+			("priority",)))
+		self.send_throttled = self._add(Counter("mcc_send_throttled_total",
+			"Messages refused by the server because of rate limiting"))
+		self.send_rate = self._add(Gauge("mcc_send_rate_limit",
+			"Current maximum send rate in messages/s (0 = unlimited)"))
+		self.handler_seconds = self._add(Histogram("mcc_handler_seconds",
+			"Time spent in event handlers", ("handler",)))
+		self.dispatch_backlog = self._add(Gauge("mcc_dispatch_backlog",
+			"Events waiting for a handler worker"))
+		self.dispatch_wait_seconds = self._add(Histogram("mcc_dispatch_wait_seconds",
+			"Time events waited for a handler worker"))
+		self.duplicate_events = self._add(Counter("mcc_duplicate_events_total",
+			"Timeline events dropped because they had been seen before"))
+		self.ratelimit_decisions = self._add(Counter("mcc_ratelimit_decisions_total",
+			"Rate limiter checks", ("result",)))
+		self.room_state_fetch_seconds = self._add(Histogram("mcc_room_state_fetch_seconds",
+			"Duration of room state fetched on demand"))
+		self.http_requests = self._add(Counter("mcc_http_requests_total",
+			"HTTP requests, by session and whether a pooled connection was reused",
+			("session", "connection")))
+		self.http_request_seconds = self._add(Histogram("mcc_http_request_seconds",
+			"Duration of HTTP requests until the response headers arrived", ("session",)))
+		self.exceptions = self._add(Counter("mcc_exceptions_total",
+			"Exceptions caught, by source (sync, handler, send, repl)", ("source",)))
+		self.backoff_failures = self._add(Gauge("mcc_backoff_failures",
+			"Failures in a row, by source (sync, send)", ("source",)))
+		self.backoff_delay_seconds = self._add(Gauge("mcc_backoff_delay_seconds",
+			"Current backoff delay, by source", ("source",)))
+		self.backoff_recovery_seconds = self._add(Histogram("mcc_backoff_recovery_seconds",
+			"Time from the first failure to the next success, by source", ("source",)))
+		self.first_sync_start = None
+		notifier.BaseNotificationListener.__init__(self, autoconnect)
+
+	def _add(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def render(self):
+		lines = []
+		for metric in self.metrics:
+			lines.extend(metric.render())
+		return "\n".join(lines) + "\n"
+
+	def write_textfile(self, filename):
+		tmpfilename = filename + ".tmp"
+		with open(tmpfilename, "w") as f:
+			f.write(self.render())
+		os.replace(tmpfilename, filename)
+
+	def start_http_server(self, port, addr="127.0.0.1"):
+		collector = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = collector.render().encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		self.httpd = http.server.ThreadingHTTPServer((addr, port), Handler)
+		self.http_thread = threading.Thread(target=self.httpd.serve_forever)
+		self.http_thread.daemon = True
+		self.http_thread.start()
+		return self.httpd.server_address
+
+	def on_mcc_mxc_first_sync_sync(self, service, event, data):
+		self.first_sync_start = time.monotonic()
+
+	def on_mcc_mxc_first_sync_sync_done(self, service, event, data):
+		if self.first_sync_start is None: return
+		self.first_sync_seconds.set(time.monotonic() - self.first_sync_start)
+
+	def on_mcc_mxc_sync_done(self, service, event, data):
+		self.sync_seconds.observe(data)
+
+	def on_mcc_mxc_sendmsg(self, service, event, data):
+		self.messages_queued.inc()
+
+	def on_mcc_mxc_sendrunner_sent(self, service, event, data):
+		room_id, seconds = data
+		self.messages_sent.inc()
+		self.send_seconds.observe(seconds)
+
+	def on_mcc_sendqueue_enqueue(self, service, event, data):
+		key, depth = data
+		self.send_queue_depth.set(depth)
+
+	def on_mcc_sendqueue_dequeue(self, service, event, data):
+		key, priority, wait, depth = data
+		self.send_queue_depth.set(depth)
+		self.send_queue_wait_seconds.observe(wait, sendqueue.PRIORITY_NAMES[priority])
+
+	def on_mcc_sendqueue_expired(self, service, event, data):
+		key, priority, age, depth = data
+		self.send_queue_depth.set(depth)
+		self.send_expired.inc(1, sendqueue.PRIORITY_NAMES[priority])
+
+	def on_mcc_sendqueue_throttled(self, service, event, data):
+		self.send_throttled.inc()
+
+	def on_mcc_sendqueue_rate(self, service, event, data):
+		interval, rate = data
+		self.send_rate.set(rate or 0)
+
+	def on_mcc_mxc_handler_done(self, service, event, data):
+		name, seconds = data
+		self.handler_seconds.observe(seconds, name)
+
+	def on_mcc_dispatch_done(self, service, event, data):
+		key, wait, seconds, backlog = data
+		self.dispatch_backlog.set(backlog)
+		self.dispatch_wait_seconds.observe(wait)
+
+	def on_mcc_mxc_duplicate_event(self, service, event, data):
+		self.duplicate_events.inc()
+
+	def on_mcc_ratelimit_ok(self, service, event, data):
+		self.ratelimit_decisions.inc(1, "ok" if data[0] else "limited")
+
+	def on_mcc_roomstate_fetch(self, service, event, data):
+		key, seconds = data
+		self.room_state_fetch_seconds.observe(seconds)
+
+	def on_mcc_http_request(self, service, event, data):
+		session, seconds, reused = data
+		self.http_requests.inc(1, session, "reused" if reused else "new")
+		self.http_request_seconds.observe(seconds, session)
+
+	def on_mcc_mxc_exception(self, service, event, data):
+		self.exceptions.inc(1, data)
+
+	def on_mcc_backoff_failure(self, service, event, data):
+		source, count, delay = data
+		self.backoff_failures.set(count, source)
+		self.backoff_delay_seconds.set(delay, source)
+
+	def on_mcc_backoff_recovered(self, service, event, data):
+		source, count, seconds = data
+		self.backoff_failures.set(0, source)
+		self.backoff_delay_seconds.set(0, source)
+		self.backoff_recovery_seconds.observe(seconds, source)
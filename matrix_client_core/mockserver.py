@@ -0,0 +1,367 @@
+# A local stand-in for a Matrix homeserver.
+
+# It implements just enough of the client-server API (login, whoami, /sync
+# with filters, sending, joining and leaving, room state) to drive MXClient and the SDK
+# in tests and benchmarks, without network access or a real account.
+
+# stdlib
+import http.server
+import itertools
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+API_PREFIXES = ("/_matrix/client/r0", "/_matrix/client/v3")
+
+
+class MockRoom:
+	def __init__(self, room_id):
+		self.room_id = room_id
+		self.state = {}		# (type, state_key) -> event
+		self.timeline = []	# (stream position, event)
+		self.joined = {}	# user ID -> stream position at which they joined
+		self.left = {}		# user ID -> stream position at which they left
+
+
+class MatrixError(Exception):
+	def __init__(self, code, errcode, error, **extra):
+		Exception.__init__(self, error)
+		self.code = code
+		self.body = dict(errcode=errcode, error=error, **extra)
+
+
+def _type_matches(patterns, event_type):
+	# Filter 'types' semantics: None matches everything, "*" is a wildcard
+	if patterns is None: return True
+	for p in patterns:
+		if p == event_type: return True
+		if p.endswith("*") and event_type.startswith(p[:-1]): return True
+	return False
+
+
+class MockHomeserver:
+	def __init__(self, addr="127.0.0.1", port=0, server_name="localhost"):
+		self.server_name = server_name
+		self.users = {}		# user ID -> password
+		self.tokens = {}	# access token -> user ID
+		self.filters = {}	# (user ID, filter ID) -> filter dict
+		self.rooms = {}		# room ID -> MockRoom
+		self.aliases = {}	# alias -> room ID
+		self.position = 0	# stream position of the last event
+		self.cond = threading.Condition()
+		self.ids = itertools.count(1)
+		self.send_interval = 0	# minimum seconds between sends per user, else 429
+		self.last_send = {}	# user ID -> time of last send
+		self.requests = {}	# endpoint name -> number of requests
+		self.sent = 0		# number of events sent by clients
+		self.httpd = http.server.ThreadingHTTPServer((addr, port), self._make_handler())
+		self.httpd.daemon_threads = True
+		self.thread = None
+
+	@property
+	def url(self):
+		host, port = self.httpd.server_address[:2]
+		return "http://{}:{}".format(host, port)
+
+	def start(self):
+		self.thread = threading.Thread(target=self.httpd.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		return self.url
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+	# -- Setting up fixtures --
+
+	def add_user(self, localpart, password="password", access_token=None):
+		user_id = "@{}:{}".format(localpart, self.server_name)
+		self.users[user_id] = password
+		if access_token is not None: self.tokens[access_token] = user_id
+		return user_id
+
+	def create_room(self, creator, name=None, topic=None, aliases=(), members=()):
+		room_id = "!room{}:{}".format(next(self.ids), self.server_name)
+		with self.cond:
+			self.rooms[room_id] = MockRoom(room_id)
+		self.join(room_id, creator)
+		for user_id in members: self.join(room_id, user_id)
+		self.put_state(room_id, creator, "m.room.power_levels", "", {"users": {creator: 100}, "users_default": 0})
+		if name is not None: self.put_state(room_id, creator, "m.room.name", "", {"name": name})
+		if topic is not None: self.put_state(room_id, creator, "m.room.topic", "", {"topic": topic})
+		if aliases: self.set_aliases(room_id, creator, aliases)
+		return room_id
+
+	def set_aliases(self, room_id, sender, aliases, canonical_alias=None):
+		aliases = list(aliases)
+		with self.cond:
+			for alias in aliases: self.aliases[alias] = room_id
+		self.put_state(room_id, sender, "m.room.aliases", self.server_name, {"aliases": aliases})
+		if canonical_alias is None and aliases: canonical_alias = aliases[0]
+		if canonical_alias is not None:
+			self.put_state(room_id, sender, "m.room.canonical_alias", "", {"alias": canonical_alias})
+
+	def join(self, room_id, user_id):
+		room = self.rooms[room_id]
+		if user_id in room.joined: return
+		displayname = user_id[1:].split(":")[0]
+		self.put_state(room_id, user_id, "m.room.member", user_id, {"membership": "join", "displayname": displayname})
+		with self.cond:
+			room.joined[user_id] = self.position
+			room.left.pop(user_id, None)
+
+	def leave(self, room_id, user_id):
+		room = self.rooms[room_id]
+		if user_id not in room.joined: return
+		self.put_state(room_id, user_id, "m.room.member", user_id, {"membership": "leave"})
+		with self.cond:
+			del room.joined[user_id]
+			room.left[user_id] = self.position
+
+	def put_state(self, room_id, sender, event_type, state_key, content):
+		return self.put_event(room_id, sender, event_type, content, state_key)
+
+	def put_event(self, room_id, sender, event_type, content, state_key=None):
+		with self.cond:
+			room = self.rooms[room_id]
+			self.position += 1
+			event = {
+				"event_id": "${}:{}".format(next(self.ids), self.server_name),
+				"type": event_type,
+				"sender": sender,
+				"content": content,
+				"origin_server_ts": int(time.time() * 1000),
+				"unsigned": {}	}
+			if state_key is not None:
+				event["state_key"] = state_key
+				prev = room.state.get((event_type, state_key))
+				if prev is not None: event["unsigned"]["prev_content"] = prev["content"]
+				room.state[(event_type, state_key)] = event
+			room.timeline.append((self.position, event))
+			self.cond.notify_all()
+		return event["event_id"]
+
+	# -- Request handling --
+
+	def _count(self, name):
+		with self.cond:
+			self.requests[name] = self.requests.get(name, 0) + 1
+
+	def _auth(self, headers, query):
+		token = query.get("access_token")
+		auth = headers.get("Authorization", "")
+		if auth.startswith("Bearer "): token = auth[7:]
+		user_id = self.tokens.get(token)
+		if user_id is None: raise MatrixError(401, "M_UNKNOWN_TOKEN", "Unknown access token")
+		return user_id
+
+	def _filter(self, user_id, filter_param):
+		if not filter_param: return {}
+		if filter_param.startswith("{"): return json.loads(filter_param)
+		try:
+			return self.filters[(user_id, filter_param)]
+		except KeyError:
+			raise MatrixError(400, "M_INVALID_PARAM", "Unknown filter")
+
+	def _sync_room(self, room, user_id, since, flt):
+		room_filter = flt.get("room", {})
+		state_types = room_filter.get("state", {}).get("types")
+		timeline_filter = room_filter.get("timeline", {})
+		timeline_types = timeline_filter.get("types")
+		limit = timeline_filter.get("limit", 10)
+		lazy_members = room_filter.get("state", {}).get("lazy_load_members", False)
+
+		full_state = since is None or room.joined[user_id] > since
+		new = [e for pos, e in room.timeline if since is None or pos > since]
+		new = [e for e in new if _type_matches(timeline_types, e["type"])]
+		if not new and not full_state: return None
+		limited = len(new) > limit
+		timeline = new[-limit:] if limit else []
+
+		state = []
+		if full_state:
+			senders = set(e["sender"] for e in timeline)
+			senders.add(user_id)
+			for (event_type, state_key), event in sorted(room.state.items()):
+				if not _type_matches(state_types, event_type): continue
+				if lazy_members and event_type == "m.room.member" and state_key not in senders: continue
+				state.append(event)
+
+		return {
+			"state": {"events": state},
+			"timeline": {"events": timeline, "limited": limited, "prev_batch": "p{}".format(since or 0)},
+			"ephemeral": {"events": []},
+			"account_data": {"events": []}	}
+
+	def _left_room(self, room, user_id, since):
+		# Just the leave event, which is all a client needs to forget the room
+		if since is None or room.left[user_id] <= since: return None
+		event = room.state[("m.room.member", user_id)]
+		return {
+			"state": {"events": []},
+			"timeline": {"events": [event], "limited": False, "prev_batch": "p{}".format(since)}	}
+
+	def _sync_response(self, user_id, since, flt):
+		join = {}
+		leave = {}
+		with self.cond:
+			position = self.position
+			for room in self.rooms.values():
+				if user_id in room.joined:
+					r = self._sync_room(room, user_id, since, flt)
+					if r is not None: join[room.room_id] = r
+				elif user_id in room.left:
+					r = self._left_room(room, user_id, since)
+					if r is not None: leave[room.room_id] = r
+		return {
+			"next_batch": "s{}".format(position),
+			"rooms": {"join": join, "invite": {}, "leave": leave},
+			"presence": {"events": []},
+			"account_data": {"events": []}	}
+
+	def handle(self, method, path, query, headers, body):
+		# Returns (HTTP status, JSON-able response body)
+		for prefix in API_PREFIXES:
+			if path.startswith(prefix):
+				path = path[len(prefix):]
+				break
+		else:
+			if path == "/_matrix/client/versions":
+				return 200, {"versions": ["r0.6.1", "v1.1"]}
+			raise MatrixError(404, "M_UNRECOGNIZED", "Unrecognized request")
+
+		if method == "POST" and path == "/login":
+			self._count("login")
+			user_id = body.get("user") or body.get("identifier", {}).get("user")
+			if user_id and not user_id.startswith("@"): user_id = "@{}:{}".format(user_id, self.server_name)
+			if self.users.get(user_id) != body.get("password"):
+				raise MatrixError(403, "M_FORBIDDEN", "Invalid password")
+			token = "token{}".format(next(self.ids))
+			self.tokens[token] = user_id
+			return 200, {"user_id": user_id, "access_token": token,
+				"device_id": "MOCK", "home_server": self.server_name}
+
+		user_id = self._auth(headers, query)
+
+		if method == "GET" and path == "/account/whoami":
+			self._count("whoami")
+			return 200, {"user_id": user_id}
+
+		if method == "GET" and path == "/sync":
+			self._count("sync")
+			since = query.get("since")
+			since = int(since[1:]) if since else None
+			flt = self._filter(user_id, query.get("filter"))
+			timeout = int(query.get("timeout", 0)) / 1000
+			response = self._sync_response(user_id, since, flt)
+			rooms = response["rooms"]
+			if since is not None and not rooms["join"] and not rooms["leave"] and timeout > 0:
+				with self.cond:
+					if self.position == since: self.cond.wait(timeout)
+				response = self._sync_response(user_id, since, flt)
+			return 200, response
+
+		m = re.match(r"^/user/([^/]+)/filter(?:/([^/]+))?$", path)
+		if m:
+			self._count("filter")
+			if urllib.parse.unquote(m.group(1)) != user_id:
+				raise MatrixError(403, "M_FORBIDDEN", "Not your filter")
+			if method == "POST":
+				filter_id = str(next(self.ids))
+				self.filters[(user_id, filter_id)] = body
+				return 200, {"filter_id": filter_id}
+			return 200, self._filter(user_id, m.group(2))
+
+		m = re.match(r"^/rooms/([^/]+)/send/([^/]+)/([^/]+)$", path)
+		if m and method == "PUT":
+			self._count("send")
+			room_id = urllib.parse.unquote(m.group(1))
+			self._check_member(room_id, user_id)
+			now = time.monotonic()
+			with self.cond:
+				wait = self.last_send.get(user_id, -self.send_interval) + self.send_interval - now
+				if wait > 0:
+					raise MatrixError(429, "M_LIMIT_EXCEEDED", "Too many requests",
+						retry_after_ms=int(wait * 1000) + 1)
+				self.last_send[user_id] = now
+				self.sent += 1
+			event_id = self.put_event(room_id, user_id, urllib.parse.unquote(m.group(2)), body)
+			return 200, {"event_id": event_id}
+
+		m = re.match(r"^/(?:join|rooms/([^/]+)/join)(?:/([^/]+))?$", path)
+		if m and method == "POST":
+			self._count("join")
+			room_id = urllib.parse.unquote(m.group(1) or m.group(2) or "")
+			room_id = self.aliases.get(room_id, room_id)
+			if room_id not in self.rooms: raise MatrixError(404, "M_NOT_FOUND", "No such room")
+			self.join(room_id, user_id)
+			return 200, {"room_id": room_id}
+
+		m = re.match(r"^/rooms/([^/]+)/leave$", path)
+		if m and method == "POST":
+			self._count("leave")
+			room_id = urllib.parse.unquote(m.group(1))
+			self._check_member(room_id, user_id)
+			self.leave(room_id, user_id)
+			return 200, {}
+
+		m = re.match(r"^/rooms/([^/]+)/state/([^/]+)(?:/([^/]*))?$", path)
+		if m and method == "GET":
+			self._count("state")
+			room_id = urllib.parse.unquote(m.group(1))
+			self._check_member(room_id, user_id)
+			key = (urllib.parse.unquote(m.group(2)), urllib.parse.unquote(m.group(3) or ""))
+			event = self.rooms[room_id].state.get(key)
+			if event is None: raise MatrixError(404, "M_NOT_FOUND", "Event not found")
+			return 200, event["content"]
+
+		raise MatrixError(404, "M_UNRECOGNIZED", "Unrecognized request")
+
+	def _check_member(self, room_id, user_id):
+		room = self.rooms.get(room_id)
+		if room is None or user_id not in room.joined:
+			raise MatrixError(403, "M_FORBIDDEN", "You are not in this room")
+
+	def _make_handler(self):
+		server = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+			disable_nagle_algorithm = True
+
+			def _handle(self):
+				url = urllib.parse.urlsplit(self.path)
+				query = dict(urllib.parse.parse_qsl(url.query))
+				length = int(self.headers.get("Content-Length") or 0)
+				try:
+					body = json.loads(self.rfile.read(length) or b"{}")
+					status, response = server.handle(self.command, url.path, query, self.headers, body)
+				except MatrixError as e:
+					status, response = e.code, e.body
+				except ValueError:
+					status, response = 400, {"errcode": "M_NOT_JSON", "error": "Bad JSON"}
+				data = json.dumps(response).encode("utf-8")
+				self.send_response(status)
+				self.send_header("Content-Type", "application/json")
+				self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+			do_GET = do_POST = do_PUT = _handle
+
+			def log_message(self, *args):
+				pass
+
+		return Handler
+
+
+if __name__ == '__main__':
+	import sys
+	hs = MockHomeserver(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8008)
+	user_id = hs.add_user("test", "test")
+	hs.create_room(user_id, name="Test room", topic="Testing", aliases=["#test:localhost"])
+	print("Serving on {} for {} (password 'test')".format(hs.url, user_id))
+	hs.httpd.serve_forever()
@@ -1,30 +1,157 @@
 # stdlib
+import inspect
+import queue
+import threading
 import time
+import traceback
 
 DEBUG=False
 
 
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+
+
 class Notifier:
 	def __init__(self):
 		self.listeners = []
+		self.subscriptions = []	# parallel to self.listeners
+		self.synchronous = []	# parallel to self.listeners
+		self.cache = {}		# event -> (inline listeners, queued listeners)
+		self.lock = threading.Lock()
+		self.queue = None	# only in asynchronous mode
+		self.overflow = OVERFLOW_BLOCK
+		self.dropped = 0
+		self.dispatch_thread = None
+
+	def add_listener(self, listener, events=None, synchronous=False):
+		# 'events' limits which events the listener gets. It can be a list of
+		# event names, where a name like 'mcc.ratelimit.*' matches every
+		# event below that prefix, or a callable that is asked once for every
+		# distinct event name. None (the default) means all events.
+
+		# In asynchronous mode, listeners are called from the dispatch
+		# thread, unless 'synchronous' is set. Only synchronous listeners
+		# contribute to the return value of notify() in that mode.
 
-	def add_listener(self, listener):
-		if listener in self.listeners: return False
-		self.listeners.append(listener)
+		if events is not None and not callable(events): events = tuple(events)
+		with self.lock:
+			if listener in self.listeners: return False
+			self.listeners.append(listener)
+			self.subscriptions.append(events)
+			self.synchronous.append(synchronous)
+			self.cache = {}
 		return True
 
 	def remove_listener(self, listener):
-		if not listener in self.listeners: return False
-		self.listeners.remove(listener)
+		with self.lock:
+			if not listener in self.listeners: return False
+			i = self.listeners.index(listener)
+			del self.listeners[i]
+			del self.subscriptions[i]
+			del self.synchronous[i]
+			self.cache = {}
+		return True
+
+	def start_async(self, maxsize=1000, overflow=OVERFLOW_BLOCK):
+		# Switch to asynchronous mode: events are put on a queue of at most
+		# 'maxsize' entries, and delivered by a dispatch thread. When the
+		# queue is full, 'overflow' decides whether notify() waits for room,
+		# or the newest or oldest event is dropped (and counted in 'dropped').
+
+		if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST):
+			raise ValueError("Unknown overflow policy: {!r}".format(overflow))
+		with self.lock:
+			if self.queue is not None: return False
+			self.overflow = overflow
+			self.queue = queue.Queue(maxsize)
+			self.cache = {}
+		self.dispatch_thread = threading.Thread(target=self._dispatch_runner)
+		self.dispatch_thread.daemon = True
+		self.dispatch_thread.start()
 		return True
 
+	def flush(self):
+		# Wait until all queued events have been delivered
+		if self.queue is not None: self.queue.join()
+
+	def _dispatch_runner(self):
+		while True:
+			listeners, service, event, data = self.queue.get()
+			try:
+				self._deliver(listeners, service, event, data)
+			finally:
+				self.queue.task_done()
+
+	@staticmethod
+	def _deliver(listeners, service, event, data):
+		# A broken listener must not take the dispatch thread down with it
+		for listener in listeners:
+			try:
+				listener(service, event, data)
+			except Exception:
+				traceback.print_exc()
+
+	def _enqueue(self, item):
+		if self.overflow == OVERFLOW_BLOCK:
+			self.queue.put(item)
+			return
+		while True:
+			try:
+				self.queue.put_nowait(item)
+				return
+			except queue.Full:
+				pass
+			with self.lock: self.dropped += 1
+			if self.overflow == OVERFLOW_DROP_NEWEST: return
+			try:
+				self.queue.get_nowait()
+				self.queue.task_done()
+			except queue.Empty:
+				pass
+
+	@staticmethod
+	def _wants(events, event):
+		if events is None: return True
+		if callable(events): return events(event)
+		for pattern in events:
+			if pattern == event or pattern == '*': return True
+			if pattern.endswith('.*') and event.startswith(pattern[:-1]): return True
+		return False
+
+	def _resolve(self, event):
+		with self.lock:
+			cache = self.cache
+			entries = tuple(zip(self.listeners, self.subscriptions, self.synchronous))
+			asynchronous = self.queue is not None
+		wanted = tuple(e for e in entries if self._wants(e[1], event))
+		inline = tuple(l for l, events, synchronous in wanted if synchronous or not asynchronous)
+		queued = tuple(l for l, events, synchronous in wanted if not synchronous and asynchronous)
+		cache[event] = (inline, queued)
+		return inline, queued
+
 	def notify(self, service, event, data=None):
 		result = None	# None - No listeners
 				# False - no listeners handled this
 				# True - at least one listener handled this
 				# Meaning of 'handled' intentionally left unspecified
 
-		for listener in self.listeners:
+		try:
+			listeners, queued = self.cache[event]
+		except KeyError:
+			listeners, queued = self._resolve(event)
+
+		if queued:
+			result = False
+			if threading.current_thread() is self.dispatch_thread:
+				# Listeners notifying from the dispatch thread could
+				# deadlock on a full queue, so deliver those right away.
+				self._deliver(queued, service, event, data)
+			else:
+				self._enqueue((queued, service, event, data))
+
+		for listener in listeners:
 			r = listener(service, event, data)
 			if not result: result = bool(r)
 
@@ -37,12 +164,43 @@ notify = GLOBAL_NOTIFIER.notify
 
 
 class BaseNotificationListener:
+	# Calls self.on_<event>() for each event, with the dots in the event
+	# name replaced by underscores. Only subscribes to events that it has a
+	# handler for, unless default_handler is overridden or DEBUG is set
+	# (at the time the event is first seen).
+
 	def __init__(self, autoconnect=True):
-		if autoconnect: add_listener(self.handle_notification)
+		if autoconnect: add_listener(self.handle_notification, self.wants_notification)
+
+	def _get_handler(self, event):
+		# Returns the handler for an event, ready to call, or None.
+		# Lookups on the class are cached per class; the cache holds the
+		# raw class attribute, which is bound to self here. Handlers the
+		# class doesn't have are looked up on the instance every time, so
+		# that instance attributes and __getattr__() work too.
+		cls = type(self)
+		cache = cls.__dict__.get('_handler_cache')
+		if cache is None:
+			cache = {}
+			cls._handler_cache = cache
+		name = "on_" + event.replace(".", "_")
+		try:
+			handler = cache[event]
+		except KeyError:
+			handler = cache[event] = inspect.getattr_static(cls, name, None)
+		if handler is None: return getattr(self, name, None)
+		get = getattr(type(handler), '__get__', None)
+		if get is None: return handler
+		return get(handler, self, cls)
+
+	def wants_notification(self, event):
+		if DEBUG: return True
+		if type(self).default_handler is not BaseNotificationListener.default_handler: return True
+		return self._get_handler(event) is not None
 
 	def handle_notification(self, service, event, data=None):
-		hname = "on_" + event.replace(".", "_")
-		handler = getattr(self, hname, self.default_handler)
+		handler = self._get_handler(event)
+		if handler is None: return self.default_handler(service, event, data)
 		return handler(service, event, data)
 
 	@staticmethod
@@ -107,5 +265,15 @@ if __name__ == '__main__':
 	print("False:", repr(r))
 	r = notify(__file__, 'e.test.noshow', "This event should not show.")
 	print("None:", repr(r))
+	r = add_listener(notifier, ['e.test.exact', 'e.wild.*'])
+	print("True:", repr(r))
+	r = notify(__file__, 'e.test.exact', "This event should show once.")
+	print("False:", repr(r))
+	r = notify(__file__, 'e.wild.card', "This event should show once.")
+	print("False:", repr(r))
+	r = notify(__file__, 'e.test.noshow', "This event should not show.")
+	print("None:", repr(r))
+	r = remove_listener(notifier)
+	print("True:", repr(r))
 
 	print("[]:", repr(GLOBAL_NOTIFIER.listeners))
@@ -1,4 +1,5 @@
 # stdlib
+import collections
 import threading
 import time
 from random import SystemRandom
@@ -8,6 +9,8 @@ random = SystemRandom()
 import matrix_client_core.notifier as notifier
 
 class RateLimit:
+	refills_itself = False	# False = needs replenish() called regularly
+
 	def __init__(self, consume_factor=0.9, max_probability=2.0):
 		self.consume_factor = consume_factor
 		self.max_probability = max_probability
@@ -27,6 +30,12 @@ class RateLimit:
 		notifier.notify("{}.{}".format(__package__, __name__),
 			'mcc.ratelimit.consume', self.probability)
 
+	def try_consume(self):
+		# ok(), and if so consume(). Returns what ok() said.
+		ok = self.ok()
+		if ok: self.consume()
+		return ok
+
 	def replenish(self):
 		self.probability = min(self.probability * 2, self.max_probability)
 		notifier.notify("{}.{}".format(__package__, __name__),
@@ -42,3 +51,148 @@ class RateLimit:
 		self.replenish_thread.daemon = True
 		self.replenish_thread.start()
 
+
+
+class TokenBucket(RateLimit):
+	# Drop-in replacement for RateLimit, as a plain token bucket.
+
+	# Tokens are refilled lazily from a monotonic clock whenever the bucket
+	# is looked at, so there is no replenish thread, no randomness, and all
+	# state changes happen under a lock. Threads sharing a bucket should
+	# use try_consume(): between their ok() and consume(), others may take
+	# the last token.
+
+	refills_itself = True
+
+	def __init__(self, rate=1.0, capacity=2.0, clock=time.monotonic):
+		self.rate = rate	# tokens per second
+		self.capacity = capacity
+		self.clock = clock
+		self.tokens = capacity
+		self.last_refill = clock()
+		self.lock = threading.Lock()
+
+	def _refill(self):
+		now = self.clock()
+		self.tokens = min(self.tokens + (now - self.last_refill) * self.rate, self.capacity)
+		self.last_refill = now
+
+	def ok(self):
+		with self.lock:
+			self._refill()
+			tokens = self.tokens
+		ok = tokens >= 1
+		notifier.notify("{}.{}".format(__package__, __name__),
+			'mcc.ratelimit.ok', (ok, tokens, self.capacity))
+
+		return ok
+
+	def consume(self):
+		with self.lock:
+			self._refill()
+			self.tokens = max(self.tokens - 1, 0)
+			tokens = self.tokens
+		notifier.notify("{}.{}".format(__package__, __name__),
+			'mcc.ratelimit.consume', tokens)
+
+	def try_consume(self):
+		# Take a token if there is one, all at once. Returns True if so.
+		with self.lock:
+			self._refill()
+			tokens = self.tokens
+			ok = tokens >= 1
+			if ok: self.tokens -= 1
+		notifier.notify("{}.{}".format(__package__, __name__),
+			'mcc.ratelimit.ok', (ok, tokens, self.capacity))
+		if ok:
+			notifier.notify("{}.{}".format(__package__, __name__),
+				'mcc.ratelimit.consume', tokens - 1)
+
+		return ok
+
+	def replenish(self):
+		with self.lock:
+			self._refill()
+			tokens = self.tokens
+		notifier.notify("{}.{}".format(__package__, __name__),
+			'mcc.ratelimit.replenish', tokens)
+
+	def start_replenish_thread(self, interval):
+		# Nothing to do; refilling happens on demand. Kept so that a
+		# TokenBucket can be used wherever a RateLimit is.
+		self.replenish_thread = None
+
+
+class KeyedRateLimit:
+	# A separate rate limiter per key (room ID, sender mxid, ...), so that
+	# one abusive user can't use up the budget for everyone else.
+	# 'factory' is called without arguments to make each limiter; use
+	# functools.partial to configure them.
+
+	# Only the 'max_keys' most recently used keys are remembered. A key
+	# that is evicted starts over with a fresh limiter next time it shows up.
+
+	def __init__(self, factory=TokenBucket, max_keys=10000):
+		self.factory = factory
+		self.max_keys = max_keys
+		self.limiters = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def stats(self):
+		return (self.hits, self.misses, self.evictions)
+
+	def get(self, key):
+		# Return the limiter for 'key', creating it if needed
+		with self.lock:
+			limiter = self.limiters.get(key)
+			if limiter is not None:
+				self.hits += 1
+				self.limiters.move_to_end(key)
+				return limiter
+			self.misses += 1
+			limiter = self.limiters[key] = self.factory()
+			evicted = None
+			if len(self.limiters) > self.max_keys:
+				evicted = self.limiters.popitem(last=False)[0]
+				self.evictions += 1
+			stats = self.stats()
+
+		notifier.notify("{}.{}".format(__package__, __name__),
+			'mcc.ratelimit.keyed.miss', (key, stats))
+		if evicted is not None:
+			notifier.notify("{}.{}".format(__package__, __name__),
+				'mcc.ratelimit.keyed.evict', (evicted, stats))
+
+		return limiter
+
+	def ok(self, key):
+		return self.get(key).ok()
+
+	def consume(self, key):
+		self.get(key).consume()
+
+	def try_consume(self, key):
+		return self.get(key).try_consume()
+
+	def replenish(self):
+		# Only needed for limiters that don't refill by themselves
+		with self.lock:
+			limiters = list(self.limiters.values())
+		for limiter in limiters:
+			limiter.replenish()
+
+	def _replenish_runner(self, interval):
+		while True:
+			time.sleep(interval)
+			self.replenish()
+
+	def start_replenish_thread(self, interval):
+		# One thread for all keys, and none at all for limiters that
+		# refill by themselves (like TokenBuckets)
+		if self.factory().refills_itself: return
+		self.replenish_thread = threading.Thread(target=self._replenish_runner, args=(interval,))
+		self.replenish_thread.daemon = True
+		self.replenish_thread.start()
@@ -0,0 +1,112 @@
+# Recording and replaying sync traffic.
+
+# A trace is an append-only file with one compact JSON array per line:
+# [wall clock time, kind, data]. 'kind' is "sync" for a raw sync response
+# and "send" for the outcome of a send. Traces whose name ends in ".gz" are
+# gzip-compressed; appending to one adds another gzip member, which
+# gzip readers handle transparently.
+
+# stdlib
+import gzip
+import json
+import threading
+import time
+
+# in-tree deps
+import matrix_client_core.notifier as notifier
+
+REPLAY_URL = "http://replay.invalid"
+
+
+def _open(filename, mode):
+	if filename.endswith(".gz"): return gzip.open(filename, mode + "t", encoding="utf-8")
+	return open(filename, mode, encoding="utf-8")
+
+
+class TraceWriter:
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = _open(filename, "a")
+		self.lock = threading.Lock()
+
+	def write(self, kind, data):
+		line = json.dumps([time.time(), kind, data], separators=(',', ':')) + "\n"
+		with self.lock:
+			if self.file is not None: self.file.write(line)
+
+	def flush(self):
+		with self.lock:
+			if self.file is not None: self.file.flush()
+
+	def close(self):
+		with self.lock:
+			if self.file is not None: self.file.close()
+			self.file = None
+
+
+def read_trace(filename):
+	# Yields (time, kind, data) for each record in a trace
+	with _open(filename, "r") as f:
+		for line in f:
+			if not line.strip(): continue
+			t, kind, data = json.loads(line)
+			yield t, kind, data
+
+
+class TraceReplayer:
+	# Feeds the sync responses in a trace into an MXClient, without any
+	# network access. The first recorded sync takes the place of
+	# first_sync(); events from later syncs go to the client's listeners
+	# exactly as they would have live. The client neither saves its sync
+	# state nor records: its 'statefilename' and 'recorder' are cleared,
+	# so that a replay never overwrites live state or traces.
+
+	def __init__(self, filename):
+		self.filename = filename
+
+	def replay(self, client, speed=None):
+		# 'speed' None replays as fast as possible, 1.0 at recorded speed,
+		# 2.0 twice as fast etc. Returns a dict of statistics.
+
+		# Imported here, because the package imports this module
+		import matrix_client_core as client_framework
+
+		stats = {'syncs': 0, 'events': 0, 'sends': 0, 'seconds': 0}
+		response = None
+		client.statefilename = None
+		client.recorder = None
+		sdkclient = client_framework.NoSyncMatrixClient(REPLAY_URL)
+		sdkclient.api_sync = lambda *args, **kwargs: response
+		client.sdkclient = sdkclient
+		if client.room_state is not None: client.room_state.api = None	# nothing to fetch from
+		client._add_response_listeners()
+
+		notifier.notify(__name__, 'mcc.replay.start', self.filename)
+		t_start = time.monotonic()
+		t_first = None
+		for t, kind, data in read_trace(self.filename):
+			if t_first is None: t_first = t
+			if speed:
+				delay = (t - t_first) / speed - (time.monotonic() - t_start)
+				if delay > 0: time.sleep(delay)
+			if kind == "send":
+				stats['sends'] += 1
+				continue
+			if kind != "sync": continue
+
+			response = data
+			stats['syncs'] += 1
+			stats['events'] += sum(len(r.get('timeline', {}).get('events', ()))
+						for r in data.get('rooms', {}).get('join', {}).values())
+			if stats['syncs'] == 1:
+				sdkclient.finish_fixup()
+				sdkclient._sync()
+				client.rooms = client_framework.RoomList(sdkclient.get_rooms())
+				client.foreground_room = None
+				client.add_listeners()
+			else:
+				sdkclient._sync()
+
+		stats['seconds'] = time.monotonic() - t_start
+		notifier.notify(__name__, 'mcc.replay.done', stats)
+		return stats
@@ -0,0 +1,156 @@
+# stdlib
+import difflib
+import json
+import pprint
+import sys
+
+
+def format_member(sender, event):
+	membership = event['content'].get('membership')
+	if membership == "join": return "{} joined".format(sender)
+	if membership == "leave": return "{} left".format(sender)
+	return None
+
+def format_text(sender, event):
+	return "{}: {}".format(sender, event['content']['body'])
+
+def format_emote(sender, event):
+	return " * {} {}".format(sender, event['content']['body'])
+
+def format_message(sender, event):
+	return " ? {}:{}: {}".format(
+		sender,
+		event['content'].get('msgtype'),
+		event['content'].get('body', ""))
+
+
+class RenderedEvent:
+	# What sinks get handed. Everything beyond the basics is only computed
+	# when a sink actually asks for it.
+
+	# (title, key path of old content, key path of new content)
+	DIFFS = (
+		("Diff root/content:", ('prev_content',), ('content',)),
+		("Diff unsigned/content:", ('unsigned', 'prev_content'), ('content',)),
+		("Diff root/unsigned(!):", ('prev_content',), ('unsigned', 'prev_content')))
+
+	def __init__(self, renderer, roomhandle, sender, event):
+		self.renderer = renderer
+		self.roomhandle = roomhandle
+		self.sender = sender
+		self.event = event
+		self._text = False
+		self._diffs = None
+
+	@property
+	def prefix(self):
+		return "[{0}]".format(self.roomhandle)
+
+	@property
+	def text(self):
+		# One-line rendition of the event, or None if there is no formatter
+		# for it (in which case a sink should show the raw event)
+		if self._text is False:
+			self._text = self.renderer.format(self.sender, self.event)
+		return self._text
+
+	@staticmethod
+	def _lookup(event, path):
+		for key in path:
+			event = event[key]
+		return event
+
+	@property
+	def diffs(self):
+		# List of (title, ndiff lines) comparing the previous and current
+		# content of a state event
+		if self._diffs is None:
+			self._diffs = []
+			for title, path_a, path_b in self.DIFFS:
+				try:
+					a, b = self._lookup(self.event, path_a), self._lookup(self.event, path_b)
+				except (KeyError, TypeError):
+					continue
+				ppa = (pprint.pformat(a) + "\n").splitlines(True)
+				ppb = (pprint.pformat(b) + "\n").splitlines(True)
+				self._diffs.append((title, list(difflib.ndiff(ppa, ppb))))
+		return self._diffs
+
+
+class TextSink:
+	# Human-readable output, one line per event plus any content diffs
+
+	def __init__(self, file=None, diffs=True):
+		self.file = file
+		self.diffs = diffs
+
+	def __call__(self, rendered):
+		f = self.file or sys.stdout
+		if rendered.text is None:
+			print(rendered.prefix, end=' ', file=f)
+			pprint.pprint(rendered.event, f)
+		else:
+			print(rendered.prefix, rendered.text, file=f)
+		if not self.diffs: return
+		for title, lines in rendered.diffs:
+			print(rendered.prefix + " " + title, file=f)
+			print("".join(lines), end='', file=f)
+
+
+class JSONLinesSink:
+	# Structured output: one JSON object per event
+
+	def __init__(self, file=None, diffs=False, raw=False):
+		self.file = file
+		self.diffs = diffs
+		self.raw = raw
+
+	def __call__(self, rendered):
+		event = rendered.event
+		d = {
+			'room': rendered.roomhandle,
+			'room_id': event.get('room_id'),
+			'event_id': event.get('event_id'),
+			'type': event.get('type'),
+			'sender': rendered.sender,
+			'ts': event.get('origin_server_ts'),
+			'text': rendered.text	}
+		if self.diffs:
+			d['diffs'] = dict((title, "".join(lines)) for title, lines in rendered.diffs)
+		if self.raw:
+			d['event'] = event
+		f = self.file or sys.stdout
+		f.write(json.dumps(d, sort_keys=True) + "\n")
+
+
+class Renderer:
+	# Formats timeline events and hands them to a list of sinks. With no
+	# sinks, render() returns right away and nothing gets formatted.
+
+	def __init__(self, sinks=None):
+		self.sinks = [] if sinks is None else list(sinks)
+		self.formatters = {}	# (event type, msgtype or None) -> formatter
+		self.register("m.room.member", format_member)
+		self.register("m.room.message", format_message)
+		self.register("m.room.message", format_text, "m.text")
+		self.register("m.room.message", format_emote, "m.emote")
+
+	def register(self, event_type, formatter, msgtype=None):
+		# 'formatter' is called as formatter(sender, event), and returns a
+		# string, or None to have the raw event shown instead
+		self.formatters[(event_type, msgtype)] = formatter
+
+	def format(self, sender, event):
+		event_type = event.get('type')
+		msgtype = (event.get('content') or {}).get('msgtype')
+		formatter = self.formatters.get((event_type, msgtype))
+		if formatter is None:
+			formatter = self.formatters.get((event_type, None))
+		if formatter is None: return None
+		return formatter(sender, event)
+
+	def render(self, roomhandle, sender, event):
+		if not self.sinks: return
+		rendered = RenderedEvent(self, roomhandle, sender, event)
+		for sink in self.sinks:
+			sink(rendered)
@@ -0,0 +1,143 @@
+# stdlib
+import collections
+import threading
+import time
+
+# external deps
+import matrix_client.errors
+
+# in-tree deps
+import matrix_client_core.notifier as notifier
+
+
+class RoomStateCache:
+	# The bits of room state we look at all the time (members, power levels,
+	# name and topic), kept up to date from sync responses.
+
+	# Works with lazy-loaded members: whatever the server didn't send us is
+	# fetched the first time someone asks for it, and cached from then on.
+	# At most 'max_entries' state events are kept, forgetting the least
+	# recently used ones first. Things we asked for but that don't exist are
+	# cached as None, so we don't keep asking. Those who can't wait for the
+	# server can prefetch() instead, which fetches on the worker pool given
+	# as 'executor' (a dispatch.OrderedDispatcher, usually shared with
+	# other things), if there is one and it isn't too busy.
+
+	TYPES = ('m.room.member', 'm.room.power_levels', 'm.room.name', 'm.room.topic')
+
+	def __init__(self, api=None, max_entries=100000):
+		self.api = api		# MatrixHttpApi to fetch missing state with; None = don't fetch
+		self.max_entries = max_entries
+		self.entries = collections.OrderedDict()	# (room ID, type, state key) -> content or None
+		self.lock = threading.Lock()
+		self.executor = None	# dispatch.OrderedDispatcher to prefetch on; None = don't
+		self.pending = set()	# keys waiting to be prefetched
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def stats(self):
+		return (self.hits, self.misses, self.evictions)
+
+	def __len__(self):
+		return len(self.entries)
+
+	def _put(self, key, content):
+		# Call with self.lock held
+		self.entries[key] = content
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+
+	def on_sync_response(self, response):
+		# Sync response listener. Picks up state events from both the state
+		# and the timeline sections of each joined room.
+		rooms = response.get('rooms', {})
+		with self.lock:
+			for room_id, sync_room in rooms.get('join', {}).items():
+				for section in ('state', 'timeline'):
+					for event in sync_room.get(section, {}).get('events', ()):
+						if event.get('type') not in self.TYPES or 'state_key' not in event: continue
+						self._put((room_id, event['type'], event['state_key']), event.get('content', {}))
+		for room_id in rooms.get('leave', {}):
+			self.forget_room(room_id)
+
+	def forget_room(self, room_id):
+		with self.lock:
+			for key in [k for k in self.entries if k[0] == room_id]:
+				del self.entries[key]
+
+	def get(self, room_id, event_type, state_key="", fetch=True):
+		# The content of a state event, or None if there is no such event
+		# (or we don't know and 'fetch' is False)
+		key = (room_id, event_type, state_key)
+		with self.lock:
+			if key in self.entries:
+				self.hits += 1
+				self.entries.move_to_end(key)
+				return self.entries[key]
+			self.misses += 1
+		if not fetch or self.api is None: return None
+
+		t0 = time.monotonic()
+		try:
+			if event_type == 'm.room.member':
+				content = self.api.get_membership(room_id, state_key)
+			else:
+				content = self.api.get_state_event(room_id, event_type)
+		except matrix_client.errors.MatrixRequestError as e:
+			# Not there, or not for our eyes. Either way, don't ask again.
+			if e.code not in (403, 404): raise
+			content = None
+		notifier.notify("{}.{}".format(__package__, __name__),
+			'mcc.roomstate.fetch', (key, time.monotonic() - t0))
+
+		with self.lock:
+			# Sync may have beaten us to it, in which case that's newer
+			if key not in self.entries: self._put(key, content)
+			return self.entries.get(key, content)
+
+	def prefetch(self, room_id, event_type, state_key=""):
+		# Have something get() didn't know fetched in the background, so
+		# that it's there next time
+		executor = self.executor
+		if self.api is None or executor is None: return
+		key = (room_id, event_type, state_key)
+		with self.lock:
+			if key in self.entries or key in self.pending: return
+			self.pending.add(key)
+		# Never wait for room in the executor's backlog: we may be running
+		# on one of its workers. Skipped ones get another chance next time.
+		if not executor.try_submit(key, self._prefetch, key):
+			with self.lock:
+				self.pending.discard(key)
+
+	def _prefetch(self, key):
+		try:
+			self.get(*key)
+		except Exception as e:
+			# Not cached, so the next prefetch() tries again
+			notifier.notify("{}.{}".format(__package__, __name__),
+				'mcc.roomstate.prefetch_failed', (key, e))
+		finally:
+			with self.lock:
+				self.pending.discard(key)
+
+	def displayname(self, room_id, user_id, fetch=True):
+		content = self.get(room_id, 'm.room.member', user_id, fetch)
+		if not content: return None
+		return content.get('displayname')
+
+	def power_levels(self, room_id, fetch=True):
+		return self.get(room_id, 'm.room.power_levels', "", fetch)
+
+	def name(self, room_id, fetch=True):
+		content = self.get(room_id, 'm.room.name', "", fetch)
+		if not content: return None
+		return content.get('name')
+
+	def topic(self, room_id, fetch=True):
+		content = self.get(room_id, 'm.room.topic', "", fetch)
+		if not content: return None
+		return content.get('topic')
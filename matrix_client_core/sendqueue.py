@@ -0,0 +1,274 @@
+# stdlib
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+# in-tree deps
+import matrix_client_core.notifier as notifier
+
+
+# Priorities for put(): lower goes first
+INTERACTIVE = 0		# replies someone is waiting for
+NORMAL = 1
+BULK = 2		# announcements and the like
+PRIORITY_NAMES = ("interactive", "normal", "bulk")
+
+
+class Lane:
+	# The queues of pending items for a single key (room ID), one per
+	# priority
+
+	def __init__(self, key):
+		self.key = key
+		self.items = [collections.deque() for name in PRIORITY_NAMES]	# (time enqueued, deadline, item)
+		self.busy = False	# an item of this lane is being processed
+		self.current = None	# (priority, time enqueued, deadline, time started) of that item
+		self.retry = False	# that item was refused and put back
+		self.next_time = 0	# monotonic time before which we may not start the next item
+		self.entry = None	# seq of this lane's entry in the scheduler's heaps, if any
+		self.entry_priority = None	# priority of that entry, if it's runnable
+
+	def __len__(self):
+		return sum(map(len, self.items))
+
+	def priority(self):
+		# The highest priority with items waiting, or None
+		for priority, items in enumerate(self.items):
+			if items: return priority
+		return None
+
+
+class AdaptivePacer:
+	# Keeps the minimum interval between any two sends as small as the
+	# server lets us. When we get throttled, it becomes the wait the
+	# server asked for, or double what it was if that isn't more; it
+	# shrinks again after 'speedup_after' consecutive successful sends.
+
+	def __init__(self, min_interval=0, max_interval=60, first_step=0.5,
+			speedup_after=10, speedup_factor=0.75):
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.first_step = first_step
+		self.speedup_after = speedup_after
+		self.speedup_factor = speedup_factor
+		self.interval = min_interval
+		self.successes = 0
+
+	def rate(self):
+		# Effective maximum rate in messages/s, or None if unlimited
+		if self.interval <= 0: return None
+		return 1 / self.interval
+
+	def success(self):
+		# Returns True if the interval changed
+		self.successes += 1
+		if self.successes < self.speedup_after or self.interval <= self.min_interval:
+			return False
+		self.successes = 0
+		self.interval *= self.speedup_factor
+		if self.interval < self.first_step: self.interval = self.min_interval
+		return True
+
+	def throttled(self, retry_after=0):
+		self.successes = 0
+		if retry_after > self.interval: interval = retry_after
+		else: interval = self.interval * 2
+		interval = max(interval, self.first_step, self.min_interval)
+		# Past 'max_interval' only if the server asks for it
+		self.interval = min(interval, max(retry_after, self.max_interval, self.interval))
+		return True
+
+
+class SendScheduler:
+	# A send queue with a separate lane per key (room ID).
+
+	# Items in the same lane are handed out one at a time, highest priority
+	# first and otherwise in order, and at most once every 'pacing' seconds.
+	# Items in different lanes can be processed in parallel, by as many
+	# workers as call get(), again highest priority first. On top of that,
+	# 'pacer' spaces out all sends to the rate the server accepts. Sends
+	# already under way when it slowed down don't slow it down again.
+
+	# Items can have a time to live. Those still waiting when it runs out
+	# are dropped, and reported as mcc.sendqueue.expired.
+
+	def __init__(self, pacing=0, pacer=None):
+		self.pacing = pacing
+		self.pacer = pacer or AdaptivePacer()
+		self.not_before = 0	# monotonic time before which nothing may be sent
+		self.slowed_down = 0	# monotonic time the pacer was last throttled
+		self.lanes = {}
+		self.depth = 0		# number of items waiting, in all lanes
+		self.waiting = []	# heap of (next_time, seq, key) for lanes with work that isn't due yet,
+					# or with none, to be dropped once their next_time has passed
+		self.runnable = []	# heap of (priority, seq, key) for lanes with work that is due
+		self.expired = []	# (key, priority, age) of dropped items, yet to be reported
+		self.seq = itertools.count()
+		self.cond = threading.Condition()
+
+	def put(self, key, item, priority=NORMAL, ttl=None):
+		# Queue 'item'. If 'ttl' is given, drop it unless it can be started
+		# within 'ttl' seconds.
+		if priority not in range(len(PRIORITY_NAMES)):
+			raise ValueError("Unknown priority: {!r}".format(priority))
+		now = time.monotonic()
+		deadline = None if ttl is None else now + ttl
+		with self.cond:
+			lane = self.lanes.get(key)
+			if lane is None:
+				lane = self.lanes[key] = Lane(key)
+			lane.items[priority].append((now, deadline, item))
+			self.depth += 1
+			depth = self.depth
+			if not lane.busy:
+				if lane.entry is None:
+					self._schedule(lane)
+				elif lane.entry_priority is not None and priority < lane.entry_priority:
+					# Move it up; the old entry is skipped when it comes up
+					self._schedule(lane)
+		notifier.notify(__name__, 'mcc.sendqueue.enqueue', (key, depth))
+
+	def _schedule(self, lane):
+		lane.entry = next(self.seq)
+		if lane.next_time > time.monotonic():
+			lane.entry_priority = None
+			heapq.heappush(self.waiting, (lane.next_time, lane.entry, lane.key))
+		else:
+			lane.entry_priority = lane.priority()
+			heapq.heappush(self.runnable, (lane.entry_priority, lane.entry, lane.key))
+		self.cond.notify()
+
+	def get(self):
+		# Block until an item is due, and return (key, item).
+		# The caller must call done(key) when it is finished with the item.
+		while True:
+			with self.cond:
+				due = self._next_due()
+				if isinstance(due, tuple):
+					key, priority, enqueued, item = due
+					self.depth -= 1
+					depth = self.depth
+					break
+				if not self.expired: self.cond.wait(due)
+			self._report_expired()
+		self._report_expired()
+		notifier.notify(__name__, 'mcc.sendqueue.dequeue', (key, priority, time.monotonic() - enqueued, depth))
+		return key, item
+
+	def _next_due(self):
+		# Call with self.cond held. Takes the next item that is due, and
+		# returns (key, priority, time enqueued, item). If there is none,
+		# returns how long to wait before trying again (None = until woken
+		# up). Drops expired items on the way.
+		now = time.monotonic()
+		while self.waiting and self.waiting[0][0] <= now:
+			next_time, seq, key = heapq.heappop(self.waiting)
+			lane = self.lanes.get(key)
+			if lane is None or lane.entry != seq: continue
+			lane.entry_priority = lane.priority()
+			if lane.entry_priority is None:
+				del self.lanes[key]
+				continue
+			heapq.heappush(self.runnable, (lane.entry_priority, seq, key))
+		while self.runnable:
+			delay = self.not_before - now
+			if delay > 0: return delay
+			priority, seq, key = heapq.heappop(self.runnable)
+			lane = self.lanes.get(key)
+			if lane is None or lane.entry != seq: continue
+			lane.entry = lane.entry_priority = None
+			self._drop_expired(lane, now)
+			current = lane.priority()
+			if current is None:
+				if lane.next_time <= now: del self.lanes[key]
+				else: self._schedule(lane)
+				continue
+			if current != priority:
+				# Its best items have expired; let other lanes go first
+				self._schedule(lane)
+				continue
+			enqueued, deadline, item = lane.items[current].popleft()
+			lane.busy = True
+			lane.current = (current, enqueued, deadline, now)
+			self.not_before = now + self.pacer.interval
+			return key, current, enqueued, item
+		if not self.waiting: return None
+		return self.waiting[0][0] - now
+
+	def _drop_expired(self, lane, now):
+		# Call with self.cond held
+		for priority, items in enumerate(lane.items):
+			while items and items[0][1] is not None and items[0][1] < now:
+				enqueued, deadline, item = items.popleft()
+				self.depth -= 1
+				self.expired.append((lane.key, priority, now - enqueued))
+
+	def _report_expired(self):
+		with self.cond:
+			expired, self.expired = self.expired, []
+			depth = self.depth
+		for key, priority, age in expired:
+			notifier.notify(__name__, 'mcc.sendqueue.expired', (key, priority, age, depth))
+
+	def done(self, key):
+		with self.cond:
+			lane = self.lanes[key]
+			lane.busy = False
+			lane.current = None
+			now = time.monotonic()
+			if lane.retry:
+				# Nothing was sent, so there's nothing to space out from
+				lane.retry = False
+			else:
+				lane.next_time = max(lane.next_time, now + self.pacing)
+			if len(lane) or lane.next_time > now:
+				# An empty lane still has to remember next_time until
+				# then; its entry in self.waiting drops it afterwards
+				self._schedule(lane)
+			else:
+				del self.lanes[key]
+
+	def defer(self, key, delay):
+		# Don't start the next item in this lane for 'delay' seconds. Must
+		# be called before done(key).
+		with self.cond:
+			lane = self.lanes[key]
+			lane.next_time = max(lane.next_time, time.monotonic() + delay)
+
+	def success(self):
+		# Report that the last item was sent successfully
+		with self.cond:
+			changed = self.pacer.success()
+			interval = self.pacer.interval
+			rate = self.pacer.rate()
+		if changed:
+			notifier.notify(__name__, 'mcc.sendqueue.rate', (interval, rate))
+
+	def throttle(self, key, item, retry_after=0):
+		# The server refused 'item' because we're sending too fast. Put it
+		# back at the front of its lane, and hold off all sending for
+		# 'retry_after' seconds. Must be called before done(key).
+		with self.cond:
+			lane = self.lanes[key]
+			# It keeps its place, and its age, in the lane
+			priority, enqueued, deadline, started = lane.current
+			lane.items[priority].appendleft((enqueued, deadline, item))
+			lane.retry = True
+			self.depth += 1
+			now = time.monotonic()
+			self.not_before = max(self.not_before, now + retry_after)
+			# Sent at the old rate, so it says nothing about the new one
+			changed = started >= self.slowed_down
+			if changed:
+				self.pacer.throttled(retry_after)
+				self.slowed_down = now
+			interval = self.pacer.interval
+			rate = self.pacer.rate()
+		notifier.notify(__name__, 'mcc.sendqueue.throttled', (key, retry_after))
+		if changed:
+			notifier.notify(__name__, 'mcc.sendqueue.rate', (interval, rate))
+
+	def qsize(self):
+		return self.depth
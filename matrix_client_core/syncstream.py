@@ -0,0 +1,176 @@
+# Parsing sync responses while they are being downloaded.
+
+# An initial sync for an account in many big rooms can be tens of MB of
+# JSON. Rather than reading and decoding it in one piece, iter_sync() walks
+# the document and hands out one room at a time, so only a single room's
+# worth of events is ever decoded at once.
+
+# stdlib
+import codecs
+import json
+
+# external deps
+import matrix_client.api
+import matrix_client.errors
+import requests
+
+CHUNK_SIZE = 65536
+WHITESPACE = " \t\n\r"
+
+_decoder = json.JSONDecoder()
+
+
+def fetch(api, since=None, timeout_ms=30000, filter=None):
+	# Like MatrixHttpApi.sync(), but returns an iterator over the text of
+	# the response as it comes in, instead of the decoded response. Close
+	# it if you stop early, to give the connection back to the pool.
+	params = {"timeout": int(timeout_ms)}
+	if since: params["since"] = since
+	if filter: params["filter"] = filter
+	headers = {"User-Agent": "matrix-python-sdk/%s" % matrix_client.api.__version__}
+	if api.use_authorization_header:
+		headers["Authorization"] = "Bearer %s" % api.token
+	else:
+		params["access_token"] = api.token
+	if api.identity: params["user_id"] = api.identity
+	url = api._base_url + matrix_client.api.MATRIX_V2_API_PATH + "/sync"
+
+	try:
+		response = api.session.get(url, params=params, headers=headers,
+				verify=api.validate_cert, stream=True)
+	except requests.exceptions.RequestException as e:
+		raise matrix_client.errors.MatrixHttpLibError(e, "GET", url)
+	if response.status_code < 200 or response.status_code >= 300:
+		try:
+			raise matrix_client.errors.MatrixRequestError(code=response.status_code,
+					content=response.text)
+		finally:
+			response.close()
+	return _iter_text(response)
+
+
+def _iter_text(response):
+	if not hasattr(response, 'iter_content'):
+		# Not a real requests.Response, so no streaming
+		yield response.text
+		return
+	try:
+		decoder = codecs.getincrementaldecoder("utf-8")()
+		for chunk in response.iter_content(CHUNK_SIZE):
+			text = decoder.decode(chunk)
+			if text: yield text
+		text = decoder.decode(b"", final=True)
+		if text: yield text
+	finally:
+		response.close()
+
+
+class _Reader:
+	# Just enough of a pull parser to walk down objects key by key, and
+	# decode whatever is below that in one go.
+
+	def __init__(self, chunks):
+		self.chunks = iter(chunks)
+		self.buf = ""
+		self.pos = 0
+		self.eof = False
+
+	def _fill(self):
+		# Read one more chunk. Returns False at the end of the input.
+		if self.eof: return False
+		try:
+			chunk = next(self.chunks)
+		except StopIteration:
+			self.eof = True
+			return False
+		self.buf = self.buf[self.pos:] + chunk
+		self.pos = 0
+		return True
+
+	def _peek(self):
+		while True:
+			while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+				self.pos += 1
+			if self.pos < len(self.buf): return self.buf[self.pos]
+			if not self._fill(): raise ValueError("Unexpected end of JSON input")
+
+	def _expect(self, c):
+		if self._peek() != c:
+			raise ValueError("Expected {!r} at {!r}".format(c, self.buf[self.pos:self.pos + 20]))
+		self.pos += 1
+
+	def value(self):
+		# Decode the next value. Each failed attempt at least doubles the
+		# buffer before the next one, so big values still parse in linear
+		# time.
+		self._peek()
+		need = 0
+		while True:
+			available = len(self.buf) - self.pos
+			if available >= need or self.eof:
+				try:
+					value, end = _decoder.raw_decode(self.buf, self.pos)
+					# A number could go on in the next chunk
+					if end < len(self.buf) or self.eof:
+						self.pos = end
+						return value
+				except ValueError:
+					if self.eof: raise
+				need = 2 * available
+			self._fill()
+
+	def keys(self):
+		# Iterate over the keys of the object that comes next. The caller
+		# has to consume each key's value (with value() or keys()) before
+		# asking for the next key.
+		self._expect('{')
+		first = True
+		while True:
+			if self._peek() == '}':
+				self.pos += 1
+				return
+			if not first: self._expect(',')
+			first = False
+			if self._peek() != '"': raise ValueError("Expected an object key")
+			key = self.value()
+			self._expect(':')
+			yield key
+
+
+def iter_sync(chunks):
+	# Iterate over a sync response given as chunks of text, as (path, value)
+	# pairs. Rooms come one at a time, with a path like
+	# ("rooms", "join", room_id); everything else comes whole, with a path
+	# of just the top-level key (or ("rooms", key) for unknown sections).
+	reader = _Reader(chunks)
+	for key in reader.keys():
+		if key != "rooms":
+			yield (key,), reader.value()
+			continue
+		for section in reader.keys():
+			if section not in ("join", "invite", "leave"):
+				yield ("rooms", section), reader.value()
+				continue
+			for room_id in reader.keys():
+				yield ("rooms", section, room_id), reader.value()
+
+
+def type_matches(event_filter, event_type):
+	# Apply the "types" and "not_types" of a filter to an event type
+	def match(pattern):
+		if pattern.endswith("*"): return event_type.startswith(pattern[:-1])
+		return event_type == pattern
+	if any(map(match, event_filter.get("not_types", ()))): return False
+	types = event_filter.get("types")
+	return types is None or any(map(match, types))
+
+
+def filter_room(sync_room, room_filter):
+	# Drop the events a room filter doesn't want from one room of a sync
+	# response, in case the server sent them anyway
+	for section, event_filter in room_filter.items():
+		if not isinstance(event_filter, dict): continue
+		part = sync_room.get(section)
+		if not isinstance(part, dict) or 'events' not in part: continue
+		part['events'] = [e for e in part['events'] if type_matches(event_filter, e.get('type', ""))]
+	return sync_room
@@ -0,0 +1,46 @@
+# Fixtures shared by the tests that run clients against a MockHomeserver
+
+# stdlib
+import asyncio
+import time
+import unittest
+
+# in-tree deps
+import matrix_client_core as client_framework
+from matrix_client_core.mockserver import MockHomeserver
+
+
+def wait_for(condition, timeout=15):
+	deadline = time.monotonic() + timeout
+	while not condition():
+		if time.monotonic() > deadline: return False
+		time.sleep(0.02)
+	return True
+
+
+async def async_wait_for(condition, timeout=15):
+	deadline = time.monotonic() + timeout
+	while not condition():
+		if time.monotonic() > deadline: return False
+		await asyncio.sleep(0.02)
+	return True
+
+
+class MockHomeserverTest(unittest.TestCase):
+	# A running MockHomeserver with two users: "bot", who logs in with
+	# "bottoken" (or password "secret"), and "other"
+
+	def setUp(self):
+		self.hs = MockHomeserver()
+		self.url = self.hs.start()
+		self.addCleanup(self.hs.stop)
+		self.bot = self.hs.add_user("bot", password="secret", access_token="bottoken")
+		self.other = self.hs.add_user("other")
+
+	def account(self, user_id=None, access_token="bottoken", password=None):
+		account = client_framework.AccountInfo()
+		account.hs_client_api_url = self.url
+		account.mxid = user_id or self.bot
+		account.access_token = access_token
+		account.password = password
+		return account
@@ -0,0 +1,124 @@
+# stdlib
+import asyncio
+import os
+import tempfile
+import unittest
+
+# external deps
+import matrix_client.errors
+
+# in-tree deps
+import matrix_client_core as client_framework
+import matrix_client_core.aio as aio
+import matrix_client_core.notifier as notifier
+from helpers import MockHomeserverTest, async_wait_for
+
+
+class RecordingClient(aio.AsyncMXClient):
+	def __init__(self, *args, **kwargs):
+		aio.AsyncMXClient.__init__(self, *args, **kwargs)
+		self.renderer.sinks = []
+		self.received = []
+
+	async def on_global_timeline_event(self, event):
+		if event['type'] != 'm.room.message': return
+		# Let other events overtake this one if they could
+		await asyncio.sleep(0.01)
+		self.received.append(event['content']['body'])
+
+
+class AsyncMXClientTest(MockHomeserverTest):
+	def setUp(self):
+		MockHomeserverTest.setUp(self)
+		self.room_id = self.hs.create_room(self.other, name="Room", members=[self.bot])
+		self.hs.put_event(self.room_id, self.other, "m.room.message", {"msgtype": "m.text", "body": "before"})
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tmpdir.cleanup)
+		self.notified = []
+		notifier.add_listener(self.on_event, ['mcc.sendqueue.*', 'mcc.mxc.*'])
+
+	def tearDown(self):
+		notifier.remove_listener(self.on_event)
+
+	def on_event(self, service, event, data):
+		self.notified.append(event)
+
+	def client(self, password=False):
+		if password: account = self.account(access_token=None, password="secret")
+		else: account = self.account()
+		return RecordingClient(os.path.join(self.tmpdir.name, "account.json"), account=account)
+
+	def test_password_login(self):
+		async def main():
+			client = self.client(password=True)
+			await client.login()
+			client.close()
+			return client
+
+		client = asyncio.run(main())
+		self.assertEqual(client.api.token, client.account.access_token)
+		self.assertEqual(self.hs.tokens[client.account.access_token], self.bot)
+		saved = client_framework.AccountInfo()
+		saved.loadfromfile(client.accountfilename)
+		self.assertEqual(saved.access_token, client.account.access_token)
+
+	def test_bad_token(self):
+		async def main():
+			client = self.client()
+			client.account.access_token = "wrong"
+			try:
+				await client.login()
+			finally:
+				client.close()
+
+		with self.assertRaises(matrix_client.errors.MatrixRequestError) as cm:
+			asyncio.run(main())
+		self.assertEqual(cm.exception.code, 401)
+
+	def test_lifecycle(self):
+		hs = self.hs
+
+		async def main():
+			client = self.client()
+			await client.login()
+			await client.first_sync()
+			self.assertEqual(list(client.rooms.roomsbyid), [self.room_id])
+			self.assertEqual(client.sdkclient.rooms[self.room_id].name, "Room")
+			client.hook()
+
+			# Incremental syncs go to the handlers, in order per room
+			hs.set_aliases(self.room_id, self.other, ["#room:localhost"])
+			for i in range(5):
+				hs.put_event(self.room_id, self.other, "m.room.message", {"msgtype": "m.text", "body": str(i)})
+			self.assertTrue(await async_wait_for(lambda: len(client.received) == 5))
+			self.assertEqual(client.received, ["0", "1", "2", "3", "4"])
+			self.assertTrue(await async_wait_for(lambda: client.rooms.get_room("#room:localhost") is not None))
+
+			# Too fast for the server: throttled, then sent in order
+			hs.send_interval = 0.2
+			client.start_sending(send_sleep_time=0, concurrency=2)
+			for i in range(3): client.sendmsg(self.room_id, "reply {}".format(i))
+			self.assertTrue(await async_wait_for(lambda: hs.sent == 3))
+			self.assertIn('mcc.sendqueue.throttled', self.notified)
+			self.assertTrue(await async_wait_for(lambda: client.received[-3:] == ["reply 0", "reply 1", "reply 2"]))
+
+			# close() stops syncing and sending for good
+			tasks = list(client.tasks)
+			client.close()
+			await asyncio.sleep(0.1)
+			self.assertTrue(all(task.done() for task in tasks))
+			self.assertEqual(len(client.tasks), 0)
+			self.assertEqual(len(client.api.http.idle) + len(client.api.sync_http.idle), 0)
+			syncs = hs.requests['sync']
+			hs.put_event(self.room_id, self.other, "m.room.message", {"msgtype": "m.text", "body": "after"})
+			client.sendmsg(self.room_id, "unsent")
+			await asyncio.sleep(0.3)
+			self.assertEqual(hs.requests['sync'], syncs)
+			self.assertEqual(hs.sent, 3)
+			self.assertNotIn("after", client.received)
+
+		asyncio.run(main())
+
+
+if __name__ == '__main__':
+	unittest.main()
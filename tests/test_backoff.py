@@ -0,0 +1,81 @@
+# stdlib
+import unittest
+
+# in-tree deps
+import matrix_client_core as client_framework
+import matrix_client_core.backoff as backoff
+import matrix_client_core.notifier as notifier
+
+
+class Clock:
+	def __init__(self):
+		self.now = 0
+
+	def __call__(self):
+		return self.now
+
+
+class BackoffTest(unittest.TestCase):
+	def test_delays(self):
+		clock = Clock()
+		b = backoff.Backoff(initial=5, maximum=30, factor=2, jitter=0, clock=clock)
+		self.assertEqual(b.next_delay(backoff.SYNC), 5)
+		self.assertEqual([b.failure(backoff.SYNC) for i in range(5)], [5, 10, 20, 30, 30])
+		self.assertEqual(b.remaining(backoff.SYNC), 30)
+		self.assertEqual(b.remaining(backoff.SEND), 0)
+		clock.now = 20
+		self.assertEqual(b.remaining(backoff.SYNC), 10)
+		b.success(backoff.SYNC)
+		self.assertEqual(b.failures(backoff.SYNC), 0)
+		self.assertEqual(b.next_delay(backoff.SYNC), 5)
+
+	def test_jitter(self):
+		b = backoff.Backoff(initial=10, jitter=0.5, random=lambda: 1)
+		self.assertEqual(b.failure(backoff.SEND), 5)
+
+
+class ExceptionTest(unittest.TestCase):
+	def setUp(self):
+		self.client = client_framework.MXClient(account=client_framework.AccountInfo())
+		self.client.backoff = backoff.Backoff(initial=5, jitter=0)
+		self.sources = []
+		notifier.add_listener(self.on_event, ['mcc.mxc.exception'])
+
+	def tearDown(self):
+		notifier.remove_listener(self.on_event)
+
+	def on_event(self, service, event, data):
+		self.sources.append(data)
+
+	def test_compat_attributes(self):
+		client = self.client
+		self.assertEqual(client.exception_delay_init, 5)
+		self.assertEqual(client.exception_delay, 5)
+		client.backoff.failure(backoff.SYNC)
+		self.assertEqual(client.exception_delay, 10)
+		client.exception_delay_init = 1
+		self.assertEqual(client.backoff.initial, 1)
+		self.assertEqual(client.exception_delay, 2)
+		client.exception_delay = 3
+		self.assertEqual(client.exception_delay, 3)
+		self.assertEqual(client.backoff.failures(backoff.SYNC), 0)
+
+	def test_handler_failures_dont_back_off(self):
+		class Failing(client_framework.MXClient):
+			@client_framework.wrap_exception
+			def on_global_timeline_event(self, event):
+				self.last_event = event
+				raise RuntimeError("broken handler")
+
+		client = Failing(account=client_framework.AccountInfo())
+		client.on_global_timeline_event({"room_id": "!r:s"})
+		client.on_exception(RuntimeError("bad command"), backoff.REPL)
+		self.assertEqual(self.sources, [backoff.HANDLER, backoff.REPL])
+		self.assertEqual(client.backoff.sources, {})
+
+		client.on_exception(RuntimeError("send failed"), backoff.SEND)
+		self.assertEqual(client.backoff.failures(backoff.SEND), 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
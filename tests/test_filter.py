@@ -0,0 +1,77 @@
+# stdlib
+import asyncio
+import os
+import tempfile
+import unittest
+
+# in-tree deps
+import matrix_client_core as client_framework
+import matrix_client_core.aio as aio
+from helpers import MockHomeserverTest
+
+
+class StaleFilterTest(MockHomeserverTest):
+	# A filter ID remembered in the account file that the server has
+	# forgotten since must be replaced, not make every startup fail
+
+	def setUp(self):
+		MockHomeserverTest.setUp(self)
+		self.hs.create_room(self.other, name="Room", members=[self.bot])
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tmpdir.cleanup)
+		self.accountfilename = os.path.join(self.tmpdir.name, "account.json")
+		self.statefilename = os.path.join(self.tmpdir.name, "state.json")
+		self.account().savetofile(self.accountfilename)
+
+	def client(self, cls=client_framework.MXClient, statefilename=None):
+		client = cls(self.accountfilename, statefilename=statefilename)
+		client.sync_filter = client.build_sync_filter(timeline_limit=5)
+		return client
+
+	def check_replaced(self, client):
+		self.assertEqual(self.hs.requests['filter'], 2)
+		self.assertFalse(client.sync_filter_cached)
+		self.assertEqual(len(client.rooms.roomsbyid), 1)
+		account = client_framework.AccountInfo()
+		account.loadfromfile(self.accountfilename)
+		self.assertEqual(account.sync_filter_id, client.sdkclient.sync_filter)
+
+	def run_twice(self, statefilename):
+		client = self.client(statefilename=statefilename)
+		client.login()
+		client.first_sync()
+		self.assertEqual(self.hs.requests['filter'], 1)
+		self.hs.filters.clear()
+		client = self.client(statefilename=statefilename)
+		client.login()
+		self.assertTrue(client.sync_filter_cached)
+		client.first_sync()
+		return client
+
+	def test_full_sync(self):
+		self.check_replaced(self.run_twice(None))
+
+	def test_resume(self):
+		client = self.run_twice(self.statefilename)
+		self.check_replaced(client)
+		# Resumed, rather than falling back to a full sync
+		self.assertEqual(self.hs.requests['sync'], 3)
+
+	def test_async(self):
+		client = self.client()
+		client.login()
+		client.first_sync()
+		self.hs.filters.clear()
+
+		async def main():
+			client = self.client(aio.AsyncMXClient)
+			await client.login()
+			await client.first_sync()
+			client.close()
+			return client
+
+		self.check_replaced(asyncio.run(main()))
+
+
+if __name__ == '__main__':
+	unittest.main()
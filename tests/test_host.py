@@ -0,0 +1,82 @@
+# stdlib
+import time
+import unittest
+
+# in-tree deps
+import matrix_client_core as client_framework
+import matrix_client_core.backoff as backoff
+import matrix_client_core.host as host
+import matrix_client_core.notifier as notifier
+from helpers import MockHomeserverTest, wait_for
+
+
+class RecordingClient(client_framework.MXClient):
+	def on_global_timeline_event(self, event):
+		self.received.append((time.monotonic(), event['content'].get('body')))
+
+
+class BotHostTest(MockHomeserverTest):
+	def setUp(self):
+		MockHomeserverTest.setUp(self)
+		self.events = []
+		notifier.add_listener(self.on_event, ['mcc.host.*'])
+
+	def tearDown(self):
+		notifier.remove_listener(self.on_event)
+
+	def on_event(self, service, event, data):
+		self.events.append((event, data))
+
+	def started(self):
+		return [data for event, data in self.events if event == 'mcc.host.client_started']
+
+	def client(self, localpart, register=True):
+		token = localpart + "token"
+		if register: self.hs.add_user(localpart, access_token=token)
+		account = self.account("@{}:{}".format(localpart, self.hs.server_name), token)
+		client = RecordingClient(account=account)
+		client.renderer.sinks = []
+		client.received = []
+		client.backoff = backoff.Backoff(initial=0.05, jitter=0)
+		return client
+
+	def test_poll_timeout(self):
+		bothost = host.BotHost(sync_workers=2, sync_timeout_ms=30000, sync_latency_ms=2000)
+		bothost.clients = [None] * 2
+		self.assertEqual(bothost.poll_timeout_ms(), 30000)
+		bothost.clients = [None] * 8
+		self.assertEqual(bothost.poll_timeout_ms(), 500)
+
+	def test_failed_start_is_retried(self):
+		bothost = host.BotHost(sync_workers=1, event_workers=1, send_workers=1, sync_latency_ms=600)
+		clients = [self.client("bot{}".format(i)) for i in range(3)]
+		ghost = self.client("ghost", register=False)
+		room_id = self.hs.create_room(self.other, members=[c.account.mxid for c in clients])
+		for client in [ghost] + clients: bothost.add(client)
+		bothost.start()
+		try:
+			# The others start while the ghost can't log in
+			self.assertTrue(wait_for(lambda: len(self.started()) == 3))
+			failed = [data for event, data in self.events if event == 'mcc.host.start_failed']
+			self.assertEqual(failed[0][0], ghost.account.mxid)
+			self.assertNotIn(ghost.account.mxid, self.started())
+
+			# Three clients taking turns on one worker still see new
+			# events within 'sync_latency_ms', give or take
+			time.sleep(0.5)
+			sent = time.monotonic()
+			self.hs.put_event(room_id, self.other, "m.room.message", {"msgtype": "m.text", "body": "hi"})
+			self.assertTrue(wait_for(lambda: all(c.received for c in clients)))
+			for client in clients:
+				self.assertEqual(client.received[0][1], "hi")
+				self.assertLess(client.received[0][0] - sent, 1.5)
+
+			self.hs.add_user("ghost", access_token="ghosttoken")
+			self.assertTrue(wait_for(lambda: ghost.account.mxid in self.started()))
+			self.assertEqual(ghost.backoff.failures(backoff.SYNC), 0)
+		finally:
+			bothost.stop()
+
+
+if __name__ == '__main__':
+	unittest.main()
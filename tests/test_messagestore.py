@@ -0,0 +1,38 @@
+# stdlib
+import os
+import tempfile
+import unittest
+
+# in-tree deps
+from matrix_client_core.messagestore import MessageStore
+
+
+def event(n, room_id="!r:s"):
+	return {"event_id": "$e{}:s".format(n), "room_id": room_id, "sender": "@u:s",
+		"type": "m.room.message", "content": {"msgtype": "m.text", "body": str(n)}}
+
+
+class MessageStoreTest(unittest.TestCase):
+	def test_per_room_must_be_positive(self):
+		for per_room in (0, -1):
+			with self.assertRaises(ValueError):
+				MessageStore(per_room=per_room)
+
+	def test_ring(self):
+		store = MessageStore(per_room=1)
+		for n in range(3): store.add(event(n))
+		self.assertEqual(len(store), 1)
+		self.assertEqual([m.body for m in store.recent("!r:s")], ["2"])
+		self.assertIsNone(store.get("$e0:s"))
+
+	def test_spill(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			store = MessageStore(per_room=1, spill_filename=os.path.join(tmpdir, "spill.db"))
+			for n in range(3): store.add(event(n))
+			self.assertEqual(store.get("$e0:s").body, "0")
+			self.assertEqual(store.get("$e2:s").body, "2")
+			store.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
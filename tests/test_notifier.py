@@ -0,0 +1,180 @@
+# stdlib
+import threading
+import unittest
+import unittest.mock
+
+# in-tree deps
+import matrix_client_core.notifier as notifier
+
+
+class Recorder:
+	def __init__(self, result=None):
+		self.events = []
+		self.result = result
+
+	def __call__(self, service, event, data=None):
+		self.events.append((event, data))
+		return self.result
+
+
+class NotifierTest(unittest.TestCase):
+	def setUp(self):
+		self.n = notifier.Notifier()
+
+	def test_subscriptions(self):
+		everything, exact, wild, asked = Recorder(), Recorder(), Recorder(), Recorder()
+		self.n.add_listener(everything)
+		self.n.add_listener(exact, ['a.b'])
+		self.n.add_listener(wild, ['a.*'])
+		self.n.add_listener(asked, lambda event: event.endswith('.c'))
+		for event in ('a.b', 'a.c', 'ab.c', 'x'): self.n.notify(__name__, event)
+		self.assertEqual([e for e, d in everything.events], ['a.b', 'a.c', 'ab.c', 'x'])
+		self.assertEqual([e for e, d in exact.events], ['a.b'])
+		self.assertEqual([e for e, d in wild.events], ['a.b', 'a.c'])
+		self.assertEqual([e for e, d in asked.events], ['a.c', 'ab.c'])
+
+	def test_cache_follows_listeners(self):
+		first, second = Recorder(True), Recorder()
+		self.assertIsNone(self.n.notify(__name__, 'a.b'))
+		self.assertTrue(self.n.add_listener(first, ['a.*']))
+		self.assertFalse(self.n.add_listener(first))
+		self.assertTrue(self.n.notify(__name__, 'a.b'))
+		self.n.add_listener(second, ['a.b'])
+		self.n.notify(__name__, 'a.b', 1)
+		self.assertEqual(second.events, [('a.b', 1)])
+		self.assertTrue(self.n.remove_listener(first))
+		self.assertFalse(self.n.remove_listener(first))
+		self.assertFalse(self.n.notify(__name__, 'a.b', 2))
+		self.assertEqual(len(first.events), 2)
+
+	def block(self):
+		# A queued listener that holds up the dispatch thread until released
+		entered = threading.Event()
+		release = threading.Event()
+
+		def listener(service, event, data):
+			if event == 'block':
+				entered.set()
+				release.wait(5)
+
+		self.n.add_listener(listener, ['block'])
+		self.n.notify(__name__, 'block')
+		self.assertTrue(entered.wait(5))
+		return release
+
+	def overflow(self, policy):
+		got = Recorder()
+		inline = Recorder(True)
+		self.assertTrue(self.n.start_async(maxsize=2, overflow=policy))
+		self.assertFalse(self.n.start_async())
+		self.n.add_listener(got, ['e'])
+		self.n.add_listener(inline, ['e'], synchronous=True)
+		release = self.block()
+		for i in range(5):
+			# Only synchronous listeners count in asynchronous mode
+			self.assertTrue(self.n.notify(__name__, 'e', i))
+		self.assertEqual(len(inline.events), 5)
+		release.set()
+		self.n.flush()
+		self.assertEqual(self.n.dropped, 3)
+		return [d for e, d in got.events]
+
+	def test_drop_newest(self):
+		self.assertEqual(self.overflow(notifier.OVERFLOW_DROP_NEWEST), [0, 1])
+
+	def test_drop_oldest(self):
+		self.assertEqual(self.overflow(notifier.OVERFLOW_DROP_OLDEST), [3, 4])
+
+	def test_block(self):
+		got = Recorder()
+		self.n.start_async(maxsize=1)
+		self.n.add_listener(got, ['e'])
+		release = self.block()
+		self.n.notify(__name__, 'e', 0)
+		sender = threading.Thread(target=self.n.notify, args=(__name__, 'e', 1))
+		sender.start()
+		sender.join(0.2)
+		self.assertTrue(sender.is_alive())
+		release.set()
+		sender.join(5)
+		self.n.flush()
+		self.assertEqual([d for e, d in got.events], [0, 1])
+		self.assertEqual(self.n.dropped, 0)
+
+	def test_unknown_overflow_policy(self):
+		with self.assertRaises(ValueError):
+			self.n.start_async(overflow='drop-everything')
+
+	def test_broken_listener(self):
+		def broken(service, event, data):
+			raise RuntimeError("broken listener")
+
+		got = Recorder()
+		self.n.start_async()
+		self.n.add_listener(broken)
+		self.n.add_listener(got)
+		with unittest.mock.patch('traceback.print_exc'):
+			self.n.notify(__name__, 'e')
+			self.n.flush()
+		self.assertEqual(len(got.events), 1)
+
+
+class Listener(notifier.BaseNotificationListener):
+	def __init__(self):
+		notifier.BaseNotificationListener.__init__(self, autoconnect=False)
+		self.events = []
+
+	def on_a_method(self, service, event, data):
+		self.events.append(event)
+
+	@staticmethod
+	def on_a_static(service, event, data):
+		return "static"
+
+
+class BaseNotificationListenerTest(unittest.TestCase):
+	def connect(self, listener):
+		n = notifier.Notifier()
+		n.add_listener(listener.handle_notification, listener.wants_notification)
+		return n
+
+	def test_handlers(self):
+		listener = Listener()
+		listener.on_a_instance = lambda service, event, data: listener.events.append("instance " + event)
+		n = self.connect(listener)
+		n.notify(__name__, 'a.method')
+		n.notify(__name__, 'a.instance')
+		self.assertTrue(n.notify(__name__, 'a.static'))
+		self.assertIsNone(n.notify(__name__, 'a.unhandled'))
+		self.assertEqual(listener.events, ['a.method', 'instance a.instance'])
+
+	def test_getattr(self):
+		class Dynamic(Listener):
+			def __getattr__(self, name):
+				if not name.startswith("on_dyn_"): raise AttributeError(name)
+				return lambda service, event, data: self.events.append("dynamic " + event)
+
+		listener = Dynamic()
+		n = self.connect(listener)
+		n.notify(__name__, 'dyn.x')
+		n.notify(__name__, 'a.method')
+		self.assertIsNone(n.notify(__name__, 'other.x'))
+		self.assertEqual(listener.events, ['dynamic dyn.x', 'a.method'])
+
+	def test_default_handler(self):
+		seen = []
+
+		class Catchall(Listener):
+			def default_handler(self, service, event, data):
+				seen.append(event)
+
+		listener = Catchall()
+		n = self.connect(listener)
+		n.notify(__name__, 'a.method')
+		n.notify(__name__, 'anything')
+		self.assertEqual(listener.events, ['a.method'])
+		self.assertEqual(seen, ['anything'])
+
+
+if __name__ == '__main__':
+	unittest.main()
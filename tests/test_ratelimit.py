@@ -0,0 +1,79 @@
+# stdlib
+import functools
+import threading
+import unittest
+
+# in-tree deps
+import matrix_client_core.ratelimit as ratelimit
+
+
+class Clock:
+	def __init__(self):
+		self.now = 0
+
+	def __call__(self):
+		return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+	def test_refill(self):
+		clock = Clock()
+		bucket = ratelimit.TokenBucket(rate=2, capacity=3, clock=clock)
+		self.assertEqual([bucket.try_consume() for i in range(4)], [True, True, True, False])
+		clock.now = 0.5
+		self.assertTrue(bucket.try_consume())
+		self.assertFalse(bucket.ok())
+		clock.now = 100
+		self.assertEqual(sum(bucket.try_consume() for i in range(10)), 3)
+
+	def test_no_over_admission(self):
+		# Many threads after the last token: exactly one gets it
+		for attempt in range(20):
+			bucket = ratelimit.TokenBucket(rate=0, capacity=1, clock=Clock())
+			threads = 16
+			barrier = threading.Barrier(threads)
+			admitted = []
+
+			def worker():
+				barrier.wait()
+				if bucket.try_consume(): admitted.append(1)
+
+			workers = [threading.Thread(target=worker) for i in range(threads)]
+			for t in workers: t.start()
+			for t in workers: t.join()
+			self.assertEqual(len(admitted), 1)
+			self.assertEqual(bucket.tokens, 0)
+
+
+class KeyedRateLimitTest(unittest.TestCase):
+	def test_keys_are_separate(self):
+		clock = Clock()
+		limit = ratelimit.KeyedRateLimit(functools.partial(ratelimit.TokenBucket, 1, 1, clock))
+		self.assertTrue(limit.try_consume("@a:s"))
+		self.assertFalse(limit.try_consume("@a:s"))
+		self.assertTrue(limit.try_consume("@b:s"))
+		self.assertEqual(limit.stats(), (1, 2, 0))	# hits, misses, evictions
+
+	def test_eviction(self):
+		limit = ratelimit.KeyedRateLimit(functools.partial(ratelimit.TokenBucket, 0, 1, Clock()), max_keys=2)
+		for key in ("a", "b", "c"): limit.try_consume(key)
+		self.assertEqual(list(limit.limiters), ["b", "c"])
+		self.assertEqual(limit.stats()[2], 1)
+		# Starts over
+		self.assertTrue(limit.try_consume("a"))
+
+	def test_replenish_thread(self):
+		class Bucket(ratelimit.TokenBucket):
+			pass
+
+		for factory in (Bucket, functools.partial(ratelimit.TokenBucket, 5)):
+			limit = ratelimit.KeyedRateLimit(factory)
+			limit.start_replenish_thread(60)
+			self.assertFalse(hasattr(limit, 'replenish_thread'))
+		limit = ratelimit.KeyedRateLimit(ratelimit.RateLimit)
+		limit.start_replenish_thread(60)
+		self.assertTrue(limit.replenish_thread.is_alive())
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,62 @@
+# stdlib
+import os
+import tempfile
+import unittest
+
+# in-tree deps
+import matrix_client_core as client_framework
+import matrix_client_core.recorder as recorder
+
+
+def sync_response(n):
+	event = {"event_id": "$e{}:s".format(n), "type": "m.room.message", "sender": "@u:s",
+		"origin_server_ts": n, "content": {"msgtype": "m.text", "body": str(n)}}
+	return {
+		"next_batch": "s{}".format(n),
+		"rooms": {"join": {"!a:s": {
+			"state": {"events": []},
+			"timeline": {"events": [event], "limited": False, "prev_batch": "p"},
+			"ephemeral": {"events": []},
+			"account_data": {"events": []}	}}, "invite": {}, "leave": {}},
+		"presence": {"events": []},
+		"account_data": {"events": []}	}
+
+
+class Collector(client_framework.MXClient):
+	def on_global_timeline_event(self, event):
+		self.bodies.append(event['content']['body'])
+
+
+class TraceReplayerTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tmpdir.cleanup)
+		self.tracefilename = os.path.join(self.tmpdir.name, "trace.gz")
+		writer = recorder.TraceWriter(self.tracefilename)
+		for n in range(3): writer.write("sync", sync_response(n))
+		writer.write("send", ["!a:s", "ok", 0.01])
+		writer.close()
+
+	def test_replay(self):
+		# A client set up for live use: replaying into it must leave its
+		# state file and trace alone
+		statefilename = os.path.join(self.tmpdir.name, "state.json")
+		with open(statefilename, "w") as f: f.write("live state")
+		live_trace = os.path.join(self.tmpdir.name, "live.trace")
+		client = Collector(statefilename=statefilename)
+		client.bodies = []
+		live_writer = client.recorder = recorder.TraceWriter(live_trace)
+		self.addCleanup(live_writer.close)
+		client.state_save_interval = 0
+
+		stats = recorder.TraceReplayer(self.tracefilename).replay(client)
+		self.assertEqual((stats['syncs'], stats['events'], stats['sends']), (3, 3, 1))
+		self.assertEqual(client.bodies, ["1", "2"])	# the first sync is the initial one
+		self.assertEqual(list(client.rooms.roomsbyid), ["!a:s"])
+		self.assertFalse(hasattr(client, 'debug_info'))	# no exceptions
+		with open(statefilename) as f: self.assertEqual(f.read(), "live state")
+		self.assertEqual(os.path.getsize(live_trace), 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,145 @@
+# stdlib
+import random
+import threading
+import unittest
+
+# in-tree deps
+import matrix_client_core as client_framework
+from helpers import MockHomeserverTest
+
+
+class FakeRoom:
+	# Just enough of matrix_client.room.Room for RoomList
+
+	def __init__(self, room_id, aliases, canonical_alias=None):
+		self.room_id = room_id
+		self.aliases = aliases
+		self.canonical_alias = canonical_alias
+
+
+def random_aliases(rnd, n):
+	# Aliases are unique to their room, but their prefixes (the part
+	# before the ':') are shared between rooms often enough to matter
+	aliases = ["#{}:s{}".format(rnd.choice("abcdefgh") * rnd.randint(1, 3), n)
+		for i in range(rnd.randint(0, 3))]
+	return sorted(set(aliases))
+
+
+def prefix_index(rooms):
+	result = {}
+	for prefix, item in rooms.roomsbyprefix.items():
+		if isinstance(item, list): result[prefix] = frozenset(r.room_id for r in item)
+		else: result[prefix] = frozenset((item.room_id,))
+	return result
+
+
+class RoomListIncrementalTest(unittest.TestCase):
+	# Random joins, leaves and alias changes, applied one at a time, must
+	# leave the index exactly as building it from scratch would
+
+	def check(self, rooms):
+		fresh = client_framework.RoomList(dict(rooms.roomsbyid))
+		self.assertEqual(dict((a, r.room_id) for a, r in rooms.roomsbyalias.items()),
+			dict((a, r.room_id) for a, r in fresh.roomsbyalias.items()))
+		self.assertEqual(prefix_index(rooms), prefix_index(fresh))
+		self.assertEqual(rooms.indexedaliases, fresh.indexedaliases)
+		for room_id, handle in rooms.handles.items():
+			self.assertEqual(handle, fresh.get_room_handle(room_id), room_id)
+		lookups = list(rooms.roomsbyid) + list(fresh.roomsbyalias) + list(fresh.roomsbyprefix)
+		for key in lookups:
+			self.assertEqual(rooms.get_room_handle(key), fresh.get_room_handle(key), key)
+			self.assertIs(rooms.get_room(key), fresh.get_room(key), key)
+
+	def test_random_updates(self):
+		rnd = random.Random(1234)
+		rooms_dict = {}
+		for n in range(10):
+			aliases = random_aliases(rnd, n)
+			room_id = "!r{}:s".format(n)
+			rooms_dict[room_id] = FakeRoom(room_id, aliases, aliases[0] if aliases else None)
+		rooms = client_framework.RoomList(rooms_dict)
+		next_room = len(rooms_dict)
+		self.check(rooms)
+
+		for step in range(2000):
+			op = rnd.random()
+			ids = sorted(rooms.roomsbyid)
+			if op < 0.15 or not ids:
+				# join
+				room_id = "!r{}:s".format(next_room)
+				aliases = random_aliases(rnd, next_room)
+				next_room += 1
+				rooms.add_room(FakeRoom(room_id, aliases, aliases[0] if aliases else None))
+			elif op < 0.3:
+				# leave
+				rooms.remove_room(rnd.choice(ids))
+			elif op < 0.65:
+				# new aliases, as the SDK applies them before calling us
+				room = rooms.roomsbyid[rnd.choice(ids)]
+				room.aliases = random_aliases(rnd, room.room_id[2:].split(":")[0])
+				rooms.update_room(room)
+			else:
+				# new canonical alias
+				room = rooms.roomsbyid[rnd.choice(ids)]
+				room.canonical_alias = rnd.choice(room.aliases + [None])
+				rooms.update_room(room)
+			# Look some handles up, so that there are cached ones to go stale
+			for room_id in rnd.sample(sorted(rooms.roomsbyid), min(3, len(rooms.roomsbyid))):
+				rooms.get_room_handle(room_id)
+			self.check(rooms)
+
+	def test_update_during_lookup(self):
+		# A handler re-indexing one room while another thread works out
+		# the handle of a room sharing a prefix with it must not leave a
+		# stale handle in the cache
+		computed = threading.Event()
+		proceed = threading.Event()
+
+		class SlowRoomList(client_framework.RoomList):
+			def _room_handle(self, room):
+				handle = client_framework.RoomList._room_handle(self, room)
+				if room.room_id == "!b:s":
+					computed.set()
+					proceed.wait(5)
+				return handle
+
+		a = FakeRoom("!a:s", ["#bar:s1"], "#bar:s1")
+		b = FakeRoom("!b:s", ["#foo:s2"], "#foo:s2")
+		rooms = SlowRoomList({a.room_id: a, b.room_id: b})
+
+		reader = threading.Thread(target=rooms.get_room_handle, args=(b.room_id,))
+		reader.start()
+		self.assertTrue(computed.wait(5))
+		a.aliases = ["#foo:s1"]
+		a.canonical_alias = "#foo:s1"
+		updater = threading.Thread(target=rooms.update_room, args=(a,))
+		updater.start()
+		updater.join(0.2)
+		proceed.set()
+		reader.join()
+		updater.join()
+		self.assertEqual(rooms.get_room_handle(b.room_id), "#foo:s2")
+		self.check(rooms)
+
+
+class RoomListLeaveTest(MockHomeserverTest):
+	def test_leave_frees_aliases(self):
+		a = self.hs.create_room(self.other, aliases=["#foo:localhost"], members=[self.bot])
+		b = self.hs.create_room(self.other, aliases=["#foo:example.org"], members=[self.bot])
+		client = client_framework.MXClient(account=self.account())
+		client.renderer.sinks = []
+		client.login()
+		client.first_sync()
+		client.add_listeners()
+		self.assertIsNone(client.rooms.get_room("#foo"))	# ambiguous
+
+		client.sdkclient.api.leave_room(a)
+		client.sdkclient._sync(timeout_ms=0)
+		self.assertNotIn(a, client.rooms.roomsbyid)
+		self.assertIsNone(client.rooms.get_room("#foo:localhost"))
+		self.assertIs(client.rooms.get_room("#foo"), client.rooms.get_room(b))
+		self.assertEqual(client.rooms.get_room_handle(b), "#foo")
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,119 @@
+# stdlib
+import unittest
+
+# external deps
+import matrix_client.errors
+
+# in-tree deps
+import matrix_client_core as client_framework
+import matrix_client_core.dispatch as dispatch
+import matrix_client_core.host as host
+import matrix_client_core.notifier as notifier
+import matrix_client_core.roomstate as roomstate
+from helpers import wait_for
+
+
+class FakeApi:
+	# Room state as MatrixHttpApi would fetch it, counting requests
+	def __init__(self, state):
+		self.state = state	# (room ID, type, state key) -> content
+		self.requests = 0
+
+	def get_state_event(self, room_id, event_type):
+		return self._get((room_id, event_type, ""))
+
+	def get_membership(self, room_id, user_id):
+		return self._get((room_id, 'm.room.member', user_id))
+
+	def _get(self, key):
+		self.requests += 1
+		content = self.state.get(key)
+		if content is None: raise matrix_client.errors.MatrixRequestError(code=404, content="Not found")
+		if isinstance(content, Exception): raise content
+		return content
+
+
+def member_event(user_id, displayname):
+	return {"type": "m.room.member", "state_key": user_id, "content": {"membership": "join", "displayname": displayname}}
+
+
+class RoomStateCacheTest(unittest.TestCase):
+	def test_sync_and_fetch(self):
+		api = FakeApi({("!r:s", "m.room.member", "@b:s"): {"displayname": "Bee"}})
+		cache = roomstate.RoomStateCache(api)
+		cache.on_sync_response({"rooms": {"join": {"!r:s": {
+			"state": {"events": [member_event("@a:s", "Ay")]},
+			"timeline": {"events": [{"type": "m.room.name", "state_key": "", "content": {"name": "Room"}},
+				{"type": "m.room.message", "content": {}}]}	}}}})
+		self.assertEqual(cache.displayname("!r:s", "@a:s"), "Ay")
+		self.assertEqual(cache.name("!r:s"), "Room")
+		self.assertEqual(api.requests, 0)
+
+		self.assertIsNone(cache.displayname("!r:s", "@b:s", fetch=False))
+		self.assertEqual(cache.displayname("!r:s", "@b:s"), "Bee")
+		self.assertIsNone(cache.topic("!r:s"))	# 404, and remembered as such
+		self.assertIsNone(cache.topic("!r:s"))
+		self.assertEqual(api.requests, 2)
+
+		cache.on_sync_response({"rooms": {"leave": {"!r:s": {}}}})
+		self.assertEqual(len(cache), 0)
+
+	def test_eviction(self):
+		cache = roomstate.RoomStateCache(max_entries=2)
+		for user in ("@a:s", "@b:s"):
+			cache.on_sync_response({"rooms": {"join": {"!r:s": {"state": {"events": [member_event(user, user)]}}}}})
+		cache.displayname("!r:s", "@a:s")	# now the most recently used
+		cache.on_sync_response({"rooms": {"join": {"!r:s": {"state": {"events": [member_event("@c:s", "C")]}}}}})
+		self.assertEqual([k[2] for k in cache.entries], ["@a:s", "@c:s"])
+		self.assertEqual(cache.stats()[2], 1)
+
+	def test_prefetch(self):
+		api = FakeApi({("!r:s", "m.room.member", "@b:s"): {"displayname": "Bee"}})
+		cache = roomstate.RoomStateCache(api)
+		cache.prefetch("!r:s", "m.room.member", "@b:s")	# nowhere to run it
+		self.assertEqual(api.requests, 0)
+
+		cache.executor = dispatch.OrderedDispatcher(1)
+		cache.executor.start()
+		cache.prefetch("!r:s", "m.room.member", "@b:s")
+		self.assertTrue(wait_for(lambda: cache.displayname("!r:s", "@b:s", fetch=False) == "Bee"))
+		self.assertTrue(wait_for(lambda: not cache.pending))
+		cache.prefetch("!r:s", "m.room.member", "@b:s")	# cached already
+		self.assertEqual(api.requests, 1)
+
+	def test_prefetch_failure(self):
+		failures = []
+		listener = lambda service, event, data: failures.append(data[0])
+		notifier.add_listener(listener, ['mcc.roomstate.prefetch_failed'])
+		self.addCleanup(notifier.remove_listener, listener)
+		key = ("!r:s", "m.room.member", "@b:s")
+		cache = roomstate.RoomStateCache(FakeApi({key: RuntimeError("connection reset")}))
+		cache.executor = dispatch.OrderedDispatcher(1)
+		cache.executor.start()
+		cache.prefetch(*key)
+		self.assertTrue(wait_for(lambda: failures))
+		self.assertEqual(failures, [key])
+		self.assertTrue(wait_for(lambda: not cache.pending))
+		self.assertIsNone(cache.get(*key, fetch=False))
+
+	def test_prefetch_never_blocks(self):
+		# A full backlog skips the prefetch rather than wait for room
+		cache = roomstate.RoomStateCache(FakeApi({}))
+		cache.executor = dispatch.OrderedDispatcher(1, max_backlog=1)
+		cache.prefetch("!r:s", "m.room.member", "@a:s")
+		cache.prefetch("!r:s", "m.room.member", "@b:s")
+		self.assertEqual(cache.executor.qsize(), 1)
+		self.assertEqual(cache.pending, set([("!r:s", "m.room.member", "@a:s")]))
+
+	def test_host_shares_executor(self):
+		for event_workers in (0, 2):
+			bothost = host.BotHost(event_workers=event_workers)
+			clients = [client_framework.MXClient() for i in range(3)]
+			for client in clients: bothost.add(client)
+			executors = set(id(c.room_state.executor) for c in clients)
+			self.assertEqual(executors, set([id(bothost.prefetcher)]))
+			if event_workers: self.assertIs(bothost.prefetcher, bothost.dispatcher)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,52 @@
+# stdlib
+import unittest
+
+# in-tree deps
+import matrix_client_core as client_framework
+import matrix_client_core.notifier as notifier
+import matrix_client_core.sendqueue as sendqueue
+from helpers import MockHomeserverTest, wait_for
+
+
+class AdaptivePacingTest(MockHomeserverTest):
+	def setUp(self):
+		MockHomeserverTest.setUp(self)
+		self.room_id = self.hs.create_room(self.other, members=[self.bot])
+		self.client = client_framework.MXClient(account=self.account())
+		self.client.renderer.sinks = []
+		self.client.login()
+		self.client.first_sync()
+		self.client.add_listeners()
+		self.intervals = []
+		self.throttled = 0
+		notifier.add_listener(self.on_event, ['mcc.sendqueue.*'])
+
+	def tearDown(self):
+		notifier.remove_listener(self.on_event)
+
+	def on_event(self, service, event, data):
+		if event == 'mcc.sendqueue.rate': self.intervals.append(data[0])
+		elif event == 'mcc.sendqueue.throttled': self.throttled += 1
+
+	def test_pacer_follows_server(self):
+		client = self.client
+		client.sendq.pacer = sendqueue.AdaptivePacer(speedup_after=3)
+		client.start_send_thread(send_sleep_time=0, concurrency=2)
+
+		# Too fast for the server: the 429s must reach the pacer
+		self.hs.send_interval = 0.2
+		for i in range(6): client.sendmsg(self.room_id, "slow {}".format(i))
+		self.assertTrue(wait_for(lambda: self.hs.sent == 6))
+		self.assertGreater(self.throttled, 0)
+		self.assertGreater(max(self.intervals), 0)
+
+		# Once the server lets us, the pacer speeds up all the way again
+		self.hs.send_interval = 0
+		for i in range(6): client.sendmsg(self.room_id, "fast {}".format(i))
+		self.assertTrue(wait_for(lambda: self.hs.sent == 12))
+		self.assertEqual(client.sendq.pacer.interval, 0)
+		self.assertEqual(self.intervals[-1], 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
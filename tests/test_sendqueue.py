@@ -0,0 +1,124 @@
+# stdlib
+import time
+import unittest
+
+# in-tree deps
+import matrix_client_core.notifier as notifier
+import matrix_client_core.sendqueue as sendqueue
+
+
+class SendSchedulerTest(unittest.TestCase):
+	def setUp(self):
+		self.waits = []
+		notifier.add_listener(self.on_event, ['mcc.sendqueue.dequeue'])
+
+	def tearDown(self):
+		notifier.remove_listener(self.on_event)
+
+	def on_event(self, service, event, data):
+		key, priority, wait, depth = data
+		self.waits.append((key, wait))
+
+	def test_order(self):
+		q = sendqueue.SendScheduler()
+		q.put("!a", "a1", sendqueue.BULK)
+		q.put("!a", "a2", sendqueue.INTERACTIVE)
+		q.put("!b", "b1")
+		self.assertEqual(q.get(), ("!a", "a2"))
+		self.assertEqual(q.get(), ("!b", "b1"))
+		q.done("!a")
+		self.assertEqual(q.get(), ("!a", "a1"))
+		q.done("!a")
+		q.done("!b")
+		self.assertEqual(q.lanes, {})
+
+	def test_bad_priority(self):
+		q = sendqueue.SendScheduler()
+		for priority in (-1, 3, None, "normal"):
+			with self.assertRaises(ValueError):
+				q.put("!a", "a1", priority)
+		self.assertEqual(q.lanes, {})
+		self.assertEqual(q.qsize(), 0)
+
+	def test_paced_lanes_are_dropped(self):
+		# Lanes that are done but may not send again yet must not stay
+		# around forever
+		q = sendqueue.SendScheduler(pacing=0.05)
+		for i in range(100):
+			q.put(i, "msg")
+			self.assertEqual(q.get(), (i, "msg"))
+			q.done(i)
+		self.assertEqual(len(q.lanes), 100)
+		time.sleep(0.1)
+		q.put("last", "msg")
+		self.assertEqual(q.get(), ("last", "msg"))
+		self.assertEqual(list(q.lanes), ["last"])
+		self.assertEqual(len(q.waiting), 0)
+
+	def test_paced_lane_keeps_pacing(self):
+		q = sendqueue.SendScheduler(pacing=0.1)
+		q.put("!a", "a1")
+		q.get()
+		q.done("!a")
+		t0 = time.monotonic()
+		q.put("!a", "a2")
+		self.assertEqual(q.get(), ("!a", "a2"))
+		self.assertGreaterEqual(time.monotonic() - t0, 0.09)
+
+	def test_throttled_item_keeps_its_age(self):
+		q = sendqueue.SendScheduler(pacer=sendqueue.AdaptivePacer(first_step=0))
+		q.put("!a", "a1", ttl=60)
+		q.get()
+		time.sleep(0.1)
+		q.throttle("!a", "a1")
+		q.done("!a")
+		self.assertEqual(q.get(), ("!a", "a1"))
+		self.assertGreaterEqual(self.waits[-1][1], 0.1)
+		self.assertEqual(q.lanes["!a"].current[2], q.lanes["!a"].current[1] + 60)
+
+	def test_throttle_burst_slows_down_once(self):
+		# Sends that were under way when the first 429 came in were sent
+		# too fast as well; their 429s must not slow down the pacer again
+		q = sendqueue.SendScheduler(pacer=sendqueue.AdaptivePacer())
+		for key in ("!a", "!b", "!c"): q.put(key, key)
+		taken = [q.get() for i in range(3)]
+		for key, item in taken:
+			q.throttle(key, item, 0.05)
+			q.done(key)
+		self.assertEqual(q.pacer.interval, 0.5)	# first_step, more than retry_after
+
+		# A send started after that, and refused too, does count
+		key, item = q.get()
+		q.throttle(key, item, 0.05)
+		q.done(key)
+		self.assertEqual(q.pacer.interval, 1)
+
+
+class AdaptivePacerTest(unittest.TestCase):
+	def test_follows_retry_after(self):
+		pacer = sendqueue.AdaptivePacer(first_step=0.5, max_interval=60, speedup_after=2)
+		pacer.throttled(2)
+		self.assertEqual(pacer.interval, 2)
+		pacer.throttled(1)	# not enough, as we were already that slow
+		self.assertEqual(pacer.interval, 4)
+		pacer.throttled(0)
+		self.assertEqual(pacer.interval, 8)
+		pacer.throttled(90)	# the server knows best, even past the cap
+		self.assertEqual(pacer.interval, 90)
+		pacer.throttled(0)
+		self.assertEqual(pacer.interval, 90)
+
+	def test_speeds_up(self):
+		pacer = sendqueue.AdaptivePacer(first_step=0.5, speedup_after=2, speedup_factor=0.5)
+		pacer.throttled(1)
+		self.assertFalse(pacer.success())
+		self.assertTrue(pacer.success())
+		self.assertEqual(pacer.interval, 0.5)
+		pacer.success()
+		pacer.success()
+		self.assertEqual(pacer.interval, 0)
+		self.assertIsNone(pacer.rate())
+
+
+if __name__ == '__main__':
+	unittest.main()
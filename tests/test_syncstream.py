@@ -0,0 +1,219 @@
+# stdlib
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+# in-tree deps
+import matrix_client_core as client_framework
+import matrix_client_core.recorder as recorder
+import matrix_client_core.syncstream as syncstream
+from helpers import MockHomeserverTest
+
+
+def message(n, body):
+	return {"event_id": "$e{}:s".format(n), "type": "m.room.message", "sender": "@u{}:s".format(n),
+		"origin_server_ts": 1500000000000 + n, "content": {"msgtype": "m.text", "body": body},
+		"unsigned": {"age": n * 1.5, "redacted": False, "txn": None}}
+
+SAMPLE = {
+	"next_batch": "s72594_4483_1934",
+	"presence": {"events": []},
+	"account_data": {"events": [{"type": "m.direct", "content": {}}]},
+	"rooms": {
+		"join": {
+			"!a:s": {
+				"state": {"events": [{"type": "m.room.name", "state_key": "", "content": {"name": "Caf\u00e9 \u2615"}}]},
+				"timeline": {"events": [message(1, "Hello, {world}: [1, 2]"), message(2, "Quote \" and \\ and \n")],
+					"limited": True, "prev_batch": "p1"},
+				"unread_notifications": {"highlight_count": 0, "notification_count": 12}	},
+			"!b:s": {"timeline": {"events": [message(3, "\U0001f600 \u00fc\u00df")]}}	},
+		"invite": {"!c:s": {"invite_state": {"events": []}}},
+		"leave": {},
+		"knock": {"!d:s": {}}	},
+	"device_one_time_keys_count": {"signed_curve25519": 50},
+	"to_device": {"events": []}	}
+
+DOCUMENTS = (
+	json.dumps(SAMPLE),
+	json.dumps(SAMPLE, indent=2, ensure_ascii=False),
+	json.dumps(SAMPLE, separators=(',', ':')),
+	'{"next_batch": 12345, "rooms": {"join": {"!x:s": {"n": -1.5e3}}}, "z": 0}',
+	' \n{ }\n ')
+
+
+def expected(document):
+	# What iter_sync() yields, put back together: empty sections of
+	# "rooms" have nothing to yield
+	result = json.loads(document)
+	rooms = result.get("rooms")
+	if rooms is not None:
+		for section in ("join", "invite", "leave"):
+			if rooms.get(section) == {}: del rooms[section]
+		if not rooms: del result["rooms"]
+	return result
+
+
+def reassemble(chunks):
+	result = {}
+	for path, value in syncstream.iter_sync(chunks):
+		d = result
+		for key in path[:-1]: d = d.setdefault(key, {})
+		d[path[-1]] = value
+	return result
+
+
+class FakeResponse:
+	def __init__(self, chunks):
+		self.chunks = chunks
+		self.closed = False
+
+	def iter_content(self, chunk_size):
+		return iter(self.chunks)
+
+	def close(self):
+		self.closed = True
+
+
+class IterSyncTest(unittest.TestCase):
+	def test_split_everywhere(self):
+		for document in DOCUMENTS:
+			want = expected(document)
+			self.assertEqual(reassemble([document]), want)
+			for i in range(len(document) + 1):
+				self.assertEqual(reassemble([document[:i], document[i:]]), want, i)
+			self.assertEqual(reassemble(list(document)), want)
+
+	def test_split_bytes_everywhere(self):
+		# Multi-byte characters may be split between network chunks
+		document = DOCUMENTS[1]
+		data = document.encode("utf-8")
+		want = expected(document)
+		for i in range(len(data) + 1):
+			chunks = syncstream._iter_text(FakeResponse([data[:i], data[i:]]))
+			self.assertEqual(reassemble(chunks), want, i)
+
+	def test_rooms_one_at_a_time(self):
+		paths = [path for path, value in syncstream.iter_sync([DOCUMENTS[0]])]
+		self.assertIn(("rooms", "join", "!a:s"), paths)
+		self.assertIn(("rooms", "join", "!b:s"), paths)
+		self.assertIn(("rooms", "invite", "!c:s"), paths)
+		self.assertIn(("rooms", "knock"), paths)
+		self.assertIn(("next_batch",), paths)
+
+	def test_truncated(self):
+		for document in DOCUMENTS[:4]:
+			document = document.rstrip()
+			for i in range(len(document)):
+				with self.assertRaises(ValueError, msg=i):
+					reassemble([document[:i]])
+				with self.assertRaises(ValueError, msg=i):
+					reassemble(list(document[:i]))
+
+	def test_malformed(self):
+		for document in (
+				'',
+				'[]',
+				'"rooms"',
+				'{"rooms" {}}',
+				'{"a": 1 "b": 2}',
+				'{"a": 1,}',
+				'{1: 2}',
+				'{"rooms": {"join": {"!a:s": {"x": }}}}',
+				'{"rooms": {"join": []}}',
+				'{"rooms": {"join": {"!a:s": {"x": tru}}}}',
+				'{"a": "unterminated}',
+				'{"a": 1}}'[:-2] + '] '):
+			with self.assertRaises(ValueError, msg=document):
+				reassemble([document])
+			with self.assertRaises(ValueError, msg=document):
+				reassemble(list(document))
+
+
+class ResponseClosedTest(unittest.TestCase):
+	# The sync connection pool has a single connection: a streamed
+	# response must give it back however the sync ends
+
+	def test_read_to_the_end(self):
+		response = FakeResponse([DOCUMENTS[0].encode("utf-8")])
+		reassemble(syncstream._iter_text(response))
+		self.assertTrue(response.closed)
+
+	def test_stream_sync_fails_halfway(self):
+		document = DOCUMENTS[0]
+		response = FakeResponse([document[:len(document) // 2].encode("utf-8")])
+		sdkclient = client_framework.NoSyncMatrixClient("http://example.invalid")
+		sdkclient.enable_sync()
+		with unittest.mock.patch.object(syncstream, 'fetch', lambda *args: syncstream._iter_text(response)):
+			with self.assertRaises(ValueError):
+				sdkclient.stream_sync()
+		self.assertTrue(response.closed)
+
+
+class FilterRoomTest(unittest.TestCase):
+	def test_filter_room(self):
+		sync_room = {
+			"state": {"events": [{"type": "m.room.member"}, {"type": "m.room.name"}]},
+			"timeline": {"events": [{"type": "m.room.message"}, {"type": "m.reaction"}, {}]},
+			"ephemeral": {"events": [{"type": "m.typing"}]},
+			"summary": {"m.heroes": []}	}
+		room_filter = {
+			"state": {"types": ["m.room.*"], "not_types": ["m.room.member"]},
+			"timeline": {"not_types": ["m.reaction"]},
+			"ephemeral": {"not_types": ["*"]},
+			"summary": {"types": []},
+			"lazy_load_members": True	}
+		syncstream.filter_room(sync_room, room_filter)
+		self.assertEqual(sync_room["state"]["events"], [{"type": "m.room.name"}])
+		self.assertEqual(sync_room["timeline"]["events"], [{"type": "m.room.message"}, {}])
+		self.assertEqual(sync_room["ephemeral"]["events"], [])
+		self.assertEqual(sync_room["summary"], {"m.heroes": []})
+
+
+class StreamSyncListenersTest(MockHomeserverTest):
+	# A streamed sync must look the same as a normal one to sync response
+	# listeners and the recorder: one call per response
+
+	def setUp(self):
+		MockHomeserverTest.setUp(self)
+		for i in range(5):
+			room_id = self.hs.create_room(self.other, name="Room {}".format(i), members=[self.bot])
+			self.hs.put_event(room_id, self.other, "m.room.message", {"msgtype": "m.text", "body": "Hi"})
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tmpdir.cleanup)
+
+	def first_sync(self, streaming):
+		client = client_framework.MXClient(account=self.account())
+		client.stream_first_sync = streaming
+		client.login()
+		tracefilename = os.path.join(self.tmpdir.name, "trace{}".format(int(streaming)))
+		client.start_recording(tracefilename)
+		responses = []
+		pieces = []
+		client.sdkclient.add_sync_response_listener(responses.append)
+		client.sdkclient.add_sync_response_listener(pieces.append, pieces=True)
+		client.first_sync()
+		client.stop_recording()
+		traced = [data for t, kind, data in recorder.read_trace(tracefilename) if kind == "sync"]
+		return client, responses, pieces, traced
+
+	def test_listeners_once_per_response(self):
+		client, responses, pieces, traced = self.first_sync(False)
+		self.assertEqual(len(responses), 1)
+		self.assertEqual(len(pieces), 1)
+		self.assertEqual(len(traced), 1)
+		normal = responses[0]
+
+		client, responses, pieces, traced = self.first_sync(True)
+		self.assertEqual(len(responses), 1)
+		self.assertEqual(len(pieces), 6)	# 5 rooms, then the rest
+		self.assertEqual(len(traced), 1)
+		self.assertEqual(sorted(responses[0]['rooms']['join']), sorted(normal['rooms']['join']))
+		self.assertEqual(responses[0]['next_batch'], normal['next_batch'])
+		self.assertEqual(traced[0], responses[0])
+		self.assertEqual(len(client.rooms.roomsbyid), 5)
+
+
+if __name__ == '__main__':
+	unittest.main()